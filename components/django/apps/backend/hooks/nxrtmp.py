@@ -1,5 +1,12 @@
+import json, re, time, urlparse
+
+from django.conf import settings
 from django.conf.urls import patterns, url
 from django.http import HttpResponse
+from redis_cache import get_redis_connection
+
+from camaste import listing
+from camaste.scripts import run_script
 
 
 """
@@ -19,12 +26,176 @@ notifications via Redis.
 
 Basically this makes sure that when a whore goes offline by accident the private
 show stops and the fappers get notified instantly... that kinda stuff.
+
+nginx-rtmp holds up the RTMP handshake until on_publish and on_play answer,
+so those two are answered by `NginxHooksApplication` straight from Redis,
+before Django and its session/auth/CSRF middleware get a look in. Everything
+else goes through Django as usual.
+
+on_update is called for every publisher and viewer every
+NXRTMP_UPDATE_INTERVAL seconds, it only counts heartbeats in Redis. The
+`flushheartbeats` command writes them to the database in bulk.
+"""
+
+
+# Names of streams and rooms, and the random part of access keys
+TOKEN_RE = re.compile(r'^[A-Za-z0-9]{1,64}$')
+
+# Heartbeats counted by on_update, flushed by the `flushheartbeats` command:
+# performer pk scored by the unix time of their stream's last update, and
+# room token -> seconds watched by viewers since the last flush
+HEARTBEAT_PERFORMERS = 'Heartbeat_Performers'
+HEARTBEAT_VIEWERS = 'Heartbeat_Viewers'
+
+# Viewer sessions, from on_play until on_play_done, by nginx client id:
+# clientid -> JSON of the `room`, its `performer` pk, `account` pk and
+# `started` unix time,
+# clientid scored by the time of the viewer's last heartbeat, and a list
+# of JSON of the closed sessions, with `ended` and `orphaned`, waiting to
+# be written to the database by `flushheartbeats`
+VIEWERS_OPEN = 'Viewers_Open'
+VIEWERS_SEEN = 'Viewers_Seen'
+VIEWERS_CLOSED = 'Viewers_Closed'
+# Opening and closing sessions counts the performers' viewers for the listing
+SESSION_KEYS = [VIEWERS_OPEN, VIEWERS_SEEN, VIEWERS_CLOSED, listing.ONLINE_VIEWERS, listing.PUBLIC_VIEWERS]
+
+# Access levels which may watch a room's stream, the realtime server's
+# RoomAccess.JOIN_LEVELS
+PLAY_LEVELS = 'GVPA'
+
+# Moves a viewer session to VIEWERS_CLOSED. Orphaned sessions, which never
+# got an on_play_done, end at their last heartbeat. `keys` is a table of
+# the SESSION_KEYS.
+CLOSE_SESSION = listing.COUNT_VIEWER_LUA + """
+local function close_session(keys, clientid, ended, orphaned)
+	local session = redis.call('hget', keys[1], clientid)
+	if not session then
+		return 0
+	end
+	session = cjson.decode(session)
+	ended = ended or tonumber(redis.call('zscore', keys[2], clientid)) or session['started']
+	-- The web servers' clocks may differ a little
+	session['ended'] = math.max(ended, session['started'])
+	session['orphaned'] = orphaned
+	redis.call('rpush', keys[3], cjson.encode(session))
+	redis.call('hdel', keys[1], clientid)
+	redis.call('zrem', keys[2], clientid)
+	if session['performer'] then
+		count_viewer(keys[4], keys[5], tostring(session['performer']), -1)
+	end
+	return 1
+end
+"""
+
+# The access level of a room access token, like RoomAccess.resolve in the
+# realtime server, and if it may watch, opens the viewer's session. Returns
+# the level or false. All in one round trip to Redis.
+# KEYS: Room_<token>, Room_<token>_Members, SESSION_KEYS..., and the
+#       RAXS.<token>.* key, left out for anonymous viewers
+# ARGV: room token, clientid, unix time, PLAY_LEVELS
+PLAY_SCRIPT = CLOSE_SESSION + """
+local room = redis.call('get', KEYS[1])
+room = room and cjson.decode(room)
+
+local function resolve()
+	if not room then
+		return false
+	end
+	if #KEYS < 8 then
+		if room['allow_anons'] == true and room['is_private'] ~= true then
+			return 'V'
+		end
+		return false
+	end
+	local grant = redis.call('get', KEYS[8])
+	if not grant then
+		return false
+	end
+	local account = cjson.decode(grant)['account']
+	local member = redis.call('hget', KEYS[2], tostring(account['pk']))
+	if member then
+		-- Newer than the grant, e.g. after a ban
+		return cjson.decode(member)['account']['access'], account['pk']
+	elseif room['is_private'] == true then
+		return false
+	end
+	return account['access'], account['pk']
+end
+
+local level, account = resolve()
+if type(level) ~= 'string' or #level ~= 1 or not string.find(ARGV[4], level, 1, true) then
+	return false
+end
+local keys = {KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7]}
+-- nginx reuses client ids after a restart
+close_session(keys, ARGV[2], nil, true)
+local performer = room['performer']
+if performer == cjson.null then
+	performer = nil
+end
+redis.call('hset', KEYS[3], ARGV[2], cjson.encode({
+	room = ARGV[1], performer = performer, account = account, clientid = ARGV[2], started = tonumber(ARGV[3])}))
+redis.call('zadd', KEYS[4], ARGV[3], ARGV[2])
+if performer then
+	count_viewer(KEYS[6], KEYS[7], tostring(performer), 1)
+end
+return level
+"""
+
+# KEYS: SESSION_KEYS
+# ARGV: clientid, unix time
+PLAY_DONE_SCRIPT = CLOSE_SESSION + """
+return close_session(KEYS, ARGV[1], tonumber(ARGV[2]), false)
+"""
+
+# Closes up to ARGV[2] sessions without a heartbeat since ARGV[1], for the
+# viewers nginx never sent on_play_done for. Returns how many.
+# KEYS: SESSION_KEYS
+ORPHANS_SCRIPT = CLOSE_SESSION + """
+local clientids = redis.call('zrangebyscore', KEYS[2], '-inf', '(' .. ARGV[1], 'limit', 0, ARGV[2])
+for _, clientid in ipairs(clientids) do
+	close_session(KEYS, clientid, nil, true)
+end
+return #clientids
+"""
+
+# Counts one on_update heartbeat, the stream's performer if it's from the
+# publisher on_publish saw, otherwise an interval watched in the room if
+# it's from a viewer with a session open in it.
+# KEYS: Publisher_<clientid>, HEARTBEAT_PERFORMERS, HEARTBEAT_VIEWERS,
+#       VIEWERS_SEEN, VIEWERS_OPEN
+# ARGV: stream name, unix time, update interval, Publisher_* ttl, clientid
+UPDATE_SCRIPT = """
+local publisher = redis.call('get', KEYS[1])
+if publisher then
+	publisher = cjson.decode(publisher)
+	-- nginx reuses client ids after a restart
+	if publisher['room'] == ARGV[1] or publisher['key'] == ARGV[1] then
+		redis.call('expire', KEYS[1], ARGV[4])
+		if publisher['performer'] ~= cjson.null then
+			redis.call('zadd', KEYS[2], ARGV[2], publisher['performer'])
+		end
+		return 1
+	end
+end
+local session = redis.call('hget', KEYS[5], ARGV[5])
+if not session or cjson.decode(session)['room'] ~= ARGV[1] then
+	return -1
+end
+redis.call('hincrby', KEYS[3], ARGV[1], ARGV[3])
+redis.call('zadd', KEYS[4], ARGV[2], ARGV[5])
+return 0
 """
 
 class NginxHooks(object):
+
 	@classmethod
-	def on_publish(cls, request):
+	def on_publish(cls, params):
 		"""
+		The stream name is the room's stream key. It's published as the
+		room's token, by redirecting, so viewers never see the key.
+		Answered by `NginxHooksApplication`, returns (status, location).
+
 		call=publish
 		addr - client IP address
 		clientid - nginx client id (displayed in log and stat)
@@ -35,11 +206,34 @@ class NginxHooks(object):
 		pageUrl - client page url
 		name - stream name
 		"""
-		return HttpResponse(status=403)
+		key = params.get('name', '')
+		clientid = params.get('clientid', '')
+		if not TOKEN_RE.match(key) or not clientid.isdigit():
+			return 403, None
+		con = get_redis_connection('default')
+		stream = con.get('Stream_%s' % (key,))
+		if stream is None:
+			return 403, None
+		stream = json.loads(stream)
+		# So on_update can tell the publisher from the viewers, kept
+		# alive by its heartbeats
+		publisher_key = 'Publisher_%s' % (clientid,)
+		publisher = dict(stream, key=key)
+		ttl = settings.NXRTMP_UPDATE_INTERVAL * 3
+		if stream['performer'] is None:
+			con.set(publisher_key, json.dumps(publisher), ex=ttl)
+		else:
+			listing.publish(con, publisher_key, publisher, ttl, HEARTBEAT_PERFORMERS)
+		return 302, stream['room']
 
 	@classmethod
-	def on_play(cls, request):
+	def on_play(cls, params):
 		"""
+		The stream name is the room's token. Viewers add the `RAXS.*` key
+		from `Room.allow_access` to the play URL as `access`, or leave it
+		out to watch anonymously. Opens the viewer's session in Redis.
+		Answered by `NginxHooksApplication`, returns (status, location).
+
 		call=play
 		addr - client IP address
 		clientid - nginx client id (displayed in log and stat)
@@ -49,12 +243,31 @@ class NginxHooks(object):
 		tcUrl - tcUrl
 		pageUrl - client page url
 		name - stream name
+		access - RAXS.<token>.* key, optional
 		"""
-		return HttpResponse(status=403)
+		room = params.get('name', '')
+		access = params.get('access')
+		clientid = params.get('clientid', '')
+		if not TOKEN_RE.match(room) or not clientid.isdigit():
+			return 403, None
+		keys = ['Room_%s' % (room,), 'Room_%s_Members' % (room,)] + SESSION_KEYS
+		if access:
+			prefix = 'RAXS.%s.' % (room,)
+			if not access.startswith(prefix) or not TOKEN_RE.match(access[len(prefix):]):
+				return 403, None
+			keys.append(access)
+		level = run_script(get_redis_connection('default'), PLAY_SCRIPT, keys,
+						   [room, clientid, int(time.time()), PLAY_LEVELS])
+		if level is None:
+			return 403, None
+		return 200, None
 
 	@classmethod
-	def on_play_done(cls, request):
+	def on_play_done(cls, params):
 		"""
+		Closes the viewer's session in Redis. Answered by
+		`NginxHooksApplication`, returns (status, location).
+
 		HTTP return code not checked!
 		call=play_done
 		addr - client IP address
@@ -66,11 +279,19 @@ class NginxHooks(object):
 		pageUrl - client page url
 		name - stream name
 		"""
-		return HttpResponse(status=403)
+		clientid = params.get('clientid', '')
+		if not clientid.isdigit():
+			return 403, None
+		run_script(get_redis_connection('default'), PLAY_DONE_SCRIPT,
+				   SESSION_KEYS, [clientid, int(time.time())])
+		return 200, None
 
 	@classmethod
-	def on_publish_done(cls, request):
+	def on_publish_done(cls, params):
 		"""
+		Takes the performer out of the listing. Answered by
+		`NginxHooksApplication`, returns (status, location).
+
 		HTTP return code not checked!
 		call=publish_done
 		addr - client IP address
@@ -82,7 +303,12 @@ class NginxHooks(object):
 		pageUrl - client page url
 		name - stream name
 		"""
-		return HttpResponse(status=403)
+		clientid = params.get('clientid', '')
+		if not clientid.isdigit():
+			return 403, None
+		listing.unpublish(get_redis_connection('default'), 'Publisher_%s' % (clientid,), HEARTBEAT_PERFORMERS,
+						  params.get('name', ''))
+		return 200, None
 
 	@classmethod
 	def on_record_done(cls, request):
@@ -101,8 +327,12 @@ class NginxHooks(object):
 		return HttpResponse(status=403)
 
 	@classmethod
-	def on_update(cls, request):
+	def on_update(cls, params):
 		"""
+		Counts a heartbeat in Redis for `flushheartbeats`, nothing else, it's
+		called for every viewer. Answered by `NginxHooksApplication`,
+		returns (status, location).
+
 		If a request returns HTTP result other than 2xx connection is terminated.
 		call=update
 		addr - client IP address
@@ -116,17 +346,77 @@ class NginxHooks(object):
 		time - is the number of seconds since play/publish call
 		timestamp - is RTMP timestamp of the last audio/video packet sent to the client
 		"""
-		return HttpResponse(status=403)
+		name = params.get('name', '')
+		clientid = params.get('clientid', '')
+		if not TOKEN_RE.match(name) or not clientid.isdigit():
+			return 403, None
+		interval = settings.NXRTMP_UPDATE_INTERVAL
+		run_script(get_redis_connection('default'), UPDATE_SCRIPT,
+				   ['Publisher_%s' % (clientid,), HEARTBEAT_PERFORMERS, HEARTBEAT_VIEWERS, VIEWERS_SEEN, VIEWERS_OPEN],
+				   [name, int(time.time()), interval, interval * 3, clientid])
+		return 200, None
+
+
+
+
+
+class NginxHooksApplication(object):
+	"""
+	WSGI application answering the hooks in `FAST_HOOKS` itself, and
+	handing every other request to the Django application it wraps.
+	nginx-rtmp sends the hook's arguments in the query string with
+	`notify_method get`, otherwise as a form.
+
+	The hooks are only for nginx-rtmp, through nginx on the same box, so
+	anything else calling them gets a 403.
+	"""
+	PREFIX = '/backend/hooks/nxrtmp/'
+	FAST_HOOKS = {
+		'on_publish': NginxHooks.on_publish,
+		'on_play': NginxHooks.on_play,
+		'on_update': NginxHooks.on_update,
+		'on_play_done': NginxHooks.on_play_done,
+		'on_publish_done': NginxHooks.on_publish_done,
+	}
+	STATUS = {200: '200 OK', 302: '302 Found', 403: '403 Forbidden'}
+	LOOPBACK = '127.0.0.1'
+
+	def __init__(self, application):
+		self.application = application
+
+	def __call__(self, environ, start_response):
+		path = environ.get('PATH_INFO', '')
+		if path.startswith(self.PREFIX):
+			if not self._is_local(environ):
+				return self._answer(start_response, 403)
+			hook = self.FAST_HOOKS.get(path[len(self.PREFIX):])
+			if hook is not None:
+				return self._answer(start_response, *hook(self._params(environ)))
+		return self.application(environ, start_response)
+
+	def _is_local(self, environ):
+		# nginx sets X-Real-IP to who called it
+		return environ.get('REMOTE_ADDR') == self.LOOPBACK and environ.get('HTTP_X_REAL_IP') == self.LOOPBACK
+
+	def _params(self, environ):
+		query = environ.get('QUERY_STRING', '')
+		if environ.get('REQUEST_METHOD') == 'POST':
+			length = int(environ.get('CONTENT_LENGTH') or 0)
+			query += '&' + environ['wsgi.input'].read(length)
+		# The last of any repeated argument, like Django's QueryDict
+		return dict(urlparse.parse_qsl(query))
+
+	def _answer(self, start_response, status, location=None):
+		headers = [('Content-Type', 'text/plain'), ('Content-Length', '0')]
+		if location is not None:
+			headers.append(('Location', location))
+		start_response(self.STATUS[status], headers)
+		return []
 
 
 
 
 
 urlpatterns = patterns('backend.hooks.nxrtmp',
-	url(r'^on_play$', NginxHooks.on_play, name='nxrtmp.on_play'),
-	url(r'^on_publish$', NginxHooks.on_publish, name='nxrtmp.on_publish'),
-	url(r'^on_update$', NginxHooks.on_update, name='nxrtmp.on_update'),
 	url(r'^on_record_done$', NginxHooks.on_record_done, name='nxrtmp.on_record_done'),
-	url(r'^on_publish_done$', NginxHooks.on_publish_done, name='nxrtmp.on_publish_done'),
-	url(r'^on_play_done$', NginxHooks.on_play_done, name='nxrtmp.on_play_done'),
 )
\ No newline at end of file
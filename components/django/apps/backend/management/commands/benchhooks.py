@@ -0,0 +1,116 @@
+from optparse import make_option
+import httplib, json, time, urllib, urlparse
+from wsgiref.util import setup_testing_defaults
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import get_internal_wsgi_application
+from redis_cache import get_redis_connection
+
+from backend.hooks.nxrtmp import HEARTBEAT_VIEWERS
+from camaste.models import make_token
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=5000,
+            help='Requests for each hook'),
+        make_option('--url', default=None,
+            help='Time a running server over HTTP, e.g. http://localhost, instead of calling the WSGI application'),
+    )
+    help = "Measures the latency of the nginx-rtmp hooks, using a throwaway room in Redis."
+
+    def handle(self, **options):
+        con = get_redis_connection('default')
+        room, stream_key, member = make_token(15), make_token(20), 1000000
+        access = 'RAXS.%s.%s' % (room, make_token(20))
+        keys = ['Room_%s' % (room,), 'Room_%s_Members' % (room,), 'Stream_%s' % (stream_key,), access, 'Publisher_1']
+        pipe = con.pipeline()
+        pipe.set(keys[0], json.dumps({'is_online': True, 'is_private': False, 'allow_anons': True, 'anons_see_chat': True}))
+        pipe.hset(keys[1], member, json.dumps({'token': make_token(15), 'account': {'pk': member, 'username': 'bench', 'access': 'V'}}))
+        pipe.set(keys[2], json.dumps({'room': room, 'performer': None}))
+        pipe.set(access, json.dumps({'room': room, 'account': {'pk': member, 'username': 'bench', 'access': 'V'}}))
+        pipe.execute()
+
+        # The viewer sessions left in Redis are for a room which isn't in the
+        # database, flushheartbeats drops them.
+        # Hook, arguments and the status it should answer with. on_record_done
+        # still goes through Django, it shows what the middleware costs.
+        cases = [
+            ('on_publish', {'name': stream_key, 'clientid': '1'}, 302),
+            ('on_play', {'name': room, 'access': access}, 200),
+            ('on_play', {'name': room}, 200),
+            ('on_update', {'name': room, 'clientid': '1'}, 200),
+            ('on_update', {'name': room, 'clientid': '2'}, 200),
+            ('on_play_done', {'name': room}, 200),
+            ('on_publish_done', {'name': room}, 200),
+            ('on_record_done', {'name': room}, 403),
+        ]
+        try:
+            if options['url']:
+                request = self._http(options['url'])
+            else:
+                request = self._wsgi()
+            self.stdout.write('%-16s %-10s %10s %10s %10s %10s' % ('hook', 'client', 'req/sec', 'p50 ms', 'p99 ms', 'max ms'))
+            for hook, args, expected in cases:
+                query = urllib.urlencode(dict({'clientid': '2'}, call=hook[3:], addr='127.0.0.1', app='src', **args))
+                path = '/backend/hooks/nxrtmp/%s' % (hook,)
+                status = request(path, query)
+                if status != expected:
+                    raise CommandError('%s answered %d, not %d' % (hook, status, expected))
+                latencies = []
+                started = time.time()
+                for _ in xrange(options['requests']):
+                    before = time.time()
+                    request(path, query)
+                    latencies.append(time.time() - before)
+                elapsed = time.time() - started
+                self.stdout.write('%-16s %-10s %10.0f %10.3f %10.3f %10.3f' % (
+                    hook, self._client(hook, args), len(latencies) / elapsed,
+                    percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000))
+        finally:
+            con.delete(*keys)
+            con.hdel(HEARTBEAT_VIEWERS, room)
+
+    def _client(self, hook, args):
+        if 'access' in args:
+            return 'key'
+        if hook == 'on_update':
+            return 'publisher' if args['clientid'] == '1' else 'viewer'
+        return '-'
+
+    def _wsgi(self):
+        """
+        Call the WSGI application, as runserver or a WSGI server would
+        """
+        application = get_internal_wsgi_application()
+        def request(path, query):
+            environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_REAL_IP': '127.0.0.1'}
+            setup_testing_defaults(environ)
+            status = []
+            def start_response(line, headers, exc_info=None):
+                status.append(int(line.split(' ', 1)[0]))
+            response = application(environ, start_response)
+            ''.join(response)
+            if hasattr(response, 'close'):
+                response.close()
+            return status[0]
+        return request
+
+    def _http(self, url):
+        """
+        GET from a running server over a keep-alive connection
+        """
+        url = urlparse.urlparse(url)
+        conn = httplib.HTTPConnection(url.hostname, url.port or 80)
+        def request(path, query):
+            # As nginx would for nginx-rtmp, the hooks only answer it
+            conn.request('GET', url.path.rstrip('/') + path + '?' + query, headers={'X-Real-IP': '127.0.0.1'})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        return request
@@ -0,0 +1,183 @@
+from optparse import make_option
+from datetime import datetime, timedelta
+import json, time, traceback, uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from redis_cache import get_redis_connection
+
+from backend.hooks.nxrtmp import HEARTBEAT_PERFORMERS, HEARTBEAT_VIEWERS, VIEWERS_CLOSED, SESSION_KEYS, ORPHANS_SCRIPT
+from camaste import listing
+from camaste.models import Account, FlushedBatch, Performer, Room, ViewerSession, ViewerTime
+from camaste.scripts import run_script
+
+# Viewer seconds and sessions being written to the database. If that fails
+# they're kept here and written with the next flush. Each batch has an id,
+# in `<key>_Batch`, the database records it with the writes, so they aren't
+# made twice if the flush fails after committing.
+FLUSHING_VIEWERS = HEARTBEAT_VIEWERS + '_Flushing'
+FLUSHING_SESSIONS = VIEWERS_CLOSED + '_Flushing'
+
+# How long the ids of written batches are kept, flushes are retried within
+# minutes
+BATCHES_KEPT = timedelta(days=1)
+
+# Orphaned sessions closed by each call of ORPHANS_SCRIPT, so it doesn't
+# hold Redis up for long
+ORPHANS_BATCH = 1000
+
+# Adds to the existing row for the room and day, or inserts it
+UPSERT_SQL = {
+    'mysql': 'INSERT INTO {table} (room_id, date, seconds) VALUES {rows} '
+             'ON DUPLICATE KEY UPDATE seconds = seconds + VALUES(seconds)',
+    # For dev boxes
+    'sqlite': 'INSERT INTO {table} (room_id, date, seconds) VALUES {rows} '
+              'ON CONFLICT (room_id, date) DO UPDATE SET seconds = seconds + excluded.seconds',
+}
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='int', default=60,
+            help='Seconds between flushes'),
+        make_option('--once', action='store_true', default=False,
+            help='Flush once and exit, e.g. from cron'),
+    )
+    help = ("Writes what the nginx-rtmp hooks counted in Redis to the database: which performers are online, "
+            "how long viewers watched each room, and the viewer sessions. Only run one.")
+
+    def handle(self, **options):
+        if connection.vendor not in UPSERT_SQL:
+            raise CommandError("Can't upsert viewer time with %s" % (connection.vendor,))
+        while True:
+            started = time.time()
+            try:
+                online, offline, rooms, sessions, orphans = self.flush()
+                if int(options['verbosity']) > 0:
+                    self.stdout.write('%d performers online, %d went offline, %d rooms watched, %d viewer sessions (%d orphaned)' % (
+                        online, offline, rooms, sessions, orphans))
+            except Exception:
+                if options['once']:
+                    raise
+                # Redis or the database is down, the heartbeats wait in Redis
+                self.stderr.write('Flush failed, will retry\n%s' % (traceback.format_exc(),))
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.time() - started)))
+
+    def flush(self):
+        con = get_redis_connection('default')
+        now = timezone.now()
+        online, offline = self.flush_performers(con, now)
+        rooms = self.flush_viewers(con, now)
+        orphans = self.close_orphans(con)
+        sessions = self.flush_sessions(con)
+        FlushedBatch.objects.filter(flushed__lt=now - BATCHES_KEPT).delete()
+        return online, offline, rooms, sessions, orphans
+
+    def move_aside(self, con, key, flushing_key):
+        """
+        Move `key` to `flushing_key` as a new batch, unless a batch failed
+        and is still there
+        """
+        if not con.exists(flushing_key) and con.exists(key):
+            pipe = con.pipeline()
+            pipe.renamenx(key, flushing_key)
+            pipe.set(flushing_key + '_Batch', uuid.uuid4().hex)
+            pipe.execute()
+
+    def first_write(self, con, flushing_key):
+        """
+        Record the batch in `flushing_key` as written, in the caller's
+        transaction. False if it already was.
+        """
+        # Moved aside before batches had ids
+        con.set(flushing_key + '_Batch', uuid.uuid4().hex, nx=True)
+        batch = con.get(flushing_key + '_Batch')
+        if FlushedBatch.objects.filter(batch=batch).exists():
+            return False
+        FlushedBatch.objects.create(batch=batch)
+        return True
+
+    def flush_performers(self, con, now):
+        """
+        One UPDATE for the performers still streaming, and one for those
+        who stopped, however many there are
+        """
+        cutoff = time.time() - settings.NXRTMP_OFFLINE_AFTER
+        online = [int(pk) for pk in con.zrangebyscore(HEARTBEAT_PERFORMERS, cutoff, '+inf')]
+        with transaction.atomic():
+            if online:
+                Performer.objects.filter(pk__in=online).update(is_online=True, last_online=now)
+            offline = Performer.objects.filter(is_online=True).exclude(pk__in=online).update(is_online=False)
+        listing.unlist_stale(con, HEARTBEAT_PERFORMERS, '%f' % (cutoff,))
+        return len(online), offline
+
+    def flush_viewers(self, con, now):
+        """
+        Add the seconds watched since the last flush to today's `ViewerTime`
+        rows, in one statement
+        """
+        # Left over from a failed flush, or moved aside now so new heartbeats
+        # go into a fresh hash
+        self.move_aside(con, HEARTBEAT_VIEWERS, FLUSHING_VIEWERS)
+        seconds = con.hgetall(FLUSHING_VIEWERS)
+        if not seconds:
+            return 0
+        rooms = dict(Room.objects.filter(token__in=seconds.keys()).values_list('token', 'pk'))
+        rows = [(rooms[token], now.date(), int(count)) for token, count in seconds.items() if token in rooms]
+        if rows:
+            sql = UPSERT_SQL[connection.vendor].format(
+                table=connection.ops.quote_name(ViewerTime._meta.db_table),
+                rows=', '.join(['(%s, %s, %s)'] * len(rows)))
+            with transaction.atomic():
+                if self.first_write(con, FLUSHING_VIEWERS):
+                    cursor = connection.cursor()
+                    cursor.execute(sql, [value for row in rows for value in row])
+        con.delete(FLUSHING_VIEWERS, FLUSHING_VIEWERS + '_Batch')
+        return len(rows)
+
+    def close_orphans(self, con):
+        """
+        Close the sessions of viewers who stopped sending heartbeats without
+        nginx sending on_play_done, e.g. when it was restarted
+        """
+        cutoff = int(time.time() - settings.NXRTMP_OFFLINE_AFTER)
+        closed = 0
+        while True:
+            count = run_script(con, ORPHANS_SCRIPT, SESSION_KEYS, [cutoff, ORPHANS_BATCH])
+            closed += count
+            if count < ORPHANS_BATCH:
+                return closed
+
+    def flush_sessions(self, con):
+        """
+        Insert the closed viewer sessions, with multi-row INSERTs
+        """
+        self.move_aside(con, VIEWERS_CLOSED, FLUSHING_SESSIONS)
+        sessions = [json.loads(session) for session in con.lrange(FLUSHING_SESSIONS, 0, -1)]
+        if not sessions:
+            return 0
+        rooms = dict(Room.objects.filter(token__in=set(session['room'] for session in sessions)).values_list('token', 'pk'))
+        # Accounts deleted since are left out, like anonymous viewers
+        accounts = set(session.get('account') for session in sessions) - set([None])
+        accounts = set(Account.objects.filter(pk__in=accounts).values_list('pk', flat=True)) if accounts else set()
+        rows = []
+        for session in sessions:
+            if session['room'] not in rooms:
+                continue
+            account = session.get('account')
+            rows.append(ViewerSession(
+                room_id=rooms[session['room']],
+                account_id=account if account in accounts else None,
+                clientid=int(session['clientid']),
+                started=datetime.fromtimestamp(session['started'], timezone.utc),
+                ended=datetime.fromtimestamp(session['ended'], timezone.utc),
+                orphaned=session['orphaned']))
+        with transaction.atomic():
+            if self.first_write(con, FLUSHING_SESSIONS):
+                ViewerSession.objects.bulk_create(rows, batch_size=500)
+        con.delete(FLUSHING_SESSIONS, FLUSHING_SESSIONS + '_Batch')
+        return len(rows)
@@ -1,4 +1,5 @@
 from .auth import *
 from .home import *
 from .performer import *
-from .contact import *
\ No newline at end of file
+from .contact import *
+from .api import *
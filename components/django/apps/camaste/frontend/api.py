@@ -0,0 +1,53 @@
+__all__ = ('PerformerListView',)
+
+import hashlib, json
+
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from django.views.generic import View
+
+from camaste import listing
+
+
+class PerformerListView(View):
+    """
+    The performers streaming to public rooms, as JSON, for the performer
+    grid to poll:
+
+        GET /api/performers?order=viewers|recent&limit=24&after=<cursor>
+
+        {"performers": [{"pk", "name", "room", "viewers", "since"}, ...],
+         "next": cursor for the next page, or null}
+
+    Served from the Redis index in camaste.listing, without the database.
+    Anyone gets the same answer, so it's cached by nginx and browsers for
+    CACHE_SECONDS, and pollers sending the ETag back get a 304.
+    """
+    CACHE_SECONDS = 5
+    DEFAULT_LIMIT = 24
+    MAX_LIMIT = 100
+
+    def get(self, request):
+        order = request.GET.get('order', listing.BY_VIEWERS)
+        after = request.GET.get('after') or None
+        try:
+            limit = int(request.GET.get('limit', self.DEFAULT_LIMIT))
+        except ValueError:
+            limit = 0
+        if order not in (listing.BY_VIEWERS, listing.BY_RECENT) or not 0 < limit <= self.MAX_LIMIT:
+            return HttpResponseBadRequest()
+        if after is not None and listing.parse_cursor(after) is None:
+            return HttpResponseBadRequest()
+
+        performers, cursor = listing.page(listing.PUBLIC, order, after, limit)
+        body = json.dumps({'performers': performers, 'next': cursor}, separators=(',', ':'), sort_keys=True)
+        etag = quote_etag(hashlib.sha1(body).hexdigest())
+
+        matches = request.META.get('HTTP_IF_NONE_MATCH')
+        if matches and ('*' in matches or etag[1:-1] in parse_etags(matches)):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=%d' % (self.CACHE_SECONDS,)
+        return response
@@ -0,0 +1,343 @@
+__all__ = ('ONLINE', 'PUBLIC', 'BY_VIEWERS', 'BY_RECENT', 'performers', 'page', 'parse_cursor', 'count',
+           'sync_performer', 'sync_room', 'publish', 'unpublish', 'unlist_stale')
+
+import json, re, time
+
+from redis_cache import get_redis_connection
+
+from camaste.scripts import run_script
+
+
+"""
+dP        oo            dP   oo
+88                      88
+88        dP .d8888b. d8888P dP 88d888b. .d8888b.
+88        88 Y8ooooo.   88   88 88'  `88 88'  `88
+88        88       88   88   88 88    88 88.  .88
+88888888P dP `88888P'   dP   dP dP    dP `8888P88
+                                              .88
+                                          d8888P
+
+An index in Redis of the performers streaming right now, so the browse
+pages can list them on every hit without asking the database.
+
+It's kept up to date by the nginx-rtmp hooks as performers start and stop
+publishing and viewers come and go, and by `Performer` and `Room` saves.
+The `rebuildlisting` command reconciles it with the database.
+"""
+
+
+ONLINE = 'online'
+PUBLIC = 'public'
+BY_VIEWERS = 'viewers'
+BY_RECENT = 'recent'
+
+# Performer pk -> JSON of the `room` token they're streaming to, `since`
+# when as unix time, whether the room `is_private`, and the `publisher` key
+# of their stream. Performers who aren't approved are here but not listed.
+PERFORMERS_LIVE = 'Performers_Live'
+
+# Approved performers streaming, scored by viewers or by `since`, and the
+# ones whose room isn't private. Keep the order, the scripts rely on it.
+ONLINE_RECENT = 'Performers_Online_Recent'
+ONLINE_VIEWERS = 'Performers_Online_Viewers'
+PUBLIC_RECENT = 'Performers_Public_Recent'
+PUBLIC_VIEWERS = 'Performers_Public_Viewers'
+INDEX_KEYS = [ONLINE_RECENT, ONLINE_VIEWERS, PUBLIC_RECENT, PUBLIC_VIEWERS]
+
+INDEXES = {
+    (ONLINE, BY_RECENT): ONLINE_RECENT,
+    (ONLINE, BY_VIEWERS): ONLINE_VIEWERS,
+    (PUBLIC, BY_RECENT): PUBLIC_RECENT,
+    (PUBLIC, BY_VIEWERS): PUBLIC_VIEWERS,
+}
+
+# Where a `page` ended, its last performer's score and pk
+CURSOR_RE = re.compile(r'^(\d{1,15})_(\d{1,15})$')
+
+def card_key(pk):
+    """
+    JSON of how performer `pk` is listed, their `name` and `is_approved`
+    """
+    return 'Performer_%s' % (pk,)
+
+
+# `index` is a table of the INDEX_KEYS
+LIST_LUA = """
+local function unlist(index, pk)
+	for _, key in ipairs(index) do
+		redis.call('zrem', key, pk)
+	end
+end
+
+-- Lists performer `pk` if they're approved and streaming, or unlists them
+local function list(card_key, live_key, index, pk)
+	local card = redis.call('get', card_key)
+	local live = redis.call('hget', live_key, pk)
+	if not card or not live or cjson.decode(card)['is_approved'] ~= true then
+		unlist(index, pk)
+		return 0
+	end
+	live = cjson.decode(live)
+	local viewers = redis.call('zscore', index[2], pk) or 0
+	redis.call('zadd', index[1], live['since'], pk)
+	redis.call('zadd', index[2], viewers, pk)
+	if live['is_private'] == true then
+		redis.call('zrem', index[3], pk)
+		redis.call('zrem', index[4], pk)
+	else
+		redis.call('zadd', index[3], live['since'], pk)
+		redis.call('zadd', index[4], viewers, pk)
+	end
+	return 1
+end
+"""
+
+# For the nginx-rtmp hooks' scripts, adds `delta` to a listed performer's
+# viewers, given ONLINE_VIEWERS and PUBLIC_VIEWERS
+COUNT_VIEWER_LUA = """
+local function count_viewer(online_viewers, public_viewers, pk, delta)
+	for _, key in ipairs({online_viewers, public_viewers}) do
+		local viewers = redis.call('zscore', key, pk)
+		if viewers then
+			redis.call('zadd', key, math.max(0, tonumber(viewers) + delta), pk)
+		end
+	end
+end
+"""
+
+# KEYS: card, PERFORMERS_LIVE, INDEX_KEYS...
+# ARGV: pk
+RELIST_SCRIPT = LIST_LUA + """
+return list(KEYS[1], KEYS[2], {KEYS[3], KEYS[4], KEYS[5], KEYS[6]}, ARGV[1])
+"""
+
+# A room of performer ARGV[1] was saved, if they're streaming to it, keeps
+# up with it being made private or archived
+# KEYS: card, PERFORMERS_LIVE, INDEX_KEYS...
+# ARGV: pk, room token, is_private, is_archived as 1 or 0
+ROOM_SCRIPT = LIST_LUA + """
+local live = redis.call('hget', KEYS[2], ARGV[1])
+if live then
+	live = cjson.decode(live)
+	if live['room'] == ARGV[2] then
+		if ARGV[4] == '1' then
+			redis.call('hdel', KEYS[2], ARGV[1])
+		else
+			live['is_private'] = ARGV[3] == '1'
+			redis.call('hset', KEYS[2], ARGV[1], cjson.encode(live))
+		end
+	end
+end
+return list(KEYS[1], KEYS[2], {KEYS[3], KEYS[4], KEYS[5], KEYS[6]}, ARGV[1])
+"""
+
+# on_publish let performer ARGV[3] stream to room ARGV[4]. Counts it as
+# their first heartbeat, so they're unlisted by `unlist_stale` even if the
+# stream dies before its first on_update.
+# KEYS: Publisher_<clientid>, Room_<token>, card, PERFORMERS_LIVE, INDEX_KEYS...,
+#       the heartbeats sorted set
+# ARGV: Publisher_* JSON, its ttl, pk, room token, unix time
+PUBLISH_SCRIPT = LIST_LUA + """
+redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[2])
+redis.call('zadd', KEYS[9], ARGV[5], ARGV[3])
+local room = redis.call('get', KEYS[2])
+redis.call('hset', KEYS[4], ARGV[3], cjson.encode({
+	room = ARGV[4], since = tonumber(ARGV[5]), is_private = room and cjson.decode(room)['is_private'] == true,
+	publisher = KEYS[1]}))
+return list(KEYS[3], KEYS[4], {KEYS[5], KEYS[6], KEYS[7], KEYS[8]}, ARGV[3])
+"""
+
+# on_publish_done for stream ARGV[1], forgets the performer's heartbeat
+# too, so `flushheartbeats` doesn't keep them online
+# KEYS: Publisher_<clientid>, PERFORMERS_LIVE, INDEX_KEYS..., the heartbeats
+#       sorted set
+UNPUBLISH_SCRIPT = LIST_LUA + """
+local publisher = redis.call('get', KEYS[1])
+if not publisher then
+	return 0
+end
+publisher = cjson.decode(publisher)
+-- nginx reuses client ids after a restart
+if publisher['room'] ~= ARGV[1] and publisher['key'] ~= ARGV[1] then
+	return 0
+end
+redis.call('del', KEYS[1])
+if publisher['performer'] == cjson.null then
+	return 1
+end
+local pk = tostring(publisher['performer'])
+local live = redis.call('hget', KEYS[2], pk)
+-- Unless they've started streaming again since
+if live and cjson.decode(live)['room'] == publisher['room'] then
+	redis.call('hdel', KEYS[2], pk)
+	redis.call('zrem', KEYS[7], pk)
+	unlist({KEYS[3], KEYS[4], KEYS[5], KEYS[6]}, pk)
+end
+return 1
+"""
+
+# Unlists the performers whose last heartbeat was before ARGV[1], and
+# forgets the heartbeat. Returns how many.
+# KEYS: the heartbeats sorted set, PERFORMERS_LIVE, INDEX_KEYS...
+STALE_SCRIPT = LIST_LUA + """
+local pks = redis.call('zrangebyscore', KEYS[1], '-inf', '(' .. ARGV[1])
+for _, pk in ipairs(pks) do
+	redis.call('zrem', KEYS[1], pk)
+	redis.call('hdel', KEYS[2], pk)
+	unlist({KEYS[3], KEYS[4], KEYS[5], KEYS[6]}, pk)
+end
+return #pks
+"""
+
+# Up to ARGV[3] members and scores of an index, highest first, after the
+# member ARGV[2] with score ARGV[1], or from the top when ARGV[2] is ''.
+# Equal scores are in descending order of member, so after the cursor are
+# the rest of its score's members, then the lower scores. Found by rank,
+# most performers have the same number of viewers, 0.
+# KEYS: the index
+PAGE_SCRIPT = """
+local limit = tonumber(ARGV[3])
+local start = 0
+if ARGV[2] ~= '' then
+	local score = redis.call('zscore', KEYS[1], ARGV[2])
+	if score and tonumber(score) == tonumber(ARGV[1]) then
+		start = redis.call('zrevrank', KEYS[1], ARGV[2]) + 1
+	else
+		-- The cursor's performer left or their score changed, binary search
+		-- the ranks of its score for where it was
+		local low = redis.call('zcount', KEYS[1], '(' .. ARGV[1], '+inf')
+		local high = low + redis.call('zcount', KEYS[1], ARGV[1], ARGV[1])
+		while low < high do
+			local middle = math.floor((low + high) / 2)
+			if redis.call('zrevrange', KEYS[1], middle, middle)[1] < ARGV[2] then
+				high = middle
+			else
+				low = middle + 1
+			end
+		end
+		start = low
+	end
+end
+if limit < 1 then
+	return {}
+end
+return redis.call('zrevrange', KEYS[1], start, start + limit - 1, 'withscores')
+"""
+
+
+
+def performers(listing=ONLINE, order=BY_VIEWERS, offset=0, limit=24):
+    """
+    A page of the `ONLINE` or `PUBLIC` performers, the most viewers or most
+    recently online first. Dicts of their `pk`, `name`, the `room` token,
+    `viewers` and `since` as unix time.
+    """
+    con = get_redis_connection('default')
+    pks = con.zrevrange(INDEXES[listing, order], offset, offset + limit - 1)
+    return _entries(con, listing, pks)
+
+
+def parse_cursor(cursor):
+    """
+    The (score, pk) in a cursor from `page`, or None if it isn't one
+    """
+    match = CURSOR_RE.match(cursor or '')
+    return match and (match.group(1), match.group(2))
+
+
+def page(listing=ONLINE, order=BY_VIEWERS, after=None, limit=24):
+    """
+    Like `performers`, but paged by the cursor of the page before, rather
+    than an offset, so performers coming and going don't shift the pages.
+    Returns the performers and the cursor for the next page, or None.
+    """
+    con = get_redis_connection('default')
+    score, pk = parse_cursor(after) if after else ('', '')
+    # One more, to tell if there's a next page
+    flat = run_script(con, PAGE_SCRIPT, [INDEXES[listing, order]], [score, pk, limit + 1])
+    pks, scores = flat[0::2], flat[1::2]
+    cursor = None
+    if len(pks) > limit:
+        cursor = '%d_%s' % (int(float(scores[limit - 1])), pks[limit - 1])
+    return _entries(con, listing, pks[:limit]), cursor
+
+
+def _entries(con, listing, pks):
+    """
+    Dicts of the listed performers `pks`
+    """
+    if not pks:
+        return []
+    pipe = con.pipeline(transaction=False)
+    pipe.mget([card_key(pk) for pk in pks])
+    pipe.hmget(PERFORMERS_LIVE, pks)
+    viewers_key = INDEXES[listing, BY_VIEWERS]
+    for pk in pks:
+        pipe.zscore(viewers_key, pk)
+    results = pipe.execute()
+    entries = []
+    for pk, card, live, viewers in zip(pks, results[0], results[1], results[2:]):
+        # Went offline after the first round trip
+        if card is None or live is None or viewers is None:
+            continue
+        card, live = json.loads(card), json.loads(live)
+        entries.append({
+            'pk': int(pk),
+            'name': card['name'],
+            'room': live['room'],
+            'viewers': int(viewers),
+            'since': live['since'],
+        })
+    return entries
+
+
+def count(listing=ONLINE):
+    """
+    How many performers are listed
+    """
+    return get_redis_connection('default').zcard(INDEXES[listing, BY_RECENT])
+
+
+def sync_performer(pk, name, is_approved):
+    """
+    A performer was saved
+    """
+    con = get_redis_connection('default')
+    con.set(card_key(pk), json.dumps({'name': name, 'is_approved': is_approved}))
+    run_script(con, RELIST_SCRIPT, [card_key(pk), PERFORMERS_LIVE] + INDEX_KEYS, [pk])
+
+
+def sync_room(performer_pk, token, is_private, is_archived):
+    """
+    A room was saved
+    """
+    run_script(get_redis_connection('default'), ROOM_SCRIPT, [card_key(performer_pk), PERFORMERS_LIVE] + INDEX_KEYS,
+               [performer_pk, token, int(is_private), int(is_archived)])
+
+
+def publish(con, publisher_key, publisher, ttl, heartbeats_key):
+    """
+    For on_publish, save the `publisher` record (the `Stream_*` record and
+    its `key`) and list its performer, with a heartbeat in `heartbeats_key`
+    """
+    pk, room = publisher['performer'], publisher['room']
+    run_script(con, PUBLISH_SCRIPT,
+               [publisher_key, 'Room_%s' % (room,), card_key(pk), PERFORMERS_LIVE] + INDEX_KEYS + [heartbeats_key],
+               [json.dumps(publisher), ttl, pk, room, int(time.time())])
+
+
+def unpublish(con, publisher_key, heartbeats_key, name):
+    """
+    For on_publish_done, unlist the performer publishing stream `name` and
+    forget their heartbeat in `heartbeats_key`
+    """
+    run_script(con, UNPUBLISH_SCRIPT, [publisher_key, PERFORMERS_LIVE] + INDEX_KEYS + [heartbeats_key], [name])
+
+
+def unlist_stale(con, heartbeats_key, cutoff):
+    """
+    Performers whose streams died without an on_publish_done, they have no
+    heartbeats in `heartbeats_key` since `cutoff`
+    """
+    return run_script(con, STALE_SCRIPT, [heartbeats_key, PERFORMERS_LIVE] + INDEX_KEYS, [cutoff])
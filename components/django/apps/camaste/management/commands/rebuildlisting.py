@@ -0,0 +1,99 @@
+import calendar, collections, datetime, json, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from redis_cache import get_redis_connection
+
+from backend.hooks.nxrtmp import HEARTBEAT_PERFORMERS, VIEWERS_OPEN
+from camaste import listing
+from camaste.models import Performer, Room
+
+# Performers whose cards are written to Redis with each pipeline
+CHUNK = 1000
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the index of performers streaming in Redis (camaste.listing), against the database: "
+            "who's approved, which rooms are private, and performers the database thinks are online.")
+
+    def handle(self, **options):
+        con = get_redis_connection('default')
+
+        # Every performer's card, approved or not, so publishing finds it
+        approved = set()
+        pipe = con.pipeline(transaction=False)
+        for i, (pk, name, is_approved) in enumerate(Performer.objects.values_list('pk', 'name', 'is_approved').iterator()):
+            pipe.set(listing.card_key(pk), json.dumps({'name': name, 'is_approved': is_approved}))
+            if is_approved:
+                approved.add(pk)
+            if i % CHUNK == CHUNK - 1:
+                pipe.execute()
+        pipe.execute()
+
+        # Streaming, according to the nginx-rtmp hooks: their stream's
+        # Publisher_* record is still there and it's sent a heartbeat lately
+        cutoff = time.time() - settings.NXRTMP_OFFLINE_AFTER
+        live = dict((int(pk), json.loads(entry)) for pk, entry in con.hgetall(listing.PERFORMERS_LIVE).items())
+        live = dict((pk, entry) for pk, entry in live.items() if 'publisher' in entry)
+        pipe = con.pipeline(transaction=False)
+        for pk, entry in live.items():
+            pipe.exists(entry['publisher'])
+            pipe.zscore(HEARTBEAT_PERFORMERS, pk)
+        results = pipe.execute()
+        for (pk, entry), publisher, heartbeat in zip(live.items(), results[0::2], results[1::2]):
+            if not publisher or heartbeat is None or heartbeat < cutoff:
+                del live[pk]
+
+        # Or to the heartbeats flushed to the database lately, for the
+        # performers missing from Redis. They're given a heartbeat, so
+        # `flushheartbeats` unlists them if their stream is gone.
+        recent = timezone.now() - datetime.timedelta(seconds=settings.NXRTMP_OFFLINE_AFTER)
+        missing = dict((pk, last_online) for pk, last_online in Performer.objects.online()
+                       .filter(last_online__gte=recent).values_list('pk', 'last_online') if pk not in live)
+        # Their newest room
+        for pk, token in Room.objects.filter(performer__in=missing.keys(), is_archived=False).order_by('created') \
+                                     .values_list('performer', 'token'):
+            live[pk] = {'room': token, 'since': calendar.timegm(missing[pk].utctimetuple())}
+        rooms = dict(Room.objects.filter(token__in=[entry['room'] for entry in live.values()], is_archived=False)
+                                 .values_list('token', 'is_private'))
+        for pk, entry in live.items():
+            if entry['room'] not in rooms:
+                del live[pk]
+            else:
+                entry['is_private'] = rooms[entry['room']]
+
+        viewers = collections.Counter()
+        for session in con.hvals(VIEWERS_OPEN):
+            performer = json.loads(session).get('performer')
+            if performer is not None:
+                viewers[performer] += 1
+
+        # Built aside and renamed over the old index in one transaction. The
+        # hooks' changes while this ran are lost, they're caught up with as
+        # performers and viewers come and go.
+        pipe = con.pipeline()
+        new_keys = dict((key, key + '_Rebuild') for key in [listing.PERFORMERS_LIVE] + listing.INDEX_KEYS)
+        written = collections.Counter()
+        pipe.delete(*new_keys.values())
+        for pk, entry in live.items():
+            pipe.execute_command('HSET', new_keys[listing.PERFORMERS_LIVE], pk, json.dumps(entry))
+            if pk in missing:
+                pipe.execute_command('ZADD', HEARTBEAT_PERFORMERS, 'NX', entry['since'], pk)
+            written[listing.PERFORMERS_LIVE] += 1
+            if pk not in approved:
+                continue
+            scores = [(listing.ONLINE_RECENT, entry['since']), (listing.ONLINE_VIEWERS, viewers[pk])]
+            if not entry['is_private']:
+                scores += [(listing.PUBLIC_RECENT, entry['since']), (listing.PUBLIC_VIEWERS, viewers[pk])]
+            for key, score in scores:
+                pipe.execute_command('ZADD', new_keys[key], score, pk)
+                written[key] += 1
+        for key, new_key in new_keys.items():
+            if written[key]:
+                pipe.rename(new_key, key)
+            else:
+                pipe.delete(key)
+        pipe.execute()
+        self.stdout.write('%d performers streaming, %d listed, %d public' % (
+            len(live), written[listing.ONLINE_RECENT], written[listing.PUBLIC_RECENT]))
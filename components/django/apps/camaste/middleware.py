@@ -16,7 +16,8 @@ class MinifyHTMLMiddleware(object):
     Strip comments, newlines and excess space from the output HTML.
     """
     def process_response(self, request, response):
-        if 'text/html' in response['Content-Type'] and settings.COMPRESS_HTML:
+        # 304s have no Content-Type
+        if 'text/html' in response.get('Content-Type', '') and settings.COMPRESS_HTML:
             response.content = strip_spaces_between_tags(response.content.strip())
             response.content = RE_MULTISPACE.sub(" ", response.content)
             response.content = RE_REMOVE.sub("", response.content)
@@ -1,4 +1,4 @@
-__all__ = ('Account', 'Performer', 'Room')
+__all__ = ('Account', 'Performer', 'Room', 'ViewerTime', 'ViewerSession', 'FlushedBatch')
 
 from django.conf import settings
 from django.db import models
@@ -13,6 +13,11 @@ from os import urandom
 import re, json
 
 from camaste.validators import *
+from camaste import listing
+
+# The Realtime server caches room and member records, it's told to drop
+# them by a message on this channel whenever they change
+REALTIME_ACCESS_CHANNEL = 'realtime.access'
 
 def make_token(how_long):
     return re.sub(r'[^A-Za-z]', '', b64encode(urandom(how_long*2))).upper()[0:how_long]
@@ -143,7 +148,8 @@ class PerformerManager (models.Manager):
     def online(self):
         return self.get_queryset().filter(is_online=True, is_approved=True)
     def public(self):
-        return self.get_queryset().filter(is_private=False, is_online=True, is_approved=True)
+        # Streaming to a room anyone can join
+        return self.online().filter(rooms__is_private=False, rooms__is_archived=False).distinct()
 
 
 class Performer (models.Model):
@@ -186,10 +192,12 @@ class Performer (models.Model):
 @receiver(post_save, sender=Performer)
 def Performer__post_save(sender, instance, created, **kwargs):
     """
-    When a performer is created ensure that their account is marked as 'is_model'
+    When a performer is created ensure that their account is marked as 'is_model',
+    and keep how they're listed up to date, see camaste.listing
     """
     if created:
         Account.objects.filter(pk=instance.account.pk).update(is_model=True)        
+    listing.sync_performer(instance.pk, instance.name, instance.is_approved)
 
 
 
@@ -210,9 +218,11 @@ class Room (models.Model):
     is_private = Is membership restricted to specific Accounts?
     allow_anons = Allow anonymous users?
     anons_see_chat = Allow anonymous users to see chat?    
+    stream_key = Secret the performer publishes the room's stream with
     """
     token = models.CharField(max_length=15, blank=False, null=False, unique=True)
     performer = models.ForeignKey(Performer, related_name="rooms")    
+    stream_key = models.CharField(max_length=20, blank=False, null=False, unique=True)
 
     created = models.DateTimeField(null=False, blank=False, auto_now_add=True)
 
@@ -225,14 +235,24 @@ class Room (models.Model):
     def save(self, *args, **kwargs):
         if self.token is None:            
             self.token = make_token(15)
+        if not self.stream_key:
+            self.stream_key = make_token(20)
         super(Room, self).save(*args, **kwargs)
 
+    def new_stream_key(self):
+        """
+        Replace a stream key which got out, the old one stops working
+        """
+        get_redis_connection('default').delete("Stream_%s" % (self.stream_key,))
+        self.stream_key = make_token(20)
+        self.save()
+
     def allow_access(self, account, access='G'):
         """
         Setup a room access token for the Realtime server to pickup
         """
         assert isinstance(account, Account)
-        key = "RAXS.%s." % (self.token, make_token(20))
+        key = "RAXS.%s.%s" % (self.token, make_token(20))
         con = get_redis_connection('default')
         pipe = con.pipeline()
         pipe.set(key, json.dumps({
@@ -250,20 +270,72 @@ class Room (models.Model):
 @receiver(post_save, sender=Room)
 def Room__post_save(sender, instance, created, **kwargs):
     room_key = "Room_%s" % (instance.token)
+    # Read by the nginx-rtmp on_publish hook, see backend.hooks.nxrtmp
+    stream_key = "Stream_%s" % (instance.stream_key,)
 
     con = get_redis_connection('default')
     pipe = con.pipeline()
-    if room.is_archived:
+    if instance.is_archived:
         pipe.delete(room_key)
+        pipe.delete(stream_key)
     else:
         room_data = {
-            'is_online': instance.online,
+            'performer': instance.performer_id,
+            'is_online': instance.is_online,
             'is_private': instance.is_private,
             'allow_anons': instance.allow_anons,
             'anons_see_chat': instance.anons_see_chat
         }
         pipe.set(room_key, json.dumps(room_data))
+        pipe.set(stream_key, json.dumps({
+                'room': instance.token,
+                'performer': instance.performer_id
+            }))
+    pipe.publish(REALTIME_ACCESS_CHANNEL, json.dumps({'room': instance.token}))
     pipe.execute()
+    listing.sync_room(instance.performer_id, instance.token, instance.is_private, instance.is_archived)
+
+class ViewerTime (models.Model):
+    """
+    Time viewers spent watching a room's stream each day, counted from the
+    nginx-rtmp on_update heartbeats by the `flushheartbeats` command.
+    """
+    room = models.ForeignKey(Room, related_name="viewer_time")
+    date = models.DateField()
+    seconds = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('room', 'date'),)
+
+    @property
+    def minutes(self):
+        return self.seconds // 60
+
+class ViewerSession (models.Model):
+    """
+    A viewer watching a room's stream, from nginx-rtmp's on_play until
+    on_play_done. Kept in Redis while it's open, written in batches by the
+    `flushheartbeats` command.
+
+    account = None for anonymous viewers
+    clientid = nginx-rtmp's id for the connection
+    orphaned = nginx never sent on_play_done, it ended at the last heartbeat
+    """
+    room = models.ForeignKey(Room, related_name="viewer_sessions")
+    account = models.ForeignKey(Account, related_name="viewer_sessions", null=True, blank=True)
+    clientid = models.BigIntegerField()
+    started = models.DateTimeField(db_index=True)
+    ended = models.DateTimeField()
+    orphaned = models.BooleanField(default=False)
+
+class FlushedBatch (models.Model):
+    """
+    A batch of viewer time or sessions the `flushheartbeats` command wrote,
+    recorded in the same transaction, so a flush retried after it committed
+    but before it cleared the batch from Redis doesn't write it twice.
+    """
+    batch = models.CharField(max_length=32, unique=True)
+    flushed = models.DateTimeField(auto_now_add=True, db_index=True)
 
 class RoomMember (models.Model):
     """
@@ -290,7 +362,7 @@ class RoomMember (models.Model):
     def save(self, *args, **kwargs):
         if self.token is None:            
             self.token = make_token(15)
-        super(Room, self).save(*args, **kwargs)
+        super(RoomMember, self).save(*args, **kwargs)
 
 
 @receiver(post_save, sender=RoomMember)
@@ -302,20 +374,21 @@ def RoomMember__post_save(sender, instance, created, **kwargs):
 
     con = get_redis_connection('default')
     pipe = con.pipeline()
-    if is_banned:
-        # Remove membership
-        pipe.hdel(members_key, instance.token)
-    else:
-        # Update membership
-        member_data = {
-            'token': instance.token,
-            'account': {                
-                'pk': instance.account.pk,
-                'username': instance.account.username,
-                'access': instance.access
-            }
+    # Banned members are kept, as 'B', so the Realtime server can tell
+    # them apart from people who simply aren't members
+    member_data = {
+        'token': instance.token,
+        'account': {                
+            'pk': instance.account.pk,
+            'username': instance.account.username,
+            'access': 'B' if instance.is_banned else instance.access
         }
-        pipe.hset(members_key, instance.account.pk, json.dumps(member_data))
+    }
+    pipe.hset(members_key, instance.account.pk, json.dumps(member_data))
+    pipe.publish(REALTIME_ACCESS_CHANNEL, json.dumps({
+            'room': instance.room.token,
+            'account': instance.account.pk
+        }))
     pipe.execute()
 
 
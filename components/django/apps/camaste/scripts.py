@@ -0,0 +1,14 @@
+__all__ = ('run_script',)
+
+# Source -> redis-py Script, sent as EVALSHA, the source only if Redis
+# doesn't have it yet
+_SCRIPTS = {}
+
+def run_script(con, source, keys, args):
+    """
+    Run a Lua script, registering it the first time
+    """
+    script = _SCRIPTS.get(source)
+    if script is None:
+        script = _SCRIPTS[source] = con.register_script(source)
+    return script(keys=keys, args=args, client=con)
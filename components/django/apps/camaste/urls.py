@@ -18,4 +18,7 @@ urlpatterns = patterns('camaste.views',
     url(r'^broadcast$', frontend.BroadcastView.as_view(), name='broadcast'),
     url(r'^model/home$', frontend.PerformerHomeView.as_view(), name='performer_home'),
     url(r'^model/signup$', frontend.PerformerSignupView.as_view(), name='performer_signup'),
+
+    # JSON for the frontend
+    url(r'^api/performers$', frontend.PerformerListView.as_view(), name='api_performers'),
 )
\ No newline at end of file
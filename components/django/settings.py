@@ -51,6 +51,7 @@ PIPELINE_JS = {
             'js/vendor/jquery-1.11.1.min.js',
             'js/vendor/sockjs-0.3.4.min.js',
             'js/vendor/stapes.min.js',
+            'js/msgpack.js',
             'js/main.js',
             'js/chat.js',
         ),
@@ -82,7 +83,7 @@ USE_L10N                            = False
 PREPEND_WWW                         = False
 ROOT_URLCONF                        = 'urls'
 MESSAGE_STORAGE                     = 'django.contrib.messages.storage.session.SessionStorage'
-#WSGI_APPLICATION                   = 'wsgi.application'
+WSGI_APPLICATION                    = 'wsgi.application'  # Also used by runserver
 COMPRESS_HTML                       = TEMPLATE_DEBUG == False
 
 
@@ -169,6 +170,17 @@ MIDDLEWARE_CLASSES = (
     'camaste.middleware.MinifyHTMLMiddleware',
 )
 
+####################################################################
+#
+# nginx-rtmp
+#
+# on_update is called this often for every stream, it must match
+# notify_update_timeout in nginx.conf (30s is nginx-rtmp's default)
+NXRTMP_UPDATE_INTERVAL              = 30
+# Performers are marked offline after this long without a heartbeat
+NXRTMP_OFFLINE_AFTER                = NXRTMP_UPDATE_INTERVAL * 3
+
+
 ####################################################################
 #
 # Authentication
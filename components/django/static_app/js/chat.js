@@ -12,6 +12,14 @@ var Camaste_Chat = Stapes.subclass({
 	constructor: function (app, $element) {
 		this.app = app;
 		this.$el = $($element);
+		// Session to resume after a reconnect and the last message seen in each room
+		this.session = null;
+		this.seqs = {};
+		// Messages skipped over in each room, which may still turn up as
+		// the server sends performers' messages ahead of everyone else's
+		this.gaps = {};
+		// Messages which arrived in each room while joining it, shown after its history
+		this.joining = {};
 
 		var self = this;
 		app.on('ready', function(){
@@ -19,8 +27,13 @@ var Camaste_Chat = Stapes.subclass({
 			$('.input-text', $element).focus();
 			self.scroll_to_bottom();
 		});
+		app.realtime.on('connect', function(){
+			if( self.session !== null ) {
+				self.resume();
+			}
+		});
 		app.on('chat.msg', function(msg){
-			self.add_line(msg.body.text)
+			self.on_msg(msg.channel, msg.body);
 		});
 
 		$('.input-send', this.$el).on('click', function () {
@@ -36,11 +49,90 @@ var Camaste_Chat = Stapes.subclass({
 	},
 
 	connect: function () {
+		this.join("test");
+	},
+
+	join: function (token) {
+		var self = this;
+		this.joining[token] = [];
 		this.app.realtime.call('chat.join', {
-			"token": "test"
+			"token": token
+		}, function (msg) {
+			var early = self.joining[token] || [];
+			delete self.joining[token];
+			if( !msg.join ) {
+				return;
+			}
+			self.session = msg.session;
+			var history = msg.history || [];
+			if( self.seqs[token] === undefined || self.seqs[token] > msg.seq ) {
+				// New to the room, or it was started over
+				self.seqs[token] = history.length ? history[0].seq - 1 : msg.seq;
+				self.gaps[token] = {};
+			}
+			for( var i = 0; i < history.length; i++ ) {
+				self.on_msg(token, history[i]);
+			}
+			for( var j = 0; j < early.length; j++ ) {
+				self.on_msg(token, early[j]);
+			}
 		});
 	},
 
+	/**
+	 * After reconnecting get back into our rooms and catch up on what was missed
+	 */
+	resume: function () {
+		var self = this;
+		this.app.realtime.call('chat.resume', {
+			"session": this.session,
+			"rooms": this.seqs
+		}, function (msg) {
+			var tokens = Object.keys(self.seqs);
+			self.session = msg.session;
+			for( var i = 0; i < tokens.length; i++ ) {
+				var room = msg.resumed ? msg.rooms[tokens[i]] : null;
+				if( room && room.resumed ) {
+					for( var j = 0; j < room.missed.length; j++ ) {
+						self.on_msg(tokens[i], room.missed[j]);
+					}
+				}
+				else {
+					self.join(tokens[i]);
+				}
+			}
+		});
+	},
+
+	on_msg: function (token, body) {
+		if( this.joining[token] ) {
+			this.joining[token].push(body);
+			return;
+		}
+		var last = this.seqs[token] || 0;
+		var gaps = this.gaps[token] || (this.gaps[token] = {});
+		if( body.seq <= last ) {
+			if( !gaps[body.seq] ) {
+				// Already seen
+				return;
+			}
+			delete gaps[body.seq];
+		}
+		else {
+			// Only the last few are remembered, anything older was dropped
+			for( var seq = Math.max(last + 1, body.seq - 100); seq < body.seq; seq++ ) {
+				gaps[seq] = true;
+			}
+			for( var key in gaps ) {
+				if( key <= body.seq - 100 ) {
+					delete gaps[key];
+				}
+			}
+			this.seqs[token] = body.seq;
+		}
+		this.add_line(body.text);
+	},
+
 	input_submit: function () {
 		var $input = $('input.input-text', this.$el);
 		var val = $input.val().trim();
@@ -30,6 +30,8 @@ a88aaaa8P' .d8888b. .d8888b. 88 d8888P dP 88d8b.d8b. .d8888b.
  *  - The realtime backend can send 'events' which are emitted via Stapes
  *  - It provides a simple 'do' method for RPC with the realtime backend
  *  - It automagically reconnects and handles graceful shutdown
+ *  - It speaks MessagePack over a binary websocket where the browser can,
+ *    falling back to JSON over SockJS
  *  - You don't need to 'connect' - just use it
  *  - It handles timeout and success/error calls
  *
@@ -53,6 +55,11 @@ var Camaste_Realtime = Stapes.subclass({
         this._queued = [];
         this._reconnect_fails = 0;
         this._reconnect_timer = null;
+        // Set by the server when it's draining, how long to wait before reconnecting
+        this._reconnect_delay = null;
+        // Encodes and decodes messages for the current connection
+        this._codec = null;
+        this._use_msgpack = Camaste_MsgPack.supported();
         this._app = app;
 
         var self = this;
@@ -61,9 +68,13 @@ var Camaste_Realtime = Stapes.subclass({
             self._shutting_down = true;
             self.close();
         })
+        app.on('reconnect', function (msg) {
+            self._reconnect_delay = msg.delay;
+        })
     },
 
     _clear_reconnect_timer: function () {
+        var self = this;
         if( self._reconnect_timer != null ) {
             clearTimeout(self._reconnect_timer);
             self._reconnect_timer = null;
@@ -72,12 +83,23 @@ var Camaste_Realtime = Stapes.subclass({
 
     /**
      * Try to reconnect, but back off slowly so we don't hammer the server too hard.
+     * The delay is jittered so everyone dropped at once doesn't come back at once,
+     * a draining server tells us how long to wait instead.
      */
     _reconnect: function () {
+        var self = this;
         self._reconnect_fails += 1;
         if( self._shutting_down == false ) {
-            var i = Math.min(self._reconnect_fails, 20);
-            var timeout = Math.round(Math.log(i)*Math.log(i+1)*1000);                
+            var timeout;
+            if( self._reconnect_delay != null ) {
+                timeout = self._reconnect_delay;
+                self._reconnect_delay = null;
+                self._reconnect_fails = 0;
+            }
+            else {
+                var i = Math.min(self._reconnect_fails, 20);
+                timeout = Math.round((Math.log(i)*Math.log(i+1) + Math.random())*1000);
+            }
             self._reconnect_timer = setTimeout(function(){
                 self._connect();
             }, timeout);       
@@ -85,15 +107,38 @@ var Camaste_Realtime = Stapes.subclass({
     },
 
     /**
-     * Initialise SockJS connection.
+     * A websocket speaking MessagePack in binary frames, it has the same
+     * interface as a SockJS connection.
+     */
+    _open_msgpack: function () {
+        var scheme = window.location.protocol == "https:" ? "wss://" : "ws://";
+        var ws = new WebSocket(scheme + window.location.host + '/realtime/websocket', 'msgpack');
+        ws.binaryType = "arraybuffer";
+        return ws;
+    },
+
+    /**
+     * Initialise SockJS connection, or the MessagePack websocket.
+     * If that can't be opened SockJS is used from then on.
      * During shutdown the connection won't be re-initialised
      */
     _connect: function () {
         if( this._shutting_down == false && this._sjs == null ) {
-            var sjs = new SockJS('//' + window.location.host + '/realtime');
+            var use_msgpack = this._use_msgpack;
+            var sjs;
+            if( use_msgpack ) {
+                sjs = this._open_msgpack();
+                this._codec = {encode: Camaste_MsgPack.encode, decode: Camaste_MsgPack.decode};
+            }
+            else {
+                sjs = new SockJS('//' + window.location.host + '/realtime');
+                this._codec = {encode: JSON.stringify, decode: JSON.parse};
+            }
             var self = this;
+            var opened = false;
             // Setup handlers for SockJS
             sjs.onopen = function () {
+                opened = true;
                 self._is_open = true;
                 self._reconnect_fails = 0;
                 self._tick();
@@ -101,6 +146,10 @@ var Camaste_Realtime = Stapes.subclass({
                 self.emit('connect');
             };
             sjs.onclose = function (info) {
+                if( use_msgpack && !opened ) {
+                    // Blocked by a proxy, or the server can't do MessagePack
+                    self._use_msgpack = false;
+                }
                 self._is_open = false;
                 self._sjs = null;
                 self._reconnect();
@@ -115,7 +164,7 @@ var Camaste_Realtime = Stapes.subclass({
             }
             this._sjs = sjs;
         }
-        return sjs;
+        return this._sjs;
     },
 
     /**
@@ -129,16 +178,39 @@ var Camaste_Realtime = Stapes.subclass({
      * If no "_" key exists or it is 0 or negative the response is considered to be
      * an error. If the "id" isn't found in `this._active` then it's presumed the 
      * server is sending us an event.
+     *
+     * When the server coalesces outgoing messages several of them arrive
+     * together as a JSON array, these are unbatched and handled in order.
      */
     _on_msg: function (raw_msg) {
         if( raw_msg.type != "message" ) {
             return;
         }
         var msg = null;
-        try { msg = JSON.parse(raw_msg.data); }
+        try { msg = this._codec.decode(raw_msg.data); }
         catch( e ) {
-            // JSON parse error?... aint much we can do here
+            // JSON/MessagePack parse error?... aint much we can do here
+        }
+        var msgs = this._unbatch(msg);
+        for (var i=0, tot=msgs.length; i < tot; i++) {
+            this._dispatch(msgs[i]);
         }
+    },
+
+    /**
+     * Returns the list of messages in a (possibly batched) message
+     */
+    _unbatch: function (msg) {
+        if( msg instanceof Array ) {
+            return msg;
+        }
+        return [msg];
+    },
+
+    /**
+     * Dispatch a single message to the RPC call handlers and app events
+     */
+    _dispatch: function (msg) {
         // Message passes some basic validations
         if( msg instanceof Object && 'id' in msg && typeof(msg.id) == "string" )  {
             var rpc = null;
@@ -171,7 +243,7 @@ var Camaste_Realtime = Stapes.subclass({
         while( this._is_open && this._queued.length && this._shutting_down == false && this._sjs != null ) {
             var rpc = this._queued.pop();        
             this._active[ rpc.id ] = rpc;
-            this._sjs.send(JSON.stringify({
+            this._sjs.send(this._codec.encode({
                 "id": rpc.id,
                 "call": rpc.call,
                 "args": rpc.args
@@ -257,6 +329,134 @@ var Camaste_Realtime = Stapes.subclass({
 
 
 
+/*
+dP        oo            dP   oo
+88                      88
+88        dP .d8888b. d8888P dP 88d888b. .d8888b.
+88        88 Y8ooooo.   88   88 88'  `88 88'  `88
+88        88       88   88   88 88    88 88.  .88
+88888888P dP `88888P'   dP   dP dP    dP `8888P88
+                                              .88
+                                          d8888P
+*/
+/**
+ * Polls the performers streaming to public rooms, for the performer grid.
+ *
+ * Usage:
+ *   Camaste.listing.on("change", function (performers) {...});
+ *   Camaste.listing.start("viewers");   // or "recent"
+ *   Camaste.listing.more();             // the next page, appended
+ *
+ * Each performer is {pk, name, room, viewers, since}. The server answers
+ * unchanged pages with a 304, so polling is cheap, and "change" is only
+ * emitted when something did change.
+ */
+var Camaste_Listing = Stapes.subclass({
+    POLL_INTERVAL: 10000,
+    PAGE_SIZE: 24,
+
+    constructor: function (app) {
+        this._app = app;
+        this._timer = null;
+        this._order = "viewers";
+        // How many pages are shown, they're all polled
+        this._pages = 1;
+        // Order and cursor -> the last page fetched, for the 304s, jQuery only
+        // keeps the ETags
+        this._cache = {};
+        this.performers = [];
+        this.next = null;
+    },
+
+    start: function (order) {
+        this._order = order || this._order;
+        this._pages = 1;
+        this.stop();
+        this._poll();
+    },
+
+    stop: function () {
+        if( this._timer != null ) {
+            clearTimeout(this._timer);
+            this._timer = null;
+        }
+    },
+
+    more: function () {
+        if( this.next != null ) {
+            this._pages += 1;
+            this.stop();
+            this._poll();
+        }
+    },
+
+    /**
+     * Fetches the shown pages one after the other, following their cursors
+     */
+    _poll: function () {
+        var self = this;
+        var order = this._order;
+        var performers = [];
+        var changed = false;
+        var fetch = function (after, page) {
+            var data = {"order": order, "limit": self.PAGE_SIZE};
+            if( after != null ) {
+                data.after = after;
+            }
+            $.ajax({
+                url: "/api/performers",
+                data: data,
+                dataType: "json",
+                // Sends If-None-Match with the ETag of the last answer
+                ifModified: true,
+                success: function (result, status) {
+                    var key = order + " " + after;
+                    if( status == "notmodified" ) {
+                        result = self._cache[key];
+                    }
+                    else {
+                        self._cache[key] = result;
+                        changed = true;
+                    }
+                    if( !result ) {
+                        self._schedule();
+                        return;
+                    }
+                    performers = performers.concat(result.performers);
+                    self.next = result.next;
+                    if( result.next != null && page < self._pages ) {
+                        fetch(result.next, page + 1);
+                        return;
+                    }
+                    self.performers = performers;
+                    if( changed ) {
+                        self.emit("change", performers);
+                    }
+                    self._schedule();
+                },
+                error: function () {
+                    self._schedule();
+                }
+            });
+        };
+        fetch(null, 1);
+    },
+
+    _schedule: function () {
+        var self = this;
+        this.stop();
+        this._timer = setTimeout(function () {
+            self._timer = null;
+            self._poll();
+        }, this.POLL_INTERVAL);
+    }
+});
+
+
+
+
+
+
 /*
  .d888888                    
 d8'    88                    
@@ -276,6 +476,7 @@ var Camaste_Core = Stapes.subclass({
         this._sjs = null;
         this._shutting_down = false;
         this.realtime = new Camaste_Realtime(this);
+        this.listing = new Camaste_Listing(this);
         $(function(){ self._on_ready(); });
     },
 
@@ -0,0 +1,305 @@
+"use strict";
+
+
+
+
+/*
+ 8888ba.88ba                    888888ba                    dP       
+ 88  `8b  `8b                   88    `8b                   88       
+ 88   88   88 .d8888b. .d8888b. a88aaaa8P' .d8888b. .d8888b. 88  .dP  
+ 88   88   88 Y8ooooo. 88'  `88 88        88'  `88 88'  `"" 88888"   
+ 88   88   88       88 88.  .88 88        88.  .88 88.  ... 88  `8b. 
+ dP   dP   dP `88888P' `8888P88 dP        `88888P8 `88888P' dP   `YP 
+                            .88                                      
+                        d8888P                                       
+*/
+/**
+ * Just enough MessagePack for talking to the Realtime server over a binary
+ * websocket, see `realtime/codec.py`.
+ *
+ * Usage:
+ *   var bytes = Camaste_MsgPack.encode({"id": "_ABC", "call": "chat.join", "args": {}});
+ *   var obj = Camaste_MsgPack.decode(arraybuffer);
+ *
+ * Strings, numbers, booleans, null, arrays and plain objects are supported.
+ * Integers are sent as integers, other numbers as 64 bit floats. Binary
+ * data decodes to a Uint8Array. Extension types aren't supported.
+ */
+var Camaste_MsgPack = (function () {
+    var float_buf = new DataView(new ArrayBuffer(8));
+
+    function utf8_encode(str, out) {
+        for (var i = 0; i < str.length; i++) {
+            var c = str.charCodeAt(i);
+            // Surrogate pair
+            if( c >= 0xd800 && c < 0xdc00 && i + 1 < str.length ) {
+                var d = str.charCodeAt(i + 1);
+                if( d >= 0xdc00 && d < 0xe000 ) {
+                    c = 0x10000 + ((c - 0xd800) << 10) + (d - 0xdc00);
+                    i++;
+                }
+            }
+            if( c < 0x80 ) {
+                out.push(c);
+            }
+            else if( c < 0x800 ) {
+                out.push(0xc0 | (c >> 6), 0x80 | (c & 0x3f));
+            }
+            else if( c < 0x10000 ) {
+                out.push(0xe0 | (c >> 12), 0x80 | ((c >> 6) & 0x3f), 0x80 | (c & 0x3f));
+            }
+            else {
+                out.push(0xf0 | (c >> 18), 0x80 | ((c >> 12) & 0x3f), 0x80 | ((c >> 6) & 0x3f), 0x80 | (c & 0x3f));
+            }
+        }
+    }
+
+    function utf8_decode(bytes, start, end) {
+        var chars = [];
+        var i = start;
+        while( i < end ) {
+            var c = bytes[i++];
+            if( c >= 0xf0 ) {
+                c = ((c & 0x07) << 18) | ((bytes[i++] & 0x3f) << 12) | ((bytes[i++] & 0x3f) << 6) | (bytes[i++] & 0x3f);
+            }
+            else if( c >= 0xe0 ) {
+                c = ((c & 0x0f) << 12) | ((bytes[i++] & 0x3f) << 6) | (bytes[i++] & 0x3f);
+            }
+            else if( c >= 0xc0 ) {
+                c = ((c & 0x1f) << 6) | (bytes[i++] & 0x3f);
+            }
+            if( c >= 0x10000 ) {
+                c -= 0x10000;
+                chars.push(String.fromCharCode(0xd800 + (c >> 10), 0xdc00 + (c & 0x3ff)));
+            }
+            else {
+                chars.push(String.fromCharCode(c));
+            }
+        }
+        return chars.join("");
+    }
+
+    // A big-endian unsigned number of `size` bytes
+    function push_uint(out, value, size) {
+        for (var shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+            out.push(Math.floor(value / Math.pow(2, shift)) & 0xff);
+        }
+    }
+
+    // Type byte followed by a length or number
+    function push_sized(out, type, value, size) {
+        out.push(type);
+        push_uint(out, value, size);
+    }
+
+    function push_header(out, length, fix, fix_max, type16, type32) {
+        if( length <= fix_max ) {
+            out.push(fix | length);
+        }
+        else if( length < 0x10000 ) {
+            push_sized(out, type16, length, 2);
+        }
+        else {
+            push_sized(out, type32, length, 4);
+        }
+    }
+
+    function encode_number(value, out) {
+        if( Math.floor(value) !== value || !isFinite(value) || Math.abs(value) > 9007199254740991 ) {
+            float_buf.setFloat64(0, value);
+            out.push(0xcb);
+            for (var i = 0; i < 8; i++) {
+                out.push(float_buf.getUint8(i));
+            }
+        }
+        else if( value >= 0 ) {
+            if( value < 0x80 ) { out.push(value); }
+            else if( value < 0x100 ) { push_sized(out, 0xcc, value, 1); }
+            else if( value < 0x10000 ) { push_sized(out, 0xcd, value, 2); }
+            else if( value < 0x100000000 ) { push_sized(out, 0xce, value, 4); }
+            else { push_sized(out, 0xcf, value, 8); }
+        }
+        else {
+            if( value >= -32 ) { out.push(value & 0xff); }
+            else if( value >= -0x80 ) { push_sized(out, 0xd0, value + 0x100, 1); }
+            else if( value >= -0x8000 ) { push_sized(out, 0xd1, value + 0x10000, 2); }
+            else if( value >= -0x80000000 ) { push_sized(out, 0xd2, value + 0x100000000, 4); }
+            else {
+                // Two's complement of a 64 bit integer, in two halves
+                var high = Math.floor(value / 0x100000000);
+                var low = value - high * 0x100000000;
+                push_sized(out, 0xd3, high + 0x100000000, 4);
+                push_uint(out, low, 4);
+            }
+        }
+    }
+
+    function encode_value(value, out) {
+        if( value === null || value === undefined ) {
+            out.push(0xc0);
+        }
+        else if( value === false ) {
+            out.push(0xc2);
+        }
+        else if( value === true ) {
+            out.push(0xc3);
+        }
+        else if( typeof(value) == "number" ) {
+            encode_number(value, out);
+        }
+        else if( typeof(value) == "string" ) {
+            var bytes = [];
+            utf8_encode(value, bytes);
+            if( bytes.length < 32 ) { out.push(0xa0 | bytes.length); }
+            else if( bytes.length < 0x100 ) { push_sized(out, 0xd9, bytes.length, 1); }
+            else { push_header(out, bytes.length, 0, -1, 0xda, 0xdb); }
+            for (var i = 0; i < bytes.length; i++) {
+                out.push(bytes[i]);
+            }
+        }
+        else if( value instanceof Uint8Array || value instanceof ArrayBuffer ) {
+            var data = new Uint8Array(value);
+            if( data.length < 0x100 ) { push_sized(out, 0xc4, data.length, 1); }
+            else { push_header(out, data.length, 0, -1, 0xc5, 0xc6); }
+            for (var i = 0; i < data.length; i++) {
+                out.push(data[i]);
+            }
+        }
+        else if( value instanceof Array ) {
+            push_header(out, value.length, 0x90, 15, 0xdc, 0xdd);
+            for (var i = 0; i < value.length; i++) {
+                encode_value(value[i], out);
+            }
+        }
+        else if( typeof(value) == "object" ) {
+            // Like JSON.stringify, undefined values and functions are left out
+            var keys = [];
+            for (var key in value) {
+                if( value.hasOwnProperty(key) && value[key] !== undefined && typeof(value[key]) != "function" ) {
+                    keys.push(key);
+                }
+            }
+            push_header(out, keys.length, 0x80, 15, 0xde, 0xdf);
+            for (var i = 0; i < keys.length; i++) {
+                encode_value(keys[i], out);
+                encode_value(value[keys[i]], out);
+            }
+        }
+        else {
+            throw new Error("MessagePack can't encode " + typeof(value));
+        }
+    }
+
+    function Decoder(buffer) {
+        this.bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        this.view = new DataView(this.bytes.buffer, this.bytes.byteOffset, this.bytes.byteLength);
+        this.pos = 0;
+    }
+
+    Decoder.prototype.uint = function (size) {
+        var value = 0;
+        for (var i = 0; i < size; i++) {
+            value = value * 256 + this.bytes[this.pos++];
+        }
+        return value;
+    };
+
+    Decoder.prototype.int = function (size) {
+        if( size == 8 ) {
+            // Two halves, a single one would lose precision
+            var high = this.int(4);
+            return high * 0x100000000 + this.uint(4);
+        }
+        var value = this.uint(size);
+        var limit = Math.pow(2, size * 8);
+        return value >= limit / 2 ? value - limit : value;
+    };
+
+    Decoder.prototype.str = function (length) {
+        var start = this.pos;
+        this.pos += length;
+        return utf8_decode(this.bytes, start, this.pos);
+    };
+
+    Decoder.prototype.bin = function (length) {
+        var start = this.pos;
+        this.pos += length;
+        return this.bytes.subarray(start, this.pos);
+    };
+
+    Decoder.prototype.array = function (length) {
+        var value = new Array(length);
+        for (var i = 0; i < length; i++) {
+            value[i] = this.value();
+        }
+        return value;
+    };
+
+    Decoder.prototype.map = function (length) {
+        var value = {};
+        for (var i = 0; i < length; i++) {
+            var key = this.value();
+            value[key] = this.value();
+        }
+        return value;
+    };
+
+    Decoder.prototype.value = function () {
+        if( this.pos >= this.bytes.length ) {
+            throw new Error("MessagePack data is truncated");
+        }
+        var type = this.bytes[this.pos++];
+        if( type < 0x80 ) { return type; }
+        if( type < 0x90 ) { return this.map(type & 0x0f); }
+        if( type < 0xa0 ) { return this.array(type & 0x0f); }
+        if( type < 0xc0 ) { return this.str(type & 0x1f); }
+        if( type >= 0xe0 ) { return type - 0x100; }
+        var value;
+        switch( type ) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return this.bin(this.uint(1));
+            case 0xc5: return this.bin(this.uint(2));
+            case 0xc6: return this.bin(this.uint(4));
+            case 0xca: value = this.view.getFloat32(this.pos); this.pos += 4; return value;
+            case 0xcb: value = this.view.getFloat64(this.pos); this.pos += 8; return value;
+            case 0xcc: return this.uint(1);
+            case 0xcd: return this.uint(2);
+            case 0xce: return this.uint(4);
+            case 0xcf: return this.uint(8);
+            case 0xd0: return this.int(1);
+            case 0xd1: return this.int(2);
+            case 0xd2: return this.int(4);
+            case 0xd3: return this.int(8);
+            case 0xd9: return this.str(this.uint(1));
+            case 0xda: return this.str(this.uint(2));
+            case 0xdb: return this.str(this.uint(4));
+            case 0xdc: return this.array(this.uint(2));
+            case 0xdd: return this.array(this.uint(4));
+            case 0xde: return this.map(this.uint(2));
+            case 0xdf: return this.map(this.uint(4));
+        }
+        throw new Error("MessagePack type 0x" + type.toString(16) + " isn't supported");
+    };
+
+    return {
+        /**
+         * Is MessagePack over binary websockets possible in this browser?
+         */
+        supported: function () {
+            return typeof(WebSocket) != "undefined" && typeof(DataView) != "undefined" && typeof(Uint8Array) != "undefined";
+        },
+
+        encode: function (value) {
+            var out = [];
+            encode_value(value, out);
+            return new Uint8Array(out);
+        },
+
+        decode: function (buffer) {
+            var decoder = new Decoder(buffer);
+            return decoder.value();
+        }
+    };
+})();
@@ -1,5 +1,9 @@
-import os
+import os, sys
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "apps"))
 
 from django.core.wsgi import get_wsgi_application
-application = get_wsgi_application()
\ No newline at end of file
+from backend.hooks.nxrtmp import NginxHooksApplication
+
+# The nginx-rtmp on_publish/on_play hooks are answered before Django
+application = NginxHooksApplication(get_wsgi_application())
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the 'Realtime' service, run them from `components/realtime`:
+
+    python -mbench.fanout
+"""
@@ -0,0 +1,66 @@
+"""
+Compares the JSON and MessagePack codecs on typical messages: the CPU time
+to encode what the server sends and decode what it receives, and the bytes
+each puts on the wire.
+
+JSON over SockJS is encoded twice, the message is escaped into a JSON
+string inside the 'a[...]' frame, so its size is shown too.
+"""
+import argparse, sys, timeit
+
+from sockjs.tornado import proto
+
+from realtime import EndUserConnection
+from realtime.codec import JSON, MSGPACK, msgpack
+
+
+def messages(members):
+    """
+    Name -> (message, whether the server sends or receives it)
+    """
+    presence = [{'id': 1000 + i, 'name': 'member%d' % (i,), 'access': 'V'} for i in range(members)]
+    return [
+        ('sendmsg', {'id': '_ABCDEFGHIJ', 'call': 'chat.sendmsg',
+                     'args': {'token': 'a1b2c3d4e5f6g7h', 'text': 'Lorem ipsum dolor sit amet'}}, False),
+        ('chat.msg', EndUserConnection.envelope('chat.msg', {
+            'channel': 'a1b2c3d4e5f6g7h',
+            'body': {'text': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit', 'seq': 123456}}), True),
+        ('join reply', EndUserConnection.envelope('_ABCDEFGHIJ', {
+            'token': 'a1b2c3d4e5f6g7h', 'join': True, 'presence': presence, 'history': [], 'seq': 123456,
+            'session': '0123456789abcdef0123456789abcdef'}), True),
+    ]
+
+
+def measure(codec, obj, sends, number):
+    payload = codec.encode(obj)
+    if sends:
+        seconds = timeit.timeit(lambda: codec.encode(obj), number=number)
+    else:
+        seconds = timeit.timeit(lambda: codec.decode(payload), number=number)
+    return seconds / number * 1e6, len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wire codec benchmark')
+    parser.add_argument('--members', type=int, default=50, metavar='N', help='Members in the join reply presence list')
+    parser.add_argument('--number', type=int, default=20000, metavar='N', help='Times each message is encoded or decoded')
+    args = parser.parse_args()
+
+    if MSGPACK is None:
+        print 'The msgpack package is not installed'
+        return 1
+    if msgpack.Packer.__module__ == 'msgpack.fallback':
+        print 'Warning: msgpack is using its pure Python fallback, not the C extension'
+
+    print '%-12s %6s %10s %10s %12s %10s %12s' % ('message', '', 'json us', 'msgpack us', 'sockjs bytes', 'json bytes', 'msgpack bytes')
+    for name, obj, sends in messages(args.members):
+        json_us, json_bytes = measure(JSON, obj, sends, args.number)
+        msgpack_us, msgpack_bytes = measure(MSGPACK, obj, sends, args.number)
+        sockjs_bytes = len('a[' + proto.json_encode(JSON.encode(obj)) + ']')
+        print '%-12s %6s %10.2f %10.2f %12d %10d %12d' % (name, 'encode' if sends else 'decode',
+                                                          json_us, msgpack_us, sockjs_bytes, json_bytes, msgpack_bytes)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
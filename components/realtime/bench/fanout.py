@@ -0,0 +1,90 @@
+"""
+Measures the cost of delivering one chat message to every end-user in a room,
+comparing encoding the 'chat.msg' response for every subscriber against the
+encode-once `Frame` broadcast path.
+"""
+import argparse, sys, timeit
+
+from tornadoredis.client import reply_pubsub_message
+from sockjs.tornado import proto
+
+from realtime import EndUserConnection
+from realtime.apps import ChatApp
+
+
+class NullSession(object):
+    """
+    Stands in for a SockJS session, it does the same encoding work
+    as a real one but throws the output away.
+    """
+    is_closed = False
+    send_expects_json = True
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, msg, stats=True, binary=False):
+        self.send_jsonified(proto.json_encode(msg), stats)
+
+    def send_jsonified(self, msg, stats=True):
+        self.sent += 1
+
+
+class NullServer(object):
+    conf = {}
+    coalesce_window = 0
+    coalesce_max = 1
+    max_backlog = 0
+    metrics = None
+    recorder = None
+
+    def register(self, cmd, callback, schema=None):
+        pass
+
+    def on_redis_reconnect(self, callback):
+        pass
+
+
+def make_room(size):
+    server = NullServer()
+    return [EndUserConnection(server, NullSession()) for _ in range(size)]
+
+
+def encode_per_subscriber(room, msg):
+    for enduser in room:
+        enduser.reply('chat.msg', {
+            'channel': msg.channel,
+            'body': msg.body
+        })
+
+
+def encode_once(chat, room, msg):
+    for enduser in room:
+        chat.on_msg(enduser, msg)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat fan-out encoding benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 5000], metavar='N', help='Room sizes to measure')
+    parser.add_argument('--messages', type=int, default=200, metavar='N', help='Messages per room size')
+    args = parser.parse_args()
+
+    chat = ChatApp(NullServer())
+    body = {'text': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit'}
+
+    print '%8s %18s %18s %8s' % ('viewers', 'per-sub us/msg', 'once us/msg', 'speedup')
+    for size in args.sizes:
+        room = make_room(size)
+        # A fresh Message for every delivery, as `RedisSubscriber` would
+        msgs = [reply_pubsub_message(('message', 'room', body)) for _ in range(args.messages)]
+        msgs_iter = iter(msgs * 2)
+        old = timeit.timeit(lambda: encode_per_subscriber(room, next(msgs_iter)), number=args.messages)
+        new = timeit.timeit(lambda: encode_once(chat, room, next(msgs_iter)), number=args.messages)
+        old_us = old / args.messages * 1e6
+        new_us = new / args.messages * 1e6
+        print '%8d %18.1f %18.1f %7.1fx' % (size, old_us, new_us, old_us / new_us)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
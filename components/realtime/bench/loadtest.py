@@ -0,0 +1,240 @@
+"""
+Load test for the 'Realtime' server. Opens many SockJS websocket clients
+against a local `RealtimeServer`, spreads them over chat rooms, drives
+'chat.sendmsg' traffic and reports delivery latency, throughput and the
+server's memory use.
+
+By default a throwaway redis-server and realtime server are started on free
+localhost ports, rate limits and access checks are disabled so they don't
+skew the numbers:
+
+    python -mbench.loadtest --clients 2000 --rooms 20 --rate 200
+
+Use --url to test an already running server instead. The clients all run in
+one process, check it isn't the bottleneck before blaming the server.
+"""
+import argparse, json, os, random, resource, shlex, signal, subprocess, sys, time
+
+import tornado.ioloop
+import tornado.websocket
+from tornado import gen
+
+from .redisserver import ThrowawayRedis, free_port
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def room_sizes(clients, rooms, distribution):
+    """
+    How many clients go in each room. 'uniform' spreads them evenly, 'zipf'
+    gives a few very busy rooms and a long tail of small ones, like a real
+    site's performer list.
+    """
+    if distribution == 'uniform':
+        weights = [1.0] * rooms
+    else:
+        weights = [1.0 / (rank + 1) for rank in range(rooms)]
+    total = sum(weights)
+    sizes = [max(1, int(clients * weight / total)) for weight in weights]
+    sizes[0] += clients - sum(sizes)
+    return sizes
+
+
+def rss_kb(pid):
+    """
+    Resident memory of a process and all its children (forked workers), in kB
+    """
+    pids = set([pid])
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % (entry,)) as handle:
+                    if int(handle.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.add(int(entry))
+            except (IOError, IndexError, ValueError):
+                pass
+    total = 0
+    for each in pids:
+        try:
+            with open('/proc/%d/status' % (each,)) as handle:
+                for line in handle:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except IOError:
+            pass
+    return total
+
+
+class Stats(object):
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = []
+        self.errors = 0
+
+
+class Client(object):
+    """
+    A minimal SockJS client using the raw websocket transport
+    """
+    def __init__(self, url, room, stats):
+        self.url = url
+        self.room = room
+        self.stats = stats
+        self.ws = None
+        self._next_id = 0
+
+    @gen.coroutine
+    def connect(self):
+        session = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(16))
+        self.ws = yield tornado.websocket.websocket_connect('%s/%03d/%s/websocket' % (self.url, random.randint(0, 999), session))
+        frame = yield self.ws.read_message()
+        if frame != 'o':
+            raise RuntimeError('Unexpected SockJS open frame %r' % (frame,))
+        self._read()
+
+    def call(self, name, args):
+        self._next_id += 1
+        msg = json.dumps({'id': '_%d' % (self._next_id,), 'call': name, 'args': args})
+        self.ws.write_message(json.dumps([msg]))
+
+    def join(self):
+        self.call('chat.join', {'token': self.room})
+
+    def sendmsg(self):
+        self.stats.sent += 1
+        self.call('chat.sendmsg', {'token': self.room, 'text': repr(time.time())})
+
+    @gen.coroutine
+    def _read(self):
+        while True:
+            frame = yield self.ws.read_message()
+            if frame is None:
+                return
+            if frame[0] != 'a':
+                continue
+            now = time.time()
+            for text in json.loads(frame[1:]):
+                msg = json.loads(text)
+                for msg in msg if isinstance(msg, list) else (msg,):
+                    self._on_msg(msg, now)
+
+    def _on_msg(self, msg, now):
+        if msg.get('id') == 'chat.msg':
+            self.stats.received += 1
+            try:
+                self.stats.latencies.append(now - float(msg['body']['text']))
+            except (KeyError, TypeError, ValueError):
+                self.stats.errors += 1
+        elif msg.get('_') != 1 or msg.get('sent') is False:
+            self.stats.errors += 1
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+
+@gen.coroutine
+def run(args, server_pid):
+    stats = Stats()
+    sizes = room_sizes(args.clients, args.rooms, args.distribution)
+    clients = []
+    for room, size in enumerate(sizes):
+        clients.extend(Client(args.url, 'loadtest.%d' % (room,), stats) for _ in range(size))
+
+    # The server's own footprint, taken out of the per client figure
+    rss_before = rss_kb(server_pid) if server_pid else 0
+    started = time.time()
+    for i in range(0, len(clients), args.connect_batch):
+        batch = clients[i:i + args.connect_batch]
+        yield [client.connect() for client in batch]
+        for client in batch:
+            client.join()
+    print 'Connected %d clients to %d rooms in %.1fs (largest room %d)' % (len(clients), len(sizes), time.time() - started, max(sizes))
+    yield gen.sleep(1)
+    rss_idle = rss_kb(server_pid) if server_pid else 0
+
+    # Senders are picked at random, so busy rooms get more of the traffic
+    senders = random.sample(clients, min(args.senders, len(clients)))
+    expected = 0
+    interval = 1.0 / args.rate
+    started = time.time()
+    deadline = started + args.duration
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        # Catch up on any messages due since the last iteration
+        due = int((now - started) * args.rate) + 1
+        while stats.sent < due:
+            sender = random.choice(senders)
+            sender.sendmsg()
+            expected += sizes[int(sender.room.rsplit('.', 1)[1])]
+        yield gen.sleep(interval)
+    elapsed = time.time() - started
+    yield gen.sleep(2)
+    rss_busy = rss_kb(server_pid) if server_pid else 0
+
+    for client in clients:
+        client.close()
+
+    print 'Sent %d messages in %.1fs, %.0f msgs/sec' % (stats.sent, elapsed, stats.sent / elapsed)
+    print 'Delivered %d of %d expected, %.0f deliveries/sec, %d errors' % (stats.received, expected, stats.received / elapsed, stats.errors)
+    print 'Latency p50 %.1fms, p99 %.1fms, max %.1fms' % (percentile(stats.latencies, 50) * 1000,
+                                                       percentile(stats.latencies, 99) * 1000,
+                                                       max(stats.latencies or [0]) * 1000)
+    if server_pid:
+        print 'Server RSS %.1fMB before, %.1fMB idle, %.1fMB under load, %.1fkB per client' % (
+            rss_before / 1024.0, rss_idle / 1024.0, rss_busy / 1024.0, float(rss_idle - rss_before) / len(clients))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Camaste! Realtime load test')
+    parser.add_argument('--url', metavar='URL', help='SockJS endpoint of a running server, e.g. ws://127.0.0.1:8081/realtime')
+    parser.add_argument('--redis-server', default='redis-server', metavar='PATH', help='redis-server binary')
+    parser.add_argument('--server-args', default='--chat-no-auth --chat-user-rate 0 --chat-room-rate 0', metavar='ARGS', help='Extra arguments for the realtime server')
+    parser.add_argument('--clients', type=int, default=1000, metavar='N', help='Number of simulated end-users')
+    parser.add_argument('--rooms', type=int, default=10, metavar='N', help='Number of chat rooms')
+    parser.add_argument('--distribution', choices=('uniform', 'zipf'), default='zipf', help='How end-users are spread over the rooms')
+    parser.add_argument('--senders', type=int, default=100, metavar='N', help='Number of end-users sending messages')
+    parser.add_argument('--rate', type=float, default=50, metavar='N', help='Total chat messages sent per second')
+    parser.add_argument('--duration', type=float, default=10, metavar='SECS', help='How long to send messages for')
+    parser.add_argument('--connect-batch', type=int, default=100, metavar='N', help='Clients connected at a time')
+    args = parser.parse_args()
+
+    # Every client is a socket, at both ends when the server is local
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    ioloop = tornado.ioloop.IOLoop.instance()
+    if args.url:
+        ioloop.run_sync(lambda: run(args, None))
+        return 0
+
+    with ThrowawayRedis(args.redis_server) as redis:
+        port = free_port()
+        args.url = 'ws://127.0.0.1:%d/realtime' % (port,)
+        server = subprocess.Popen([sys.executable, '-mrealtime',
+                                   '--http-host', '127.0.0.1', '--http-port', str(port),
+                                   '--redis-host', redis.host, '--redis-port', str(redis.port),
+                                   # Stop straight away when it's done
+                                   '--drain-secs', '0']
+                                  + shlex.split(args.server_args),
+                                  preexec_fn=os.setsid)
+        try:
+            time.sleep(1)
+            ioloop.run_sync(lambda: run(args, server.pid))
+        finally:
+            # The server and any workers it forked
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Measures the memory the realtime server's own objects take per end-user:
+bytes per idle connection, and per room subscription, for a range of
+session counts.
+
+Each count is measured in a freshly forked process from its resident set
+size, so this only works on Linux. The SockJS session, the websocket
+handler and the socket buffers cost the same whatever we do, those are
+left out and stood in for by a tiny `NullSession`.
+"""
+import argparse, gc, os, resource, sys
+
+from tornado.httputil import HTTPHeaders
+from sockjs.tornado.session import ConnectionInfo
+
+from realtime import EndUserConnection, RedisSubscriber
+from realtime.apps import ChatApp
+
+
+# What a browser sends with the websocket upgrade, give or take
+HEADERS = [
+    ('Host', 'camaste.example.com'),
+    ('User-Agent', 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.120 Safari/537.36'),
+    ('Accept-Encoding', 'gzip,deflate,sdch'),
+    ('Accept-Language', 'en-GB,en;q=0.8,en-US;q=0.6'),
+    ('Cache-Control', 'no-cache'),
+    ('Connection', 'Upgrade'),
+    ('Cookie', 'csrftoken=Mx0QeS3lCYvRGaHEmjmtd6GKz2Fx1Wa2; sessionid=8oq7unrvxnb3gaykuc6fn9v4abtsm1x0'),
+    ('Origin', 'http://camaste.example.com'),
+    ('Pragma', 'no-cache'),
+    ('Sec-WebSocket-Extensions', 'permessage-deflate; client_max_window_bits'),
+    ('Sec-WebSocket-Key', 'dGhlIHNhbXBsZSBub25jZQ=='),
+    ('Sec-WebSocket-Version', '13'),
+    ('Upgrade', 'websocket'),
+    ('X-Forwarded-For', '203.0.113.195'),
+    ('X-Real-Ip', '203.0.113.195'),
+]
+
+
+class NullSession(object):
+    is_closed = False
+    send_expects_json = True
+    handler = None
+
+    def send_message(self, msg, stats=True, binary=False):
+        pass
+
+    def send_jsonified(self, msg, stats=True):
+        pass
+
+
+class NullSubscriber(RedisSubscriber):
+    """
+    Keeps track of subscriptions without ever talking to Redis
+    """
+    def _schedule_sync(self):
+        pass
+
+
+class NullServer(object):
+    conf = {}
+    coalesce_window = 0
+    coalesce_max = 1
+    max_backlog = 0
+    metrics = None
+    recorder = None
+    draining = False
+
+    def __init__(self):
+        self.endusers = set()
+        self.sub = NullSubscriber(None, None)
+
+    def register(self, cmd, callback, schema=None):
+        pass
+
+    def on_redis_reconnect(self, callback):
+        pass
+
+
+def rss():
+    gc.collect()
+    with open('/proc/self/statm') as handle:
+        return int(handle.read().split()[1]) * resource.getpagesize()
+
+
+def connect(server):
+    """
+    A connection as it is after the websocket handshake
+    """
+    headers = HTTPHeaders()
+    for name, value in HEADERS:
+        headers.add(name, value)
+    cookies = {'sessionid': headers['Cookie'][-32:]}
+    enduser = EndUserConnection(server, NullSession())
+    enduser.on_open(ConnectionInfo('127.0.0.1', cookies, {}, headers, '/realtime/websocket'))
+    return enduser
+
+
+def measure(sessions, rooms_per_user, room_size):
+    """
+    Bytes per idle connection, and per subscription, in a chat app
+    """
+    server = NullServer()
+    chat = ChatApp(server)
+    before = rss()
+    endusers = [connect(server) for _ in range(sessions)]
+    for enduser in endusers:
+        chat.state(enduser)
+    idle = rss()
+    rooms = max(1, sessions * rooms_per_user // room_size)
+    for i, enduser in enumerate(endusers):
+        for j in range(rooms_per_user):
+            # A new string for every end-user, like the decoded 'chat.join' arguments
+            token = u'%015d' % ((i * rooms_per_user + j) % rooms,)
+            enduser.subscribe(token, chat._on_msg)
+    subscribed = rss()
+    return (idle - before) / float(sessions), (subscribed - idle) / float(sessions * rooms_per_user)
+
+
+def measure_forked(sessions, rooms_per_user, room_size):
+    """
+    Run `measure` in a child process, so each count starts from a clean heap
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        result = measure(sessions, rooms_per_user, room_size)
+        os.write(write_fd, '%f %f' % result)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as handle:
+        result = handle.read()
+    os.waitpid(pid, 0)
+    return [float(value) for value in result.split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-connection memory benchmark')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 50000, 100000], metavar='N', help='Session counts to measure')
+    parser.add_argument('--rooms-per-user', type=int, default=2, metavar='N', help='Rooms each end-user joins')
+    parser.add_argument('--room-size', type=int, default=50, metavar='N', help='End-users in each room')
+    args = parser.parse_args()
+
+    print '%10s %16s %16s %14s' % ('sessions', 'bytes/conn', 'bytes/sub', 'total MB')
+    for sessions in args.sessions:
+        per_conn, per_sub = measure_forked(sessions, args.rooms_per_user, args.room_size)
+        total = (per_conn + per_sub * args.rooms_per_user) * sessions / (1024 * 1024)
+        print '%10d %16.0f %16.0f %14.1f' % (sessions, per_conn, per_sub, total)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
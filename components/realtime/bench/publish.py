@@ -0,0 +1,73 @@
+"""
+Measures PUBLISH throughput against a throwaway local redis-server, comparing
+one round trip per message with the queued & pipelined `RedisSubscriber`.
+
+A run ends once Redis has acknowledged every message. On localhost the round
+trip is tiny, so the gap widens considerably against a remote Redis.
+"""
+import argparse, json, os, sys, time
+
+import tornado.ioloop
+from tornado import gen
+import tornadoredis
+
+from realtime import RedisSubscriber
+from .redisserver import ThrowawayRedis
+
+
+CHANNEL = 'bench.publish'
+BODY = {'text': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit'}
+
+
+@gen.coroutine
+def round_trip(redis, messages):
+    """
+    A single client issuing each PUBLISH as its own command, tornadoredis
+    has to wait for each reply before sending the next command. Messages
+    are encoded as `RedisSubscriber.publish` does, node id and all.
+    """
+    client = tornadoredis.Client(redis.host, redis.port)
+    node_id = os.urandom(8).encode('hex')
+    started = time.time()
+    for i in range(messages):
+        yield gen.Task(client.publish, CHANNEL, json.dumps(dict(BODY, _o=node_id)))
+    raise gen.Return(time.time() - started)
+
+
+@gen.coroutine
+def pipelined(redis, messages, burst):
+    """
+    `RedisSubscriber` queues publishes and pipelines them once per IOLoop
+    iteration, `burst` messages are published per iteration.
+    """
+    sub = RedisSubscriber(None, tornadoredis.Client(redis.host, redis.port))
+    started = time.time()
+    for i in range(1, messages + 1):
+        sub.publish(CHANNEL, BODY)
+        if i % burst == 0:
+            yield gen.moment
+    while sub._publishing or sub._publish_queue:
+        yield gen.moment
+    raise gen.Return(time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Redis PUBLISH throughput benchmark')
+    parser.add_argument('--redis-server', default='redis-server', metavar='PATH', help='redis-server binary')
+    parser.add_argument('--messages', type=int, default=20000, metavar='N', help='Messages to publish per run')
+    parser.add_argument('--burst', type=int, nargs='+', default=[1, 10, 100, 1000], metavar='N', help='Messages published per IOLoop iteration')
+    args = parser.parse_args()
+
+    ioloop = tornado.ioloop.IOLoop.instance()
+    with ThrowawayRedis(args.redis_server) as redis:
+        print '%12s %8s %12s' % ('mode', 'burst', 'msgs/sec')
+        elapsed = ioloop.run_sync(lambda: round_trip(redis, args.messages), timeout=300)
+        print '%12s %8s %12.0f' % ('round trip', '-', args.messages / elapsed)
+        for burst in args.burst:
+            elapsed = ioloop.run_sync(lambda: pipelined(redis, args.messages, burst), timeout=300)
+            print '%12s %8d %12.0f' % ('pipelined', burst, args.messages / elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
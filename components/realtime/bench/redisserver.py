@@ -0,0 +1,58 @@
+"""
+Runs a throwaway redis-server on a free localhost port for benchmarks.
+"""
+import os, shutil, socket, subprocess, tempfile, time
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ThrowawayRedis(object):
+    """
+    Starts redis-server with persistence disabled in a temporary directory,
+    which is removed again when it's stopped. Use as a context manager.
+    """
+    def __init__(self, binary='redis-server', port=None):
+        self.binary = binary
+        self.port = port or free_port()
+        self.host = '127.0.0.1'
+        self._proc = None
+        self._dir = None
+
+    def start(self):
+        self._dir = tempfile.mkdtemp(prefix='camaste-bench-redis-')
+        self._proc = subprocess.Popen([self.binary,
+                                       '--port', str(self.port),
+                                       '--bind', self.host,
+                                       '--save', '',
+                                       '--appendonly', 'no',
+                                       '--dir', self._dir],
+                                      stdout=open(os.devnull, 'w'))
+        for _ in range(100):
+            try:
+                socket.create_connection((self.host, self.port), 0.1).close()
+                return self
+            except socket.error:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError('redis-server did not start on port %d' % (self.port,))
+
+    def stop(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,269 @@
+"""
+Replays traffic captured with `--record` against a local `RealtimeServer`
+and reports the latency of each call and the throughput.
+
+Connections are opened, called on and closed at the same moments they
+were in the recording, or `--speed` times faster, 0 for as fast as
+possible. Recordings from several workers are merged by time:
+
+    python -mrealtime --record /tmp/traffic ...
+    python -mbench.replay /tmp/traffic --speed 4
+
+By default a throwaway redis-server and realtime server are started on
+free localhost ports, like `bench.loadtest`, use --url for one that's
+already running.
+
+Pubsub messages are left out unless --pubsub is given. Most of them are
+the recorded calls' own messages coming back from Redis, which the
+replayed calls produce again. With --pubsub they're published straight
+to Redis as well, for recordings from one of several servers where the
+others' traffic matters. Then the server mustn't be sharded.
+"""
+import argparse, heapq, json, os, resource, shlex, signal, subprocess, sys, time
+
+import tornado.ioloop
+import tornado.websocket
+import tornadoredis
+from tornado import gen
+
+from realtime.recorder import read_recording
+
+from .loadtest import percentile
+from .redisserver import ThrowawayRedis, free_port
+
+
+class Stats(object):
+    def __init__(self):
+        self.opened = 0
+        self.failed = 0
+        self.sent = 0
+        self.replies = 0
+        self.errors = 0
+        self.pushed = 0
+        self.published = 0
+        # Call name -> seconds until the reply, for each call
+        self.latencies = {}
+        # How late each record was replayed, in seconds
+        self.lag = []
+
+
+class ReplayClient(object):
+    """
+    A minimal SockJS client on the raw websocket transport, for one
+    recorded connection. Calls made before it's connected are held.
+    """
+    def __init__(self, url, number, stats):
+        self.url = url
+        self.number = number
+        self.stats = stats
+        self.ws = None
+        self.closed = False
+        self._held = []
+        self._next_id = 0
+        # Call id -> (name, when it was sent)
+        self._waiting = {}
+
+    @gen.coroutine
+    def connect(self):
+        try:
+            self.ws = yield tornado.websocket.websocket_connect('%s/000/replay%08d/websocket' % (self.url, self.number))
+            frame = yield self.ws.read_message()
+            if frame != 'o':
+                raise RuntimeError('Unexpected SockJS open frame %r' % (frame,))
+        except Exception:
+            self.stats.failed += 1
+            self.closed = True
+            self._held = None
+            return
+        self.stats.opened += 1
+        self._read()
+        held, self._held = self._held, None
+        for name, args in held:
+            self._send(name, args)
+        if self.closed and not self._waiting:
+            self.ws.close()
+
+    def call(self, name, args):
+        if self._held is not None:
+            self._held.append((name, args))
+        elif not self.closed:
+            self._send(name, args)
+
+    def _send(self, name, args):
+        self._next_id += 1
+        token = '_%d' % (self._next_id,)
+        self._waiting[token] = (name, time.time())
+        self.stats.sent += 1
+        self.ws.write_message(json.dumps([json.dumps({'id': token, 'call': name, 'args': args})]))
+
+    @property
+    def waiting(self):
+        """
+        Calls not answered yet, including those held until it's connected
+        """
+        return len(self._waiting) + len(self._held or ())
+
+    @gen.coroutine
+    def _read(self):
+        while True:
+            frame = yield self.ws.read_message()
+            if frame is None:
+                return
+            if frame[0] != 'a':
+                continue
+            now = time.time()
+            for text in json.loads(frame[1:]):
+                msg = json.loads(text)
+                for msg in msg if isinstance(msg, list) else (msg,):
+                    self._on_msg(msg, now)
+
+    def _on_msg(self, msg, now):
+        waiting = self._waiting.pop(msg.get('id'), None)
+        if waiting is None:
+            self.stats.pushed += 1
+            return
+        name, sent = waiting
+        self.stats.replies += 1
+        self.stats.latencies.setdefault(name, []).append(now - sent)
+        if msg.get('_') != 1:
+            self.stats.errors += 1
+        if self.closed and not self._waiting:
+            self.ws.close()
+
+    def close(self, force=False):
+        """
+        Close once the calls made so far are answered, or now with `force`
+        """
+        self.closed = True
+        if self.ws is not None and self._held is None and (force or not self._waiting):
+            self.ws.close()
+
+
+def records(paths):
+    """
+    The records of all the recordings, merged by time
+    """
+    streams = []
+    for index, path in enumerate(paths):
+        # Connection numbers only have to be unique within a file
+        stream = read_recording(path)
+        stream = ((record[0], index, seq, record) for seq, record in enumerate(stream))
+        streams.append(stream)
+    for _, index, _, record in heapq.merge(*streams):
+        if record[1] != 'p':
+            record[2] = (index,) + record[2]
+        yield record
+
+
+@gen.coroutine
+def replay(args):
+    stats = Stats()
+    clients = {}
+    publisher = None
+    if args.pubsub:
+        publisher = tornadoredis.Client(args.redis_host, args.redis_port)
+        publisher.connect()
+    count = 0
+    first = last = None
+    started = time.time()
+    for record in records(args.recordings):
+        count += 1
+        if first is None:
+            first = record[0]
+        last = record[0]
+        if args.speed:
+            due = started + (record[0] - first) / args.speed
+            delay = due - time.time()
+            if delay > 0.001:
+                yield gen.sleep(delay)
+            stats.lag.append(max(0.0, time.time() - due))
+        elif count % 100 == 0:
+            # Let the clients connect and read
+            yield gen.moment
+        kind = record[1]
+        if kind == 'p':
+            if publisher is not None:
+                stats.published += 1
+                publisher.publish(record[2], json.dumps(record[3]))
+            continue
+        client = clients.get(record[2])
+        if kind == 'c':
+            if client is not None:
+                client.close()
+            continue
+        if client is None:
+            # Connections already open when the recording started turn up
+            # with a call first
+            client = clients[record[2]] = ReplayClient(args.url, len(clients), stats)
+            client.connect()
+        if kind == 'r':
+            client.call(record[3], record[4])
+    elapsed = time.time() - started
+
+    # Give the last calls a chance to be answered
+    deadline = time.time() + args.wait
+    while time.time() < deadline and any(client.waiting for client in clients.itervalues()):
+        yield gen.sleep(0.05)
+    for client in clients.itervalues():
+        client.close(force=True)
+    if publisher is not None:
+        publisher.disconnect()
+
+    span = (last - first) if count else 0.0
+    elapsed = elapsed or 1e-9
+    print 'Replayed %d records from %d recordings, %.1fs of traffic in %.1fs (%.1fx)' % (count, len(args.recordings), span, elapsed, span / elapsed)
+    print 'Connections %d opened, %d failed' % (stats.opened, stats.failed)
+    print 'Calls %d sent, %d replies, %d errors, %.0f calls/sec' % (stats.sent, stats.replies, stats.errors, stats.sent / elapsed)
+    print 'Frames pushed %d, %.0f frames/sec, pubsub published %d' % (stats.pushed, stats.pushed / elapsed, stats.published)
+    if stats.lag:
+        print 'Behind schedule p99 %.1fms, max %.1fms' % (percentile(stats.lag, 99) * 1000, max(stats.lag) * 1000)
+    print '%-16s %8s %10s %10s %10s' % ('call', 'count', 'p50 ms', 'p99 ms', 'max ms')
+    for name, latencies in sorted(stats.latencies.items()):
+        print '%-16s %8d %10.1f %10.1f %10.1f' % (name, len(latencies), percentile(latencies, 50) * 1000,
+                                                   percentile(latencies, 99) * 1000, max(latencies) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Camaste! Realtime traffic replay')
+    parser.add_argument('recordings', nargs='+', metavar='FILE', help='Files written by the server with --record')
+    parser.add_argument('--speed', type=float, default=1.0, metavar='X', help='Replay X times faster than recorded, 0 for as fast as possible')
+    parser.add_argument('--pubsub', action='store_true', help='Also publish the recorded pubsub messages to Redis')
+    parser.add_argument('--wait', type=float, default=5.0, metavar='SECS', help='How long to wait for replies to the last calls')
+    parser.add_argument('--url', metavar='URL', help='SockJS endpoint of a running server, e.g. ws://127.0.0.1:8081/realtime')
+    parser.add_argument('--redis-host', default='127.0.0.1', metavar='HOST', help='Redis for --pubsub with --url')
+    parser.add_argument('--redis-port', type=int, default=6379, metavar='PORT', help='Redis for --pubsub with --url')
+    parser.add_argument('--redis-server', default='redis-server', metavar='PATH', help='redis-server binary')
+    parser.add_argument('--server-args', default='--chat-no-auth --chat-user-rate 0 --chat-room-rate 0', metavar='ARGS', help='Extra arguments for the realtime server')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    ioloop = tornado.ioloop.IOLoop.instance()
+    if args.url:
+        ioloop.run_sync(lambda: replay(args))
+        return 0
+
+    with ThrowawayRedis(args.redis_server) as redis:
+        port = free_port()
+        args.url = 'ws://127.0.0.1:%d/realtime' % (port,)
+        args.redis_host, args.redis_port = redis.host, redis.port
+        server = subprocess.Popen([sys.executable, '-mrealtime',
+                                   '--http-host', '127.0.0.1', '--http-port', str(port),
+                                   '--redis-host', redis.host, '--redis-port', str(redis.port),
+                                   # Stop straight away when it's done
+                                   '--drain-secs', '0']
+                                  + shlex.split(args.server_args),
+                                  preexec_fn=os.setsid)
+        try:
+            time.sleep(1)
+            ioloop.run_sync(lambda: replay(args))
+        finally:
+            # The server and any workers it forked
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
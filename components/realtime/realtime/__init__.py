@@ -1,22 +1,47 @@
-__all__ = ['RealtimeServer', 'MessageHandler']
+__all__ = ['RealtimeServer', 'MessageHandler', 'Frame', 'intern_channel']
 
-import json, logging
+import collections, functools, json, logging, math, random, signal, socket, os, time, zlib
 
 from tornado import stack_context
 import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.websocket
 import tornado.ioloop
 import tornado.gen
+import tornado.concurrent
 
 import tornadoredis
 from tornadoredis.client import reply_pubsub_message
 
 import sockjs.tornado
+import sockjs.tornado.proto
+from sockjs.tornado.transports import RawWebSocketTransport
+
+from .codec import JSON, MSGPACK, CODECS
+from .metrics import Metrics, StatsHandler
+from .pipeline import CommandPipeline
+from .recorder import Recorder
+from .schema import compile_schema
 
 LOGGER = logging.getLogger()
 
 
+def intern_channel(name):
+    """
+    One shared copy of a channel name, however many end-users are in it.
+    Names decoded from messages are unicode, but they're almost always
+    ASCII and a byte string is smaller.
+    """
+    if isinstance(name, unicode):
+        try:
+            name = name.encode('ascii')
+        except UnicodeEncodeError:
+            return name
+    return intern(name)
+
+
 
 
 """
@@ -30,35 +55,110 @@ d8'   .8P 88.  .88 88.  .88       88 88.  ... 88       88 88.  .88 88.  ... 88
 class RedisSubscriber(object):
     """
     Multiplexes subscriptions while using only a single Redis client.
+
+    Publishing uses a separate client, as a connection in subscribed mode
+    can't PUBLISH. Messages are queued and sent as a pipeline once per
+    IOLoop iteration, with at most one pipeline in flight, so bursts of
+    messages cost a single round trip instead of one each.
+
+    With `shards` set, channels are hashed onto a fixed set of shard
+    channels in Redis instead of each having its own subscription. The
+    channel name travels in the message, under '_c', and is routed locally.
+    Thousands of rooms coming and going then only ever need `shards`
+    subscriptions in Redis. Channels in `direct_channels` are left alone.
+
+    If the connection to Redis is lost it's re-established with exponential
+    backoff and every channel is subscribed to again in a single command.
+    Anything published in the meantime is lost, so the `reconnect_callbacks`
+    are then called to let the apps catch up.
     """
-    def __init__(self, tornado_redis_client):
+    SHARD_PREFIX = 'shard.'
+    # Seconds to wait before the first and the slowest reconnect attempts
+    RECONNECT_MIN = 0.05
+    RECONNECT_MAX = 10.0
+
+    def __init__(self, tornado_redis_client, publisher_client, shards=0, metrics=None, reconnect_callbacks=(), recorder=None):
         self.redis = tornado_redis_client
+        self.publisher = publisher_client
+        self.shards = shards
+        self.metrics = metrics
+        self.recorder = recorder
+        self.reconnect_callbacks = reconnect_callbacks
         self.subs = {}
+        # Number of subscribed channels in each shard
+        self._shard_subs = {}
+        # Channels which are never sharded, for messages published by
+        # something other than a realtime server, e.g. Django.
+        self.direct_channels = set()
         self.extra_debug = False
+        # Identifies messages we published, which are dispatched locally
+        # straight away and ignored when Redis sends them back to us.
+        self.node_id = os.urandom(8).encode('hex')
+        self._publish_queue = []
+        self._publish_scheduled = False
+        self._publishing = False
+        # Failed pipelines in a row, the next one waits with backoff
+        self._publish_failures = 0
+        self._publish_timer = None
+        self.node_channel = 'node.' + self.node_id
+        # Channel changes waiting for `_sync` to send them to Redis
+        self._subscribe_queue = set()
+        self._unsubscribe_queue = set()
+        self._sync_scheduled = False
+        # Channels Redis has confirmed we're subscribed to, and Futures
+        # waiting for it to, see `subscribed`
+        self._confirmed = set()
+        self._confirming = {}
+        self._starting = False
+        self._listening = False
+        self._closed = False
+        self._reconnects = 0
+        self._reconnect_timer = None
 
 
     def _on_message(self, msg):
+        """
+        Dispatch a message from the Redis listener to the local subscribers.
+
+        The body is decoded once, then the same `Message` is handed to every
+        subscriber of the channel. This lets callbacks build their outgoing
+        frame once per message instead of once per subscriber, see `Frame`.
+        """
         try:
             if not msg:
                 return
+            if self.metrics is not None:
+                self.metrics.pubsub_in += 1
             if msg.kind == 'disconnect':
-                self.close()
+                self._on_disconnect()
             else:
-                if msg.body is not None:
-                    # XXX: handle ValueError...
+                if msg.kind == 'subscribe':
+                    self._on_subscribed(msg.channel)
+                if msg.kind == 'message' and msg.body is not None:
                     try:
-                        msg.body = json.loads(msg.body)                
+                        body = json.loads(msg.body)
                     except ValueError:
                         LOGGER.exception("_on_message: Failed to json.loads %r", msg)
+                        return
+                    if isinstance(body, dict):
+                        if body.pop('_o', None) == self.node_id:
+                            # Already dispatched to local subscribers by `_publish_channel`
+                            return
+                        if self.shards and '_c' in body:
+                            msg = msg._replace(channel=body.pop('_c'))
+                    msg = msg._replace(body=body)
+                    if self.recorder is not None:
+                        self.recorder.pubsub(msg.channel, body)
                 if isinstance(msg.channel, (set, list, tuple)):
                     channels = msg.channel
                 else:
-                    channels = set([msg.channel])
+                    channels = (msg.channel,)
                 # Run callbacks for all the channels the message was sent to
                 for channel in channels:
                     if channel in self.subs:
-                        msg.channel = channel
-                        for obj, callback in self.subs[msg.channel].items():
+                        if channel != msg.channel:
+                            msg = msg._replace(channel=channel)
+                        for obj, callback in self.subs[channel].items():
                             try:
                                 callback(obj, msg)
                             except:
@@ -72,12 +172,254 @@ class RedisSubscriber(object):
 
     def close(self):
         """
-        Unsubscribe from all channels
+        Forget all the subscriptions and disconnect from Redis
         """
-        for channel in self.subs.keys():
-            self.redis.unsubscribe(channel)
-        # TODO: stop redis listener...
+        self._closed = True
+        if self._reconnect_timer is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._reconnect_timer)
+            self._reconnect_timer = None
+        if self._publish_timer is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._publish_timer)
+            self._publish_timer = None
         self.subs = {}
+        self._shard_subs = {}
+        self._subscribe_queue.clear()
+        self._unsubscribe_queue.clear()
+        self._confirmed.clear()
+        for channel in self._confirming.keys():
+            self._release(channel)
+        self._listening = False
+        # Stops the listener
+        self.redis.connection.disconnect()
+
+
+    def _on_disconnect(self):
+        self._listening = False
+        self._starting = False
+        self._confirmed.clear()
+        if not self._closed:
+            LOGGER.warning("_on_disconnect: Lost the Redis pubsub connection, reconnecting")
+            self._schedule_reconnect()
+
+
+    def _schedule_reconnect(self):
+        if self._reconnect_timer is not None or self._closed:
+            return
+        delay = min(self.RECONNECT_MAX, self.RECONNECT_MIN * 2 ** self._reconnects)
+        # Jittered, so every worker doesn't retry at the same moment
+        delay *= random.uniform(0.5, 1.0)
+        self._reconnects += 1
+        ioloop = tornado.ioloop.IOLoop.instance()
+        self._reconnect_timer = ioloop.add_timeout(ioloop.time() + delay, self._reconnect)
+
+
+    def _reconnect(self):
+        """
+        Start again on a new client, the old one is left in a subscribed
+        state. Every channel is queued to be subscribed to in one go once
+        the listener is running.
+        """
+        self._reconnect_timer = None
+        old = self.redis
+        self.redis = tornadoredis.Client(old.connection.host, old.connection.port,
+                                         password=old.password, selected_db=old.selected_db)
+        self._unsubscribe_queue.clear()
+        self._confirmed.clear()
+        self._subscribe_queue = set(self._shard_subs if self.shards else self.subs)
+        self._sync()
+
+
+    def _on_connect_error(self, typ, value, tb):
+        LOGGER.warning("_on_connect_error: Could not subscribe to Redis: %s", value)
+        self._starting = False
+        self._schedule_reconnect()
+        return True
+
+
+    def shard(self, channel):
+        """
+        The Redis channel that messages for `channel` are sent on
+        """
+        if not self.shards or channel in self.direct_channels:
+            return channel
+        if isinstance(channel, unicode):
+            channel = channel.encode('utf-8')
+        return self.SHARD_PREFIX + str((zlib.crc32(channel) & 0xffffffff) % self.shards)
+
+
+    def _redis_subscribe(self, channel):
+        if self.shards:
+            channel = self.shard(channel)
+            count = self._shard_subs.get(channel, 0)
+            self._shard_subs[channel] = count + 1
+            if count:
+                return
+        if channel in self._unsubscribe_queue:
+            self._unsubscribe_queue.discard(channel)
+        else:
+            self._subscribe_queue.add(channel)
+        self._schedule_sync()
+
+
+    def _redis_unsubscribe(self, channel):
+        if self.shards:
+            channel = self.shard(channel)
+            count = self._shard_subs.get(channel, 0) - 1
+            if count > 0:
+                self._shard_subs[channel] = count
+                return
+            self._shard_subs.pop(channel, None)
+        if channel in self._subscribe_queue:
+            self._subscribe_queue.discard(channel)
+        else:
+            self._unsubscribe_queue.add(channel)
+        self._release(channel)
+        self._schedule_sync()
+
+
+    def _schedule_sync(self):
+        if not self._sync_scheduled:
+            self._sync_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self._sync)
+
+
+    def _sync(self):
+        """
+        Send the queued SUBSCRIBE and UNSUBSCRIBEs to Redis, each as one
+        command for all the channels which changed since the last sync.
+
+        tornadoredis can only send these safely while its listener is
+        running. The listener is started by subscribing to the node's own
+        channel, which is never unsubscribed so the listener never stops.
+        """
+        self._sync_scheduled = False
+        if self._closed or self._reconnect_timer is not None:
+            return
+        if not self._listening:
+            if not self._starting:
+                self._starting = True
+                with stack_context.ExceptionStackContext(self._on_connect_error):
+                    self.redis.subscribe(self.node_channel, callback=self._listen)
+            return
+        if self._unsubscribe_queue:
+            channels = list(self._unsubscribe_queue)
+            self._unsubscribe_queue.clear()
+            self._confirmed.difference_update(channels)
+            if self.extra_debug:
+                LOGGER.debug("_sync: redis.unsubscribe(%r)", channels)
+            self.redis.unsubscribe(channels)
+        if self._subscribe_queue:
+            channels = list(self._subscribe_queue)
+            self._subscribe_queue.clear()
+            if self.extra_debug:
+                LOGGER.debug("_sync: redis.subscribe(%r)", channels)
+            self.redis.subscribe(channels)
+
+
+    def _listen(self, result=None):
+        self._starting = False
+        if isinstance(result, Exception):
+            return self._on_connect_error(type(result), result, None)
+        self._listening = True
+        if self.extra_debug:
+            LOGGER.debug("_listen: Redis subscription listener started")
+        self.redis.listen(self._on_message, exit_callback=self._on_listen_exit)
+        self._sync()
+        if self._reconnects:
+            LOGGER.info("_listen: Reconnected to Redis after %d attempts", self._reconnects)
+            self._reconnects = 0
+            for callback in self.reconnect_callbacks:
+                try:
+                    callback()
+                except:
+                    LOGGER.exception("_listen: error calling reconnect callback %s", callback)
+
+
+    def _on_listen_exit(self, *args):
+        self._listening = False
+
+
+    def _on_subscribed(self, channel):
+        self._confirmed.add(channel)
+        self._release(channel)
+
+
+    def _release(self, channel):
+        """
+        Resolve the Futures waiting on a subscription to the channel
+        """
+        for future in self._confirming.pop(channel, ()):
+            future.set_result(None)
+
+
+    def subscribed(self, channel):
+        """
+        A Future resolved once Redis has confirmed a subscription to the
+        channel, everything published on it from then on will be received.
+        Snapshots of state the channel sends changes to should be read
+        after this, or changes made in between can be missed.
+
+        It's also resolved if the channel is unsubscribed from first, or
+        the subscriber closed, so check it's still wanted.
+        """
+        future = tornado.concurrent.Future()
+        channel = self.shard(channel)
+        if channel in self._confirmed:
+            future.set_result(None)
+        else:
+            self._confirming.setdefault(channel, []).append(future)
+        return future
+
+
+    def _flush_publish(self):
+        """
+        Send all the queued messages to Redis as one pipeline
+        """
+        self._publish_scheduled = False
+        self._publish_timer = None
+        if self._publishing or not self._publish_queue:
+            return
+        queue = self._publish_queue
+        self._publish_queue = []
+        pipe = self.publisher.pipeline()
+        for channel, json_encoded_msg in queue:
+            pipe.publish(channel, json_encoded_msg)
+        self._publishing = True
+        with stack_context.ExceptionStackContext(self._on_publish_error):
+            pipe.execute(callback=self._on_published)
+
+
+    def _on_published(self, results):
+        self._publishing = False
+        self._publish_failures = 0
+        for result in results:
+            if isinstance(result, Exception):
+                LOGGER.error("_on_published: Redis publish failed: %s", result)
+        # Messages queued while the pipeline was in flight
+        if self._publish_queue:
+            self._flush_publish()
+
+
+    def _on_publish_error(self, typ, value, tb):
+        LOGGER.error("_on_publish_error: Redis publish pipeline failed", exc_info=(typ, value, tb))
+        self._publishing = False
+        # The messages queued meanwhile are sent with the next pipeline, or
+        # the next after that, with backoff while Redis is down
+        if not self._closed and not self._publish_scheduled:
+            delay = min(self.RECONNECT_MAX, self.RECONNECT_MIN * 2 ** self._publish_failures)
+            self._publish_failures += 1
+            self._publish_scheduled = True
+            ioloop = tornado.ioloop.IOLoop.instance()
+            self._publish_timer = ioloop.add_timeout(ioloop.time() + delay, self._flush_publish)
+        return True
+
+
+    @property
+    def pending(self):
+        """
+        Number of messages, or pipelines of them, not yet sent to Redis
+        """
+        return len(self._publish_queue) + int(self._publishing)
 
 
     def _publish_channel(self, channel, msg, json_encoded_msg):
@@ -85,17 +427,36 @@ class RedisSubscriber(object):
         Send a message to a channel.
         All local subscribers of the channel will get sent the message
         without going through Redis.
+
+        The message is always published to Redis, even when nobody in this
+        process is subscribed, as other worker processes or realtime nodes
+        may have subscribers for the channel.
         """
-        if channel in self.subs:
+        if self.extra_debug:
             LOGGER.debug('_publish_channel: Redis publish channel:%s msg:%s', channel, json_encoded_msg)
-            self.redis.publish(channel, json_encoded_msg)
-            # Then dispatch the message to local clients, avoids JSON encoding
-            # PUBLISH doesn't send the message to ourselves
-            pubsub_msg = reply_pubsub_message(('message', channel, msg))
-            for obj, callback in self.subs[channel].items():
+        if self.metrics is not None:
+            self.metrics.published += 1
+        self._publish_queue.append((self.shard(channel), json_encoded_msg))
+        if not self._publish_scheduled:
+            self._publish_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self._flush_publish)
+        # Then dispatch the message to local clients, avoids JSON encoding
+        self.dispatch(channel, msg)
+
+
+    def dispatch(self, channel, obj):
+        """
+        Hand a message to the local subscribers of a channel only
+        """
+        if channel in self.subs:
+            pubsub_msg = reply_pubsub_message(('message', channel, obj))
+            for sub, callback in self.subs[channel].items():
                 if self.extra_debug:
-                    LOGGER.debug('_publish_channel: Internal publish channel:%s target:%s msg:%s', channel, obj, json_encoded_msg)
-                callback(obj, pubsub_msg)
+                    LOGGER.debug('dispatch: Internal publish channel:%s target:%s msg:%r', channel, sub, obj)
+                try:
+                    callback(sub, pubsub_msg)
+                except:
+                    LOGGER.exception("dispatch: error calling %s for %s", callback, sub)
 
 
     def publish(self, channels, obj):
@@ -104,9 +465,16 @@ class RedisSubscriber(object):
         Object must be JSON encodable.
         """
         assert isinstance(obj, dict)
-        json_encoded_obj = json.dumps(obj)
         if not isinstance(channels, (list, set, tuple)):
             channels = [channels]
+        if self.shards:
+            # Each message says which channel it's for
+            for channel in channels:
+                assert isinstance(channel, (str, unicode))
+                json_encoded_obj = json.dumps(dict(obj, _o=self.node_id, _c=channel))
+                self._publish_channel(channel, obj, json_encoded_obj)
+            return
+        json_encoded_obj = json.dumps(dict(obj, _o=self.node_id))
         for channel in channels:
             assert isinstance(channel, (str, unicode))
             self._publish_channel(channel, obj, json_encoded_obj)
@@ -118,17 +486,8 @@ class RedisSubscriber(object):
         if no_subs_for_channel:
             self.subs[channel] = {}                
         self.subs[channel][obj] = callback    
-        if not self.redis.subscribed:
-            # XXX: we might not be the only people listening on Redis...            
-            # Also we need to kill the redis listener when we close
-            # how to do this?
-            if self.extra_debug:
-                LOGGER.debug("_subscribe_channel: Redis subscription listener started")
-            self.redis.listen(self._on_message)
         if no_subs_for_channel:
-            if self.extra_debug:
-                LOGGER.debug("_subscribe_channel: redis.subscribe('%s')", channel)
-            self.redis.subscribe(channel)
+            self._redis_subscribe(channel)
 
 
     def subscribe(self, channels, obj, callback):
@@ -137,12 +496,13 @@ class RedisSubscriber(object):
         """
         assert obj is not None
         assert callable(callback)
-        # Wrapping the callback makes it look like it came from here
-        callback = stack_context.wrap(callback)
+        # Not wrapped with stack_context, that's a closure per subscription,
+        # `_on_message` and `dispatch` keep one callback's exceptions from
+        # the rest
         if not isinstance(channels, (list, set, tuple)):
             channels = [channels]
         for channel in channels:
-            self._subscribe_channel(channel, obj, callback)
+            self._subscribe_channel(intern_channel(channel), obj, callback)
 
 
     def _unsubscribe_channel(self, channel, obj):
@@ -155,7 +515,7 @@ class RedisSubscriber(object):
             del self.subs[channel][obj]
             if len(self.subs[channel]) == 0:
                 del self.subs[channel]
-                self.redis.unsubscribe(channel)
+                self._redis_unsubscribe(channel)
 
 
     def unsubscribe(self, channels, obj):
@@ -174,6 +534,70 @@ class RedisSubscriber(object):
 
 
 
+class Frame(object):
+    """
+    An outgoing message serialized once, which can then be sent to any
+    number of end-users without encoding it again. `obj` is the message
+    `text` is the JSON of, if it's to hand, for encoding it as MessagePack.
+
+    `priority` decides which frames go first, and which are dropped first,
+    to end-users who can't keep up, see `EndUserConnection.send_frame`.
+    """
+    # Priorities, e.g. presence is LOW and what performers say is HIGH
+    LOW = 0
+    HIGH = 1
+
+    __slots__ = ('text', 'obj', 'priority', '_jsonified', '_packed')
+
+    def __init__(self, text, obj=None, priority=LOW):
+        self.text = text
+        self.obj = obj
+        self.priority = priority
+        self._jsonified = None
+        self._packed = None
+
+
+    @property
+    def jsonified(self):
+        """
+        The text as a JSON string, which is how SockJS transports that
+        expect JSON (everything but raw websockets) put it on the wire.
+        """
+        if self._jsonified is None:
+            self._jsonified = sockjs.tornado.proto.json_encode(self.text)
+        return self._jsonified
+
+
+    @property
+    def packed(self):
+        """
+        The message as MessagePack, for end-users who asked for it
+        """
+        if self._packed is None:
+            obj = self.obj if self.obj is not None else json.loads(self.text)
+            self._packed = MSGPACK.encode(obj)
+        return self._packed
+
+
+
+class EndUserWebSocketTransport(RawWebSocketTransport):
+    """
+    The raw websocket transport, which speaks MessagePack in binary frames
+    instead of JSON to clients that ask for the 'msgpack' subprotocol.
+    """
+    codec = JSON
+
+    def select_subprotocol(self, subprotocols):
+        for name in subprotocols:
+            if name in CODECS:
+                self.codec = CODECS[name]
+                return name
+        return None
+
+
+
+
+
 """
  88888888b                dP dP     dP                            
  88                       88 88     88                            
@@ -188,54 +612,85 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
     It does protocol handing for the JSON based messages to & from the client-side JS code.
     It also provides utility methods for subscribing to Redis channels.
     """
+    # There's one of these per end-user, so no __dict__ and nothing
+    # allocated until it's needed
+    __slots__ = ('session', '_app', '_close_callbacks', '_channels', 'ip', '_state',
+                 '_outbox', '_flush_timer', '_queue', '_queue_timer', '_inflight', 'codec', 'dropped')
+
+    # Seconds between checks of a congested end-user's backlog
+    QUEUE_POLL = 0.05
+
     def __init__(self, app, session):
         super(EndUserConnection, self).__init__(session)
         self._app = app
-        self._close_callbacks = []
-        self._channels = {}
-        self._info = None
+        self._close_callbacks = None
+        self._channels = None
+        # The end-user's IP address, set by `on_open`
+        self.ip = None
         self._state = None
+        self._outbox = None
+        self._flush_timer = None
+        # Frames held while the end-user is congested, a deque for each
+        # priority, see `send_frame`
+        self._queue = None
+        self._queue_timer = None
+        self._inflight = 0
+        self.codec = JSON
+        self.dropped = 0
 
     def get(self, name, default=None):
+        if self._state is None:
+            return default
         return self._state.get(name, default)
 
 
     def has(self, name):
-        return name in self._state
+        return self._state is not None and name in self._state
 
 
     def set(self, name, value):
-        return self._state.set(name, value)
-
-
-    @property
-    def ip(self):
-        """
-        Return the end-users IP address
-        """
-        if 'X-Real-Ip' in self._info.headers:
-            return self._info.headers['X-Real-Ip']
-        if 'X-Forwarded-For' in self._info.headers:
-            return self._info.headers['X-Forwarded-For']
-        return self._info.ip
+        if self._state is None:
+            self._state = {}
+        self._state[name] = value
 
 
     def on_open(self, conn_info):
         """
         Called by SockJSConnection when connection is initialised 
         """
-        self._info = conn_info
+        # Only the address is kept, not the headers and cookies
+        headers = conn_info.headers
+        self.ip = headers.get('X-Real-Ip') or headers.get('X-Forwarded-For') or conn_info.ip
+        self.codec = getattr(self.session.handler, 'codec', JSON)
+        if self._app.metrics is not None:
+            self._app.metrics.sessions_opened += 1
+        if self._app.recorder is not None:
+            self._app.recorder.opened(self)
+        self._app.endusers.add(self)
         LOGGER.info("%s: connected", self.ip)
+        if self._app.draining:
+            # e.g. a polling transport which got in before the server stopped listening
+            delay = random.uniform(0, self._app.DRAIN_JITTER)
+            tornado.ioloop.IOLoop.instance().add_callback(self.reconnect, delay)
 
 
     def on_close(self):        
         """
         Called by SockJSConnection upon disconnection or other close condition
         """
-        for callback in self._close_callbacks:
-            callback(self)
-        for channel in self._channels.keys():
-            self.unsubscribe(channel)
+        self._discard_outbox()
+        self._discard_queue()
+        if self._app.metrics is not None:
+            self._app.metrics.sessions_closed += 1
+        if self._app.recorder is not None:
+            self._app.recorder.closed(self)
+        self._app.endusers.discard(self)
+        if self._close_callbacks is not None:
+            for callback in self._close_callbacks:
+                callback(self)
+        if self._channels:
+            channels, self._channels = self._channels, None
+            self._app.sub.unsubscribe(channels, self)
         LOGGER.info("%s: disconnected", self.ip)
 
 
@@ -249,13 +704,18 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
         When enduser disconnects channel will be auto-unsubscribed
         """
         assert channel is not None        
-        self._channels[channel] = True
+        channel = intern_channel(channel)
+        if self._channels is None:
+            self._channels = []
+        if channel not in self._channels:
+            # A list, end-users are only in a few channels
+            self._channels.append(channel)
         self._app.sub.subscribe(channel, self, callback)
 
 
     def unsubscribe(self, channel):
-        if channel in self._channels:
-            del self._channels[channel]
+        if self._channels and channel in self._channels:
+            self._channels.remove(channel)
             self._app.sub.unsubscribe(channel, self)
 
 
@@ -263,9 +723,23 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
         """
         Call the function when the connection is closed
         """
+        if self._close_callbacks is None:
+            self._close_callbacks = []
         self._close_callbacks.append(callback)
 
 
+    def reconnect(self, delay):
+        """
+        Tell the end-user to connect again in `delay` seconds, to another
+        server, and close the connection.
+        """
+        if self.session.is_closed:
+            return
+        self._deliver(self.codec.encode(self.envelope('reconnect', {'delay': int(delay * 1000)})))
+        self.flush()
+        self.session.close(4000, 'Draining')
+
+
     def reply(self, token, response, status=1):
         """
         Respond successfully to the message
@@ -281,9 +755,10 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
         self._respond(token, status, response)
 
 
-    def _respond(self, token, is_ok=1, response=None):
+    @staticmethod
+    def envelope(token, response=None, is_ok=1):
         """
-        Send 'realtime' formatted response back to client
+        A 'realtime' formatted response
         """
         if response is None:
             response = {}
@@ -291,22 +766,208 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
             assert isinstance(response, dict)
         response['id'] = token
         response['_'] = is_ok
+        return response
+
+
+    @staticmethod
+    def encode(token, response=None, is_ok=1):
+        """
+        Serialize a 'realtime' formatted response as JSON
+        """
+        return json.dumps(EndUserConnection.envelope(token, response, is_ok))
+
+
+    @staticmethod
+    def frame(token, response, priority=Frame.LOW):
+        """
+        A 'realtime' formatted response as a `Frame`, for broadcasts
+        """
+        response = EndUserConnection.envelope(token, response)
+        return Frame(json.dumps(response), response, priority)
+
+
+    @property
+    def backlog(self):
+        """
+        Approximate number of bytes waiting to be sent to the end-user,
+        either queued by SockJS until a polling transport reconnects or
+        sitting in the websocket's write buffer.
+        """
+        session = self.session
+        size = len(getattr(session, 'send_queue', ''))
+        stream = getattr(getattr(session, 'handler', None), 'stream', None)
+        if stream is not None:
+            size += getattr(stream, '_write_buffer_size', 0)
+        return size
+
+
+    def send_frame(self, frame):
+        """
+        Send a pre-serialized `Frame`, used when the same message goes
+        out to many end-users.
+
+        Frames are broadcasts the end-user didn't ask for. When the
+        end-user isn't reading them fast enough they're held in a short
+        queue, which is sent highest priority first once the backlog has
+        gone down. When it's full the oldest of the lowest priority frames
+        is dropped. If the backlog keeps growing the connection is closed.
+        """
+        if self._queue is not None:
+            # Still congested, don't jump the queue
+            return self._enqueue(frame)
+        max_backlog = self._app.max_backlog
+        if max_backlog and self.backlog >= max_backlog:
+            self._enqueue(frame)
+            self._schedule_poll()
+            return
+        self._deliver(frame)
+
+
+    def _drop(self):
+        self.dropped += 1
+        if self._app.metrics is not None:
+            self._app.metrics.frames_dropped += 1
+
+
+    def _enqueue(self, frame):
+        """
+        Hold a `Frame` until the end-user's backlog goes down
+        """
+        queue = self._queue
+        if queue is None:
+            queue = self._queue = tuple(collections.deque() for _ in range(Frame.HIGH + 1))
+        if sum(len(lane) for lane in queue) >= self._app.send_queue:
+            # Make room, unless everything queued matters more than this
+            self._drop()
+            for lane in queue[:frame.priority + 1]:
+                if lane:
+                    lane.popleft()
+                    break
+            else:
+                return
+        queue[frame.priority].append(frame)
+
+
+    def _discard_queue(self):
+        if self._queue_timer is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._queue_timer)
+            self._queue_timer = None
+        queue = self._queue
+        self._queue = None
+        return queue
+
+
+    def _schedule_poll(self):
+        ioloop = tornado.ioloop.IOLoop.instance()
+        self._queue_timer = ioloop.add_timeout(ioloop.time() + self.QUEUE_POLL, self._poll_queue)
+
+
+    def _poll_queue(self):
+        """
+        Send the queued frames, highest priority first, once the end-user
+        has caught up
+        """
+        self._queue_timer = None
+        if self.session.is_closed:
+            return self._discard_queue()
+        max_backlog = self._app.max_backlog
+        backlog = self.backlog
+        if backlog >= max_backlog * 2:
+            LOGGER.warning("%s: send_frame: closing slow consumer, %d bytes backlog, %d frames dropped", self.ip, backlog, self.dropped)
+            self._discard_queue()
+            return self.close()
+        if backlog >= max_backlog:
+            self._schedule_poll()
+            return
+        for lane in reversed(self._discard_queue()):
+            for frame in lane:
+                self._deliver(frame)
+
+
+    def _transmit(self, item):
+        """
+        Put a `Frame` or serialized message on the wire immediately
+        """
+        session = self.session
+        if session.is_closed:
+            return
+        if self._app.metrics is not None:
+            self._app.metrics.frames_out += 1
+        codec = self.codec
+        if isinstance(item, Frame):
+            if session.send_expects_json:
+                return session.send_jsonified(item.jsonified)
+            item = codec.frame(item)
+        if codec.binary:
+            session.send_message(item, binary=True)
+        else:
+            session.send_message(item)
+
+
+    def _deliver(self, item):
+        """
+        Send a `Frame` or serialized message, unless the server coalesces
+        outgoing messages, in which case it's held in the outbox until the
+        coalescing window expires or the outbox is full.
+        """
+        window = self._app.coalesce_window
+        if not window:
+            return self._transmit(item)
+        if self._outbox is None:
+            self._outbox = [item]
+            ioloop = tornado.ioloop.IOLoop.instance()
+            self._flush_timer = ioloop.add_timeout(ioloop.time() + window, self.flush)
+        else:
+            self._outbox.append(item)
+        if len(self._outbox) >= self._app.coalesce_max:
+            self.flush()
+
+
+    def _discard_outbox(self):
+        if self._flush_timer is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._flush_timer)
+            self._flush_timer = None
+        outbox = self._outbox
+        self._outbox = None
+        return outbox
+
+
+    def flush(self):
+        """
+        Send everything in the outbox. Multiple messages are sent as
+        one array, which the client-side JS unbatches.
+        """
+        outbox = self._discard_outbox()
+        if not outbox:
+            return
+        if len(outbox) == 1:
+            return self._transmit(outbox[0])
+        codec = self.codec
+        payloads = [codec.frame(item) if isinstance(item, Frame) else item for item in outbox]
+        self._transmit(codec.batch(payloads))
+
+
+    def _respond(self, token, is_ok=1, response=None):
+        """
+        Send 'realtime' formatted response back to client
+        """
         try:
-            response = json.dumps(response)
+            response = self.codec.encode(self.envelope(token, response, is_ok))
         except:
             LOGGER.exception("Failed to encode response!")
-        self.send(response)
+            return
+        self._deliver(response)
 
 
     def _parse_msg(self, raw_msg):
         """
-        Parses the raw JSON message and ensures it passes strict
-        type checks
+        Parses the raw JSON (or MessagePack) message and ensures it
+        passes strict type checks
         """
         try:
-            msg = json.loads(raw_msg)
+            msg = self.codec.decode(raw_msg)
         except ValueError:            
-            LOGGER.debug("%s: _parse_msg: Could not json.loads(raw_msg)", self.ip)
+            LOGGER.debug("%s: _parse_msg: Could not decode raw_msg as %s", self.ip, self.codec.name)
             return
         if not isinstance(msg, dict):
             LOGGER.debug("%s: _parse_msg: message is not dict", self.ip)
@@ -317,6 +978,9 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
         if not isinstance(msg['id'], (str, unicode)):
             LOGGER.debug("%s: _parse_msg: id is not string...", self.ip)
             return
+        if not isinstance(msg['call'], (str, unicode)):
+            LOGGER.debug("%s: _parse_msg: call is not string", self.ip)
+            return self.error(msg['id'], {'call': 'Unknown'})
         if not isinstance(msg['args'], (dict,)):
             LOGGER.debug("%s: _parse_msg: args is not dict", self.ip)
             return self.error(msg['id'], {'args': 'Invalid'})
@@ -326,33 +990,102 @@ class EndUserConnection(sockjs.tornado.SockJSConnection):
         return msg
 
 
+    def _on_command_done(self, msg, started, future):
+        """
+        An asynchronous command has finished, send its result
+        """
+        self._inflight -= 1
+        try:
+            response = future.result()
+        except:
+            return self._on_command_error(msg)
+        self._on_command_result(msg, started, response)
+
+
+    def _on_command_result(self, msg, started, response):
+        metrics = self._app.metrics
+        if metrics is not None:
+            metrics.command(msg['call'], time.time() - started)
+        if response is not None:
+            if not isinstance(response, dict):
+                LOGGER.error("%s: '%s' call returned %r, not a dict", self.ip, msg['call'], response)
+                return self.error(msg['id'], {'call': 'Server Error'})
+            self.reply(msg['id'], response)
+
+
+    def _on_command_error(self, msg):
+        # Catch-all exception handler, send back generic 'Server Error'
+        LOGGER.exception("%s: on_message: exception on '%s' call", self.ip, msg['call'])
+        self.error(msg['id'], {'call': 'Server Error'})
+
+
     def on_message(self, raw_msg):     
         """
         Handles a raw message the SockJS connection.
-        It parses the message, dispatches the RPC call and send the reply
+        It parses the message, dispatches the RPC call and send the reply,
+        straight away or once an asynchronous command has finished
         """   
+        metrics = self._app.metrics
         try:
+            if metrics is not None:
+                metrics.rpc_in += 1
             msg = self._parse_msg(raw_msg)        
             if not msg:            
                 return       
+            if self._app.recorder is not None:
+                self._app.recorder.rpc(self, msg['call'], msg['args'])
             method = self._app.command(msg['call'])
             if not method:
                 LOGGER.warning("%s: on_message: unknown call '%s'", self.ip, msg['call'])
                 return self.error(msg['id'], {'call': 'Unknown'})
+            validate = self._app.validator(msg['call'])
+            if validate is not None:
+                errors = validate(msg['args'])
+                if errors is not None:
+                    LOGGER.debug("%s: on_message: bad arguments for '%s': %r", self.ip, msg['call'], errors)
+                    if metrics is not None:
+                        metrics.rpc_rejected += 1
+                    return self.error(msg['id'], {'args': errors})
             #LOGGER.debug("%s: on_message: %s(%s)", self.ip, msg['call'], json.dumps(msg['args']))
+            max_inflight = self._app.max_inflight
+            if max_inflight and self._inflight >= max_inflight:
+                LOGGER.debug("%s: on_message: too many calls in flight, rejecting '%s'", self.ip, msg['call'])
+                return self.error(msg['id'], {'call': 'Busy'})
+            # Only timed for the metrics
+            started = time.time() if metrics is not None else None
             try:
-                kwargs = msg['args']
-                response = method(self, **kwargs)            
-                if response is not None:
-                    assert isinstance(response, dict)
-                    self.reply(msg['id'], response)
+                response = method(self, **msg['args'])
             except:
-                # Catch-all exception handler, send back generic 'Server Error'
-                LOGGER.exception("%s: on_message: exception on '%s' call", self.ip, msg['call'])
-                self.error(msg['id'], {'call': 'Server Error'})
+                return self._on_command_error(msg)
+            if tornado.concurrent.is_future(response):
+                # Coroutine, reply when it finishes without blocking the IOLoop
+                self._inflight += 1
+                callback = functools.partial(self._on_command_done, msg, started)
+                tornado.ioloop.IOLoop.current().add_future(response, callback)
+            else:
+                self._on_command_result(msg, started, response)
         except:
             # So.. just incase _parse_msg errors out.. or something! Don't crash... please don't crash...
-            LOGGER.exception("%s: on_message: cannot parse raw message: '%s'", raw_msg)
+            LOGGER.exception("%s: on_message: cannot parse raw message: '%s'", self.ip, raw_msg)
+
+
+
+
+
+class DrainHandler(tornado.web.RequestHandler):
+    """
+    POST to drain the server, only from the machine it's running on
+    """
+    def initialize(self, server):
+        self.server = server
+
+    def post(self):
+        request = self.request
+        if request.remote_ip not in ('127.0.0.1', '::1') or 'X-Real-Ip' in request.headers \
+           or 'X-Forwarded-For' in request.headers:
+            raise tornado.web.HTTPError(403)
+        self.server.drain_all()
+        self.write({'draining': True, 'endusers': len(self.server.endusers)})
 
 
 
@@ -367,15 +1100,87 @@ d8'   .8P 88.  ... 88       88 .88'  88.  ... 88
  Y88888P  `88888P' dP       8888P'   `88888P' dP       
 """                                                                                                   
 class RealtimeServer(object):
+    """
+    The Tornado/SockJS server, optionally forked into multiple worker processes.
+
+    Every worker has its own Redis connection and `RedisSubscriber`, so each
+    process only SUBSCRIBEs to the channels its own end-users are in. Redis
+    does the fan-out between workers: a message published by one process is
+    delivered to the subscribers of every other process.
+    """
+    # Longest an end-user is told to wait before reconnecting when the
+    # server drains, and how often more of them are disconnected
+    DRAIN_JITTER = 5.0
+    DRAIN_TICK = 0.1
+    # Longest to wait for the Redis commands of the closed sessions
+    DRAIN_GRACE = 5.0
+
     def __init__(self, conf):
         self._cmds = {}
-        self.conf = conf        
-        self.redis = tornadoredis.Client(conf['redis_host'], conf['redis_port'])
-        self.sub = RedisSubscriber(self.redis)
+        self._validators = {}
+        self._reconnect_callbacks = []
+        self.conf = conf
+        self.worker_id = None
+        self._parent_pid = None
+        self.endusers = set()
+        self.draining = False
+        self._drain_queue = None
+        self._drain_total = 0
+        self._drain_period = 0
+        self._drain_started = None
+        self._drain_deadline = None
+        # Outgoing messages to each end-user can be held for a short window
+        # and sent together, cutting the number of frames during busy periods.
+        self.coalesce_window = conf.get('coalesce_ms', 0) / 1000.0
+        self.coalesce_max = conf.get('coalesce_max', 50)
+        # Broadcasts are queued for end-users with this many bytes
+        # waiting to be sent to them, 0 for no limit. Up to `send_queue`
+        # of them, beyond that the lowest priority ones are dropped.
+        self.max_backlog = conf.get('max_backlog', 256 * 1024)
+        self.send_queue = conf.get('send_queue', 64)
+        # Asynchronous (coroutine) commands each end-user can have running
+        # at once, further calls are rejected as 'Busy'. 0 for no limit
+        self.max_inflight = conf.get('max_inflight', 8)
+        # These are created by `_setup` after forking, each worker process
+        # must have its own IOLoop, Redis connection and HTTP server.
+        self.metrics = None
+        self.recorder = None
+        self.redis = None
+        self.publisher = None
+        self.pipeline = None
+        self.sub = None
+        self.sockjs_router = None
+        self.tornado_app = None
+        self.http_server = None
+
+
+    def _setup(self):
+        self.redis = tornadoredis.Client(self.conf['redis_host'], self.conf['redis_port'])
+        self.publisher = tornadoredis.Client(self.conf['redis_host'], self.conf['redis_port'])
+        self.pipeline = CommandPipeline([tornadoredis.Client(self.conf['redis_host'], self.conf['redis_port'])
+                                         for _ in range(max(1, self.conf.get('redis_pool', 4)))])
+        if self.conf.get('stats'):
+            self.metrics = Metrics()
+            self.metrics.start()
+        if self.conf.get('record'):
+            # Each worker has a file of its own
+            path = self.conf['record']
+            if self.worker_id is not None:
+                path = '%s.%d' % (path, self.worker_id)
+            self.recorder = Recorder(path)
+            self.recorder.start()
+        self.sub = RedisSubscriber(self.redis, self.publisher, self.conf.get('redis_shards', 0), self.metrics,
+                                   self._reconnect_callbacks, self.recorder)
 
         make_connection = lambda session: EndUserConnection(self, session)
         self.sockjs_router = sockjs.tornado.SockJSRouter(make_connection, '/realtime')
-        self.tornado_app = tornado.web.Application(self.sockjs_router.urls)
+        # The raw websocket endpoint can also speak MessagePack
+        urls = [(url, EndUserWebSocketTransport if handler is RawWebSocketTransport else handler, kwargs)
+                for url, handler, kwargs in self.sockjs_router.urls]
+        if self.metrics is not None:
+            urls.append((r'/stats', StatsHandler, {'server': self}))
+        urls.append((r'/admin/drain', DrainHandler, {'server': self}))
+        self.tornado_app = tornado.web.Application(urls)
         self.http_server = tornado.httpserver.HTTPServer(self.tornado_app)
 
 
@@ -386,26 +1191,187 @@ class RealtimeServer(object):
         return self._cmds.get(name)
 
 
-    def register(self, cmd, callback):
+    def validator(self, name):
+        """
+        Retrieve the argument validator of a command, if it has a schema
+        """
+        return self._validators.get(name)
+
+
+    def register(self, cmd, callback, schema=None):
         """
         Register an RPC command
+
+        The callback is called as `callback(enduser, **args)` and returns
+        the response dict, None to not reply, or a Future (for example from
+        a `tornado.gen.coroutine`) resolving to either.
+
+        `schema` is a dict of argument name -> `schema.Arg`. It's compiled
+        now, and calls with arguments which don't match get an error
+        reply saying what's wrong with them, without the callback being
+        called.
         """
         assert cmd is not None
         assert callable(callback)
         self._cmds[cmd] = callback
+        if schema is not None:
+            self._validators[cmd] = compile_schema(schema)
+        else:
+            self._validators.pop(cmd, None)
         LOGGER.debug("Registered command '%s' to %s", cmd, callback)
 
 
+    def on_redis_reconnect(self, callback):
+        """
+        Call the function when the pubsub connection to Redis comes back
+        after being lost, anything published in between was missed.
+        """
+        assert callable(callback)
+        self._reconnect_callbacks.append(callback)
+
+
+    def drain(self, period=None):
+        """
+        Stop taking new end-users and move the connected ones to other
+        servers, then stop the IOLoop.
+
+        The listening socket is closed straight away. End-users are then
+        disconnected in a random order, spread evenly over `period` seconds
+        (the 'drain_secs' conf), each told to reconnect after a random
+        delay of up to `DRAIN_JITTER` seconds. Redis and the other servers
+        see a steady trickle of reconnects rather than all of them at once.
+        """
+        if self.draining:
+            return
+        if period is None:
+            period = self.conf.get('drain_secs', 30)
+        self.draining = True
+        LOGGER.info("Draining %d end-users over %ds", len(self.endusers), period)
+        self.http_server.stop()
+        queue = list(self.endusers)
+        random.shuffle(queue)
+        self._drain_queue = queue
+        self._drain_total = len(queue)
+        self._drain_period = period
+        self._drain_started = tornado.ioloop.IOLoop.instance().time()
+        self._drain_tick()
+
+
+    def drain_all(self):
+        """
+        Drain every worker process, or just this server if it has none
+        """
+        if self.worker_id is None:
+            self.drain()
+        else:
+            # The parent forwards it to all the workers, see `_on_parent_sigterm`
+            os.kill(os.getppid(), signal.SIGTERM)
+
+
+    def _drain_tick(self):
+        ioloop = tornado.ioloop.IOLoop.instance()
+        queue = self._drain_queue
+        if self._drain_period > 0:
+            elapsed = ioloop.time() - self._drain_started
+            due = int(math.ceil(self._drain_total * elapsed / self._drain_period))
+        else:
+            due = self._drain_total
+        while queue and self._drain_total - len(queue) < due:
+            queue.pop().reconnect(random.uniform(0, self.DRAIN_JITTER))
+        if queue:
+            ioloop.add_timeout(ioloop.time() + self.DRAIN_TICK, self._drain_tick)
+        else:
+            self._drain_deadline = ioloop.time() + self.DRAIN_GRACE
+            self._drain_finish()
+
+
+    def _drain_finish(self):
+        """
+        Wait for the closed sessions' Redis commands, e.g. leaving their
+        rooms, to be sent before stopping.
+        """
+        ioloop = tornado.ioloop.IOLoop.instance()
+        pending = self.pipeline.pending + self.sub.pending
+        if pending and ioloop.time() < self._drain_deadline:
+            ioloop.add_timeout(ioloop.time() + self.DRAIN_TICK, self._drain_finish)
+            return
+        if pending:
+            LOGGER.warning("_drain_finish: gave up on %d Redis commands", pending)
+        LOGGER.info("Drained, stopping")
+        self.sub.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        ioloop.stop()
+
+
+    def _on_sigterm(self, signum, frame):
+        tornado.ioloop.IOLoop.instance().add_callback_from_signal(self.drain)
+
+
+    def _on_parent_sigterm(self, signum, frame):
+        """
+        SIGTERM to the parent process drains all the workers. They're sent
+        it through the process group, which the parent gets too.
+        """
+        if os.getpid() != self._parent_pid:
+            # A worker which hasn't set its own handler yet
+            return self._on_sigterm(signum, frame)
+        if self.draining:
+            return
+        self.draining = True
+        if os.getpgrp() == os.getpid():
+            LOGGER.info("Draining the workers")
+            os.killpg(os.getpgrp(), signum)
+        else:
+            LOGGER.warning("Can't drain the workers, not a process group leader, send them SIGTERM directly")
+
+
+    def _bind(self, reuse_port=False):
+        if reuse_port:
+            return tornado.netutil.bind_sockets(self.conf['http_port'], self.conf['http_host'], reuse_port=True)
+        return tornado.netutil.bind_sockets(self.conf['http_port'], self.conf['http_host'])
+
+
     def run(self):
         """
         Start the HTTP server and Tornado IO loop
+
+        With `workers` set to anything other than 1 the process is forked,
+        0 means one worker per CPU. Where the platform supports SO_REUSEPORT
+        each worker binds its own listening socket and the kernel balances
+        new connections between them, otherwise the socket is bound before
+        forking and shared by all the workers.
+
+        SIGTERM drains the server, see `drain`, rather than dropping every
+        end-user at once. Sent to the parent it drains all the workers.
         """
-        self.http_server.listen(self.conf['http_port'], self.conf['http_host'])
-        LOGGER.info('Camaste! Realtime @ http://%s:%d/realtime', self.conf['http_host'], self.conf['http_port'])
+        workers = self.conf.get('workers', 1)
+        sockets = None
+        # Also lets a new server start listening while the old one drains
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        if not reuse_port:
+            sockets = self._bind()
+        if workers != 1:
+            self._parent_pid = os.getpid()
+            signal.signal(signal.SIGTERM, self._on_parent_sigterm)
+            # The parent process stays here, restarting crashed workers.
+            # Those which exit after draining aren't restarted, and the
+            # parent exits once they all have.
+            self.worker_id = tornado.process.fork_processes(workers)
+        if reuse_port:
+            sockets = self._bind(reuse_port=True)
+
+        self._setup()
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        self.http_server.add_sockets(sockets)
+        if self.worker_id is None:
+            LOGGER.info('Camaste! Realtime @ http://%s:%d/realtime', self.conf['http_host'], self.conf['http_port'])
+        else:
+            LOGGER.info('Camaste! Realtime @ http://%s:%d/realtime (worker %d)', self.conf['http_host'], self.conf['http_port'], self.worker_id)
         try:
             tornado.ioloop.IOLoop.instance().start()            
         except KeyboardInterrupt:
             LOGGER.info('Stopping...')
+            if self.recorder is not None:
+                self.recorder.close()
             tornado.ioloop.IOLoop.instance().stop()
-
-
@@ -46,6 +46,22 @@ class TcpIpPortAction(argparse.Action):
         setattr(namespace, self.dest, value)
 
 
+class CountAction(argparse.Action):
+    """
+    Validates a count argument, which must be 0 or more
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        if len(values) > 1:
+            raise argparse.ArgumentError(self, "can only accept 1 number")
+        try:
+            value = int(values[0])
+        except:
+            raise argparse.ArgumentError(self, "must be a number")
+        if value < 0:
+            raise argparse.ArgumentError(self, "must be 0 or more")
+        setattr(namespace, self.dest, value)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Camaste! Realtime Component')
     parser.add_argument('--logging', type=argparse.FileType('r'), help='Python logging.conf', metavar='CONF_FILE')
@@ -53,6 +69,24 @@ def main():
     parser.add_argument('--http-port', type=int, action=TcpIpPortAction, default=8081, nargs=1, metavar='PORT', help='Bind Port for HTTP server')
     parser.add_argument('--redis-host', type=str, action=HostnameAction, default='localhost', nargs=1, metavar='HOST', help='Redis Server port')
     parser.add_argument('--redis-port', type=int, action=TcpIpPortAction, default=6379, nargs=1, metavar='PORT', help='Redis Server port')
+    parser.add_argument('--redis-shards', type=int, action=CountAction, default=0, nargs=1, metavar='N', help='Hash channels onto N shared Redis channels, 0 to subscribe to each channel')
+    parser.add_argument('--redis-pool', type=int, action=CountAction, default=4, nargs=1, metavar='N', help='Redis connections for commands other than pubsub')
+    parser.add_argument('--stats', action='store_true', help='Collect metrics and serve them at /stats')
+    parser.add_argument('--record', type=str, metavar='FILE', help='Append the calls end-users make and the pubsub messages received to FILE, for bench.replay. Workers each write FILE.<worker>')
+    parser.add_argument('--workers', type=int, action=CountAction, default=1, nargs=1, metavar='N', help='Number of worker processes, 0 for one per CPU')
+    parser.add_argument('--coalesce-ms', type=int, action=CountAction, default=0, nargs=1, metavar='MS', help='Hold outgoing messages to each end-user for up to MS milliseconds and send them as one batch, 0 to disable')
+    parser.add_argument('--coalesce-max', type=int, action=CountAction, default=50, nargs=1, metavar='N', help='Send a batch early once it has N messages')
+    parser.add_argument('--max-backlog', type=int, action=CountAction, default=256 * 1024, nargs=1, metavar='BYTES', help='Queue broadcasts to end-users with this much unsent data, and disconnect them at twice that, 0 for no limit')
+    parser.add_argument('--send-queue', type=int, action=CountAction, default=64, nargs=1, metavar='N', help='Broadcasts queued for each end-user with too much unsent data, the lowest priority are dropped first')
+    parser.add_argument('--max-inflight', type=int, action=CountAction, default=8, nargs=1, metavar='N', help='Asynchronous calls each end-user can have running at once, 0 for no limit')
+    parser.add_argument('--drain-secs', type=int, action=CountAction, default=30, nargs=1, metavar='SECS', help='On SIGTERM, disconnect end-users gradually over SECS seconds and then exit')
+    parser.add_argument('--chat-user-rate', type=int, action=CountAction, default=2, nargs=1, metavar='N', help='Chat messages per second each end-user may send')
+    parser.add_argument('--chat-room-rate', type=int, action=CountAction, default=50, nargs=1, metavar='N', help='Chat messages per second allowed into each room')
+
+    parser.add_argument('--chat-history', type=int, action=CountAction, default=50, nargs=1, metavar='N', help='Recent messages kept for each room and sent to end-users when they join, 0 to disable')
+    parser.add_argument('--chat-no-auth', action='store_true', help='Let anyone join and send to any chat room, for development and load testing')
+    parser.add_argument('--access-cache-size', type=int, action=CountAction, default=10000, nargs=1, metavar='N', help='Room and member records cached for access checks')
+    parser.add_argument('--access-cache-ttl', type=int, action=CountAction, default=60, nargs=1, metavar='SECS', help='Longest time a cached access record is used for')
 
     args = parser.parse_args().__dict__
 
@@ -0,0 +1,214 @@
+__all__ = ('LRUCache', 'Grant', 'RoomAccess')
+
+import collections, json, logging, time
+
+import tornado.gen
+
+LOGGER = logging.getLogger()
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A mapping of at most `size` entries, each expiring `ttl` seconds after
+    it was set. The least recently used entry is evicted when it's full.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def get(self, key, default=MISSING, now=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        if now is None:
+            now = time.time()
+        if entry[0] <= now:
+            return default
+        # Re-inserting moves it to the most recently used end
+        self._data[key] = entry
+        return entry[1]
+
+
+    def set(self, key, value, now=None):
+        if now is None:
+            now = time.time()
+        data = self._data
+        data.pop(key, None)
+        while len(data) >= self.size:
+            data.popitem(last=False)
+        data[key] = (now + self.ttl, value)
+
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+
+    def clear(self):
+        self._data.clear()
+
+
+
+class Grant(object):
+    """
+    Who an end-user is in a room, from the 'RAXS.*' key Django made for
+    them with `Room.allow_access`. Anonymous end-users have no account.
+    """
+    __slots__ = ('room', 'account', 'username', 'access')
+
+    def __init__(self, room, account=None, username=None, access=None):
+        self.room = room
+        self.account = account
+        self.username = username
+        self.access = access
+
+
+
+class RoomAccess(object):
+    """
+    Decides what an end-user may do in a room, from the room and member
+    records Django mirrors into Redis ('Room_<token>' and the
+    'Room_<token>_Members' hash).
+
+    The records are kept in an `LRUCache` so checking every chat message
+    costs nothing once the room is warm. Django publishes on `CHANNEL`
+    whenever it changes one, e.g. `{"room": token, "account": pk}`, and the
+    cached entry is dropped straight away; the TTL only bounds how stale
+    an entry can get if a notification is lost.
+
+    Access levels are those of `RoomMember.access`, or None for no access.
+    """
+    CHANNEL = 'realtime.access'
+    # Access levels which may join a room, and which may send to its chat
+    JOIN_LEVELS = frozenset('GVPA')
+    SEND_LEVELS = frozenset('PA')
+
+    def __init__(self, app, size=10000, ttl=60):
+        self._app = app
+        self.cache = LRUCache(size, ttl)
+        # Bumped by every invalidation, lookups which were in flight at
+        # the time don't cache what they read as it may be stale.
+        self._generation = 0
+        self._listening = False
+
+
+    def _listen(self):
+        """
+        Subscribe to the invalidation channel, done on first use as the
+        server isn't set up until after the apps are configured.
+        """
+        if not self._listening:
+            self._listening = True
+            sub = self._app.sub
+            sub.direct_channels.add(self.CHANNEL)
+            sub.subscribe(self.CHANNEL, self, RoomAccess._on_invalidate)
+
+
+    def clear(self):
+        """
+        Forget everything, after invalidations may have been missed
+        """
+        self._generation += 1
+        self.cache.clear()
+
+
+    def _on_invalidate(self, msg):
+        if msg.kind != 'message' or not isinstance(msg.body, dict):
+            return
+        room = msg.body.get('room')
+        if room is None:
+            return
+        self._generation += 1
+        account = msg.body.get('account')
+        if account is None:
+            self.cache.discard((room,))
+        else:
+            self.cache.discard((room, int(account)))
+
+
+    @tornado.gen.coroutine
+    def grant(self, room, key=None):
+        """
+        Read the 'RAXS.<room>.*' key an end-user was given by Django, the
+        Grant for an anonymous end-user if there's no key, or None if the
+        key is wrong or has expired.
+        """
+        if key is None:
+            raise tornado.gen.Return(Grant(room))
+        if not key.startswith('RAXS.%s.' % (room,)):
+            raise tornado.gen.Return(None)
+        results = yield self._app.pipeline.execute(('get', key))
+        if not results[0]:
+            raise tornado.gen.Return(None)
+        data = json.loads(results[0])
+        account = data['account']
+        raise tornado.gen.Return(Grant(room, int(account['pk']), account['username'], account['access']))
+
+
+    def resolve(self, grant, room, member):
+        """
+        The access level for a Grant, given the room and member records
+        """
+        if room is None:
+            return None
+        if grant.account is None:
+            if room.get('allow_anons') and room.get('anons_see_chat') and not room.get('is_private'):
+                return 'V'
+            return None
+        if member is not None:
+            # The membership is newer than the grant, e.g. after a ban
+            access = member['account']['access']
+        elif room.get('is_private'):
+            return None
+        else:
+            access = grant.access
+        return access if access in self.JOIN_LEVELS else None
+
+
+    def cached(self, grant, now=None):
+        """
+        The access level for a Grant if everything needed is cached,
+        otherwise MISSING and `check` must be used.
+        """
+        room = self.cache.get((grant.room,), now=now)
+        if room is MISSING:
+            return MISSING
+        member = None
+        if grant.account is not None:
+            member = self.cache.get((grant.room, grant.account), now=now)
+            if member is MISSING:
+                return MISSING
+        return self.resolve(grant, room, member)
+
+
+    @tornado.gen.coroutine
+    def check(self, grant):
+        """
+        The access level for a Grant, reading anything not cached from Redis
+        """
+        self._listen()
+        level = self.cached(grant)
+        if level is not MISSING:
+            raise tornado.gen.Return(level)
+        generation = self._generation
+        commands = [('get', 'Room_%s' % (grant.room,))]
+        if grant.account is not None:
+            commands.append(('hget', 'Room_%s_Members' % (grant.room,), grant.account))
+        results = yield self._app.pipeline.execute(*commands)
+        # tornadoredis gives '' rather than None for a missing hash field
+        room = json.loads(results[0]) if results[0] else None
+        member = None
+        if grant.account is not None and results[1]:
+            member = json.loads(results[1])
+        if generation == self._generation:
+            self.cache.set((grant.room,), room)
+            if grant.account is not None:
+                self.cache.set((grant.room, grant.account), member)
+        raise tornado.gen.Return(self.resolve(grant, room, member))
@@ -1,8 +1,18 @@
 __all__ = ('ChatApp',)
 
-import logging
+import json, logging, os, time
 LOGGER = logging.getLogger()
 
+import tornado.gen
+import tornado.ioloop
+
+from .. import EndUserConnection, Frame, intern_channel
+from ..access import MISSING, Grant, RoomAccess
+from ..presence import RoomPresence
+from ..history import RoomHistory
+from ..ratelimit import TokenBucket
+from ..schema import Arg
+
 
 
 """
@@ -14,11 +24,14 @@ Y8.   .8P       88 88.  ... 88       d8'   .8P   88   88.  .88   88   88.  ...
 `Y88888P' `88888P' `88888P' dP        Y88888P    dP   `88888P8   dP   `88888P' 
 """
 class ChatUserState(object):
-    __slots__ = ('name', 'token2chan', 'chan2token')
+    __slots__ = ('bucket', 'rooms', 'session')
     def __init__(self):
-        self.name = None
-        self.token2chan = {}
-        self.chan2token = {}
+        # Identifies the end-user's rooms after they disconnect, see `ChatApp.resume`
+        self.session = None
+        self.bucket = None
+        # Room token -> (Grant, how the end-user is shown in the room's
+        # presence list or None when they aren't), for the rooms joined
+        self.rooms = {}
 
 
 
@@ -35,13 +48,67 @@ Y8.   .88 88    88 88.  .88   88   88     88  88.  .88 88.  .88
                                               dP       dP  
 """
 class ChatApp(object):
+    # Burst sizes for the chat message rate limits, in messages
+    USER_BURST = 5
+    ROOM_BURST = 100
+    # Idle room buckets are swept when there are more than this many
+    ROOM_BUCKETS_SWEEP = 1024
+    # Seconds after disconnecting that an end-user can resume their rooms
+    RESUME_TTL = 120
+    # Longest room token, chat message and most rooms resumed at once
+    TOKEN_LEN = 64
+    TEXT_LEN = 1000
+    RESUME_ROOMS = 50
+    # Messages from performers and admins go ahead of everyone else's to
+    # end-users who can't keep up. Only they may send (SEND_LEVELS), so for
+    # now that puts chat ahead of presence diffs, which are always LOW.
+    PRIORITY_LEVELS = frozenset('PA')
+    # Everyone's access level without auth (--chat-no-auth)
+    NO_AUTH_LEVEL = 'P'
+
     def __init__(self, app):
-        app.register('chat.join', self.join)
-        app.register('chat.part', self.part)
-        app.register('chat.sendmsg', self.sendmsg)
+        self._last_msg = None
+        self._last_frame = None
+        self._user_rate = app.conf.get('chat_user_rate', 2)
+        self._room_rate = app.conf.get('chat_room_rate', 50)
+        self._room_buckets = {}
+        self._room_buckets_sweep = self.ROOM_BUCKETS_SWEEP
+        if app.conf.get('chat_no_auth'):
+            self.access = None
+        else:
+            self.access = RoomAccess(app, app.conf.get('access_cache_size', 10000), app.conf.get('access_cache_ttl', 60))
+        self.presence = RoomPresence(app)
+        self.history = RoomHistory(app, app.conf.get('chat_history', 50))
+        self._app = app
+        # Shared by every subscription, rather than a bound method each
+        self._on_msg = self.on_msg
+        app.on_redis_reconnect(self._on_redis_reconnect)
+        app.register('chat.join', self.join, {
+            'token': Arg(basestring, max_len=self.TOKEN_LEN),
+            'access': Arg(basestring, optional=True, max_len=self.TOKEN_LEN * 2),
+        })
+        app.register('chat.resume', self.resume, {
+            'session': Arg(basestring, max_len=64),
+            'rooms': Arg(dict, max_len=self.RESUME_ROOMS, keys=Arg(basestring, max_len=self.TOKEN_LEN),
+                         values=Arg(int)),
+        })
+        app.register('chat.part', self.part, {
+            'token': Arg(basestring, max_len=self.TOKEN_LEN),
+        })
+        app.register('chat.sendmsg', self.sendmsg, {
+            'token': Arg(basestring, max_len=self.TOKEN_LEN),
+            'text': Arg(basestring, max_len=self.TEXT_LEN),
+        })
         LOGGER.info('Configured Chat application')
 
 
+    def _on_redis_reconnect(self):
+        if self.access is not None:
+            self.access.clear()
+        self.presence.refresh()
+        self.history.refresh()
+
+
     def has_state(self, enduser):
         return enduser.has('chat')
 
@@ -54,28 +121,212 @@ class ChatApp(object):
         if state is None:
             state = ChatUserState()
             enduser.set('chat', state)
+            enduser.add_cleanup(self._on_close)
         return state
 
 
+    def _on_close(self, enduser):
+        state = self.state(enduser)
+        if state.session is not None and state.rooms:
+            # Remember the rooms for a while so they can be resumed
+            rooms = dict((token, self._save_grant(grant)) for token, (grant, member) in state.rooms.iteritems())
+            future = self._app.pipeline.execute(('setex', 'Resume_%s' % (state.session,), self.RESUME_TTL, json.dumps(rooms)))
+            tornado.ioloop.IOLoop.instance().add_future(future, lambda future: future.result())
+        for token in state.rooms.keys():
+            self._leave(state, token)
+
+
+    def _save_grant(self, grant):
+        if grant is None:
+            return None
+        return {'account': grant.account, 'username': grant.username, 'access': grant.access}
+
+
+    def _leave(self, state, token):
+        """
+        Forget an end-user was in a room they joined
+        """
+        grant, member = state.rooms.pop(token)
+        self.presence.leave(token, member)
+        self.history.leave(token)
+
+
+    def _frame(self, msg):
+        """
+        The 'chat.msg' frame for a pubsub message. `RedisSubscriber` hands
+        the same message to every subscriber in turn, so it's only encoded
+        once however many end-users are in the room.
+        """
+        if msg is not self._last_msg:
+            body = msg.body
+            if isinstance(body, dict) and 'presence' in body:
+                self.presence.apply(msg.channel, body['presence'])
+                frame = EndUserConnection.frame('chat.presence', {
+                    'channel': msg.channel,
+                    'body': body['presence']
+                })
+            else:
+                priority = Frame.LOW
+                if isinstance(body, dict):
+                    self.history.append(msg.channel, body)
+                    if body.get('access') in self.PRIORITY_LEVELS:
+                        priority = Frame.HIGH
+                frame = EndUserConnection.frame('chat.msg', {
+                    'channel': msg.channel,
+                    'body': body
+                }, priority)
+            self._last_frame = frame
+            self._last_msg = msg
+        return self._last_frame
+
+
     def on_msg(self, enduser, msg):
         if msg.kind == 'message':
-            enduser.reply('chat.msg', {
-                'channel': msg.channel,
-                'body': msg.body
-            })
+            enduser.send_frame(self._frame(msg))
 
 
-    def join(self, enduser, token):
-        # TODO: check if enduser is allowed to join
-        enduser.subscribe(token, self.on_msg)
-        return {
+    @tornado.gen.coroutine
+    def _check(self, grant):
+        """
+        The access level for a Grant, None for no access
+        """
+        if self.access is None:
+            raise tornado.gen.Return(self.NO_AUTH_LEVEL)
+        level = None
+        if grant is not None:
+            level = yield self.access.check(grant)
+        raise tornado.gen.Return(level)
+
+
+    @tornado.gen.coroutine
+    def _enter(self, enduser, state, token, grant, level):
+        """
+        Put an end-user in a room, returns its presence list and history
+        """
+        if token in state.rooms:
+            # Already joined
+            raise tornado.gen.Return((self.presence.members(token), self.history.recent(token)))
+        token = intern_channel(token)
+        member = None
+        if grant is not None and grant.account is not None and level != 'G':
+            member = {'id': grant.account, 'name': grant.username, 'access': level}
+        state.rooms[token] = (grant, member)
+        # Subscribe first so no presence diffs or messages are missed
+        enduser.subscribe(token, self._on_msg)
+        # Sent together, except a room's presence list is only read once
+        # Redis has confirmed the subscription
+        futures = [self.presence.join(token, member), self.history.join(token)]
+        try:
+            results = yield futures
+        except:
+            # Undo whichever succeeded, unless the end-user already went away
+            if token in state.rooms:
+                del state.rooms[token]
+                if futures[0].exception() is None:
+                    self.presence.leave(token, member)
+                if futures[1].exception() is None:
+                    self.history.leave(token)
+                enduser.unsubscribe(token)
+            raise
+        raise tornado.gen.Return(results)
+
+
+    def _session(self, state):
+        if state.session is None:
+            state.session = os.urandom(16).encode('hex')
+        return state.session
+
+
+    @tornado.gen.coroutine
+    def join(self, enduser, token, access=None):
+        """
+        Join a room's chat. `access` is the 'RAXS.*' key from Django, or
+        None to join as an anonymous end-user.
+
+        The reply has the room's presence list, recent history, the
+        sequence number of the last message and the session to resume if
+        the end-user gets disconnected.
+        """
+        grant = None
+        if self.access is not None:
+            grant = yield self.access.grant(token, access)
+        level = yield self._check(grant)
+        if level is None:
+            LOGGER.debug("%s: join: access to '%s' denied", enduser.ip, token)
+            raise tornado.gen.Return({
+                'token': token,
+                'join': False
+            })
+        if enduser.is_closed:
+            # Went away while we were checking
+            return
+        state = self.state(enduser)
+        presence, history = yield self._enter(enduser, state, token, grant, level)
+        raise tornado.gen.Return({
             'token': token,
-            'join': True
-        }
+            'join': True,
+            'presence': presence,
+            'history': history,
+            'seq': self.history.seq(token),
+            'session': self._session(state)
+        })
+
+
+    @tornado.gen.coroutine
+    def _resume_room(self, enduser, state, token, grant, seq):
+        level = yield self._check(grant)
+        if level is None or enduser.is_closed:
+            raise tornado.gen.Return({'resumed': False})
+        presence, history = yield self._enter(enduser, state, token, grant, level)
+        missed, complete = self.history.missed(token, seq)
+        raise tornado.gen.Return({
+            'resumed': True,
+            'presence': presence,
+            'missed': missed,
+            'complete': complete,
+            'seq': self.history.seq(token)
+        })
+
+
+    @tornado.gen.coroutine
+    def resume(self, enduser, session, rooms):
+        """
+        Rejoin the rooms of a session after reconnecting. `rooms` maps each
+        room token to the sequence number of the last message received, the
+        reply has the messages sent since then for each room that could be
+        resumed. 'complete' is false if some of them are no longer kept.
+        Rooms which can't be resumed have to be joined again.
+        """
+        key = 'Resume_%s' % (session,)
+        results = yield self._app.pipeline.execute(('get', key), ('delete', key))
+        if not results[0] or enduser.is_closed:
+            raise tornado.gen.Return({
+                'session': session,
+                'resumed': False
+            })
+        saved = json.loads(results[0])
+        state = self.state(enduser)
+        state.session = session
+        tokens = [token for token in rooms if token in saved]
+        grants = [Grant(token, **saved[token]) if saved[token] is not None else None for token in tokens]
+        replies = yield [self._resume_room(enduser, state, token, grant, int(rooms[token]))
+                         for token, grant in zip(tokens, grants)]
+        replies = dict(zip(tokens, replies))
+        for token in rooms:
+            replies.setdefault(token, {'resumed': False})
+        raise tornado.gen.Return({
+            'session': session,
+            'resumed': True,
+            'rooms': replies
+        })
 
 
     def part(self, enduser, token):
         # TODO: check if enduer is in room
+        if self.has_state(enduser):
+            state = self.state(enduser)
+            if token in state.rooms:
+                self._leave(state, token)
         enduser.unsubscribe(token)
         return {
             'token': token,
@@ -83,13 +334,97 @@ class ChatApp(object):
         }
 
 
+    def _sweep_room_buckets(self, now):
+        """
+        Forget rooms whose buckets have refilled, they're the same as new.
+        Amortised over many messages as the threshold doubles with the
+        number of busy rooms.
+        """
+        buckets = self._room_buckets
+        for token in [token for token, bucket in buckets.iteritems() if bucket.is_idle(now)]:
+            del buckets[token]
+        self._room_buckets_sweep = max(self.ROOM_BUCKETS_SWEEP, len(buckets) * 2)
+
+
+    def _allow_send(self, enduser, token):
+        """
+        Check the end-user and room message rate limits, returns the
+        name of the limit which was hit or None.
+        """
+        now = time.time()
+        state = self.state(enduser)
+        if self._user_rate:
+            if state.bucket is None:
+                state.bucket = TokenBucket(self._user_rate, self.USER_BURST)
+            if not state.bucket.consume(now=now):
+                return 'user'
+        if self._room_rate:
+            bucket = self._room_buckets.get(token)
+            if bucket is None:
+                if len(self._room_buckets) >= self._room_buckets_sweep:
+                    self._sweep_room_buckets(now)
+                bucket = self._room_buckets[token] = TokenBucket(self._room_rate, self.ROOM_BURST)
+            if not bucket.consume(now=now):
+                return 'room'
+        return None
+
+
     def sendmsg(self, enduser, token, text):
-        # TODO: check if enduser is in allowed to post
+        """
+        Send a message to a room's chat. The end-user's access is normally
+        cached, otherwise it's checked asynchronously.
+        """
         # TODO: map token to channel
-        enduser.publish(token, {
-            "text": text
-        })
+        if self.access is None:
+            return self._sendmsg(enduser, token, text, self.NO_AUTH_LEVEL)
+        state = self.state(enduser)
+        if token not in state.rooms:
+            return self._denied(enduser, token)
+        grant = state.rooms[token][0]
+        level = self.access.cached(grant)
+        if level is MISSING:
+            return self._sendmsg_checked(enduser, token, text, grant)
+        if level not in RoomAccess.SEND_LEVELS:
+            return self._denied(enduser, token)
+        return self._sendmsg(enduser, token, text, level)
+
+
+    @tornado.gen.coroutine
+    def _sendmsg_checked(self, enduser, token, text, grant):
+        level = yield self.access.check(grant)
+        if level not in RoomAccess.SEND_LEVELS:
+            raise tornado.gen.Return(self._denied(enduser, token))
+        raise tornado.gen.Return(self._sendmsg(enduser, token, text, level))
+
+
+    def _denied(self, enduser, token):
+        LOGGER.debug("%s: sendmsg: not allowed to send to '%s'", enduser.ip, token)
+        return {
+            'token': token,
+            'sent': False,
+            'denied': True
+        }
+
+
+    def _sendmsg(self, enduser, token, text, level):
+        """
+        `level` is the sender's access level, recorded in the message so
+        every server gives it the same priority
+        """
+        limited = self._allow_send(enduser, token)
+        if limited is not None:
+            LOGGER.debug("%s: sendmsg: %s rate limit hit for '%s'", enduser.ip, limited, token)
+            return {
+                'token': token,
+                'sent': False,
+                'limited': limited
+            }
+        msg = {
+            "text": text,
+            "access": level
+        }
+        self.history.send(token, msg)
         return {
             'token': token,
             'sent': True
-        }
\ No newline at end of file
+        }
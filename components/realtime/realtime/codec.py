@@ -0,0 +1,93 @@
+"""
+How messages between end-users and the `RealtimeServer` are serialized.
+
+Everyone speaks JSON over SockJS. Clients on the raw websocket endpoint
+('/realtime/websocket') can ask for the 'msgpack' subprotocol instead, then
+the same messages go both ways as MessagePack in binary frames.
+"""
+
+__all__ = ('JSON', 'MSGPACK', 'CODECS')
+
+import json, struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec(object):
+    name = 'json'
+    binary = False
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+
+    def decode(self, raw):
+        """
+        Raises ValueError if it's not valid
+        """
+        return json.loads(raw)
+
+
+    def frame(self, frame):
+        return frame.text
+
+
+    def batch(self, payloads):
+        """
+        Several encoded messages as one array
+        """
+        return '[' + ','.join(payloads) + ']'
+
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, obj):
+        # Without use_bin_type Python 2 str goes out as a string, not bytes
+        return msgpack.packb(obj, use_bin_type=False)
+
+
+    def decode(self, raw):
+        """
+        Raises ValueError if it's not valid
+        """
+        if not isinstance(raw, str):
+            # A text frame
+            raise ValueError("not a binary message")
+        try:
+            return msgpack.unpackb(raw, raw=False)
+        except Exception as ex:
+            raise ValueError(str(ex))
+
+
+    def frame(self, frame):
+        return frame.packed
+
+
+    def batch(self, payloads):
+        """
+        Several encoded messages as one array, a MessagePack array is just
+        a header followed by its items.
+        """
+        count = len(payloads)
+        if count < 16:
+            header = chr(0x90 | count)
+        elif count < 0x10000:
+            header = struct.pack('>BH', 0xdc, count)
+        else:
+            header = struct.pack('>BI', 0xdd, count)
+        return header + ''.join(payloads)
+
+
+
+JSON = JsonCodec()
+# None when the msgpack package isn't installed
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+# Websocket subprotocol -> codec
+CODECS = dict((codec.name, codec) for codec in (JSON, MSGPACK) if codec is not None)
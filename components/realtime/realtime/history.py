@@ -0,0 +1,211 @@
+__all__ = ('RoomHistory',)
+
+import collections, json, logging
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+LOGGER = logging.getLogger()
+
+
+# Number the message, keep it in the history and publish it
+# KEYS: sequence, history  ARGV: message JSON, Redis channel, channel for '_c'
+#                                or '', history size, expiry
+SEND_SCRIPT = """
+local seq = redis.call('incr', KEYS[1])
+redis.call('expire', KEYS[1], ARGV[5])
+local body = cjson.decode(ARGV[1])
+body['seq'] = seq
+local msg = cjson.encode(body)
+if tonumber(ARGV[4]) > 0 then
+    redis.call('rpush', KEYS[2], msg)
+    redis.call('ltrim', KEYS[2], -tonumber(ARGV[4]), -1)
+    redis.call('expire', KEYS[2], ARGV[5])
+end
+if ARGV[3] ~= '' then
+    body['_c'] = ARGV[3]
+    msg = cjson.encode(body)
+end
+redis.call('publish', ARGV[2], msg)
+return seq
+"""
+
+
+class RoomHistory(object):
+    """
+    Numbers the messages sent to each room and keeps the last `size` of
+    them, so end-users who join late have something to look at and those
+    who reconnect can be sent what they missed.
+
+    Messages are sent by a Lua script which takes the next number from
+    'Room_<token>_Seq', stores the message as 'seq' in it, appends it to the
+    'Room_<token>_History' list (trimmed to `size`) and publishes it. Every
+    server, including the sender's, gets it back from Redis, so they all
+    see a room's messages in the same order.
+
+    Servers keep the same tail in memory for rooms they have end-users in,
+    fetched from Redis by the first join and then added to as messages
+    arrive on the room's channel. Any number of joins while that first
+    fetch is in flight share it.
+    """
+    # Forget rooms nobody has sent to for a day
+    EXPIRE = 24 * 60 * 60
+
+    def __init__(self, app, size=50):
+        self._app = app
+        self.size = size
+        # Room token -> deque of messages, for rooms with local end-users
+        self._tails = {}
+        # Room token -> the last sequence number seen
+        self._seqs = {}
+        # Room token -> Future of the fetch from Redis
+        self._fetching = {}
+        # Room token -> messages which arrived during the fetch
+        self._early = {}
+        # Room token -> number of local end-users joined
+        self._local = {}
+
+
+    def _keys(self, room):
+        return ['Room_%s_Seq' % (room,), 'Room_%s_History' % (room,)]
+
+
+    def send(self, room, msg):
+        """
+        Send a message to the room, returns a Future for its sequence number
+        """
+        sub = self._app.sub
+        if self._app.metrics is not None:
+            self._app.metrics.published += 1
+        future = self._app.pipeline.execute(('eval', SEND_SCRIPT, self._keys(room),
+                                             [json.dumps(msg), sub.shard(room), room if sub.shards else '',
+                                              self.size, self.EXPIRE]))
+        tornado.ioloop.IOLoop.instance().add_future(future, lambda future: future.result())
+        return future
+
+
+    def append(self, room, msg):
+        """
+        A message arrived on the room's channel
+        """
+        seq = msg.get('seq')
+        if not isinstance(seq, (int, long)):
+            return
+        if room in self._fetching:
+            self._early[room].append(msg)
+            return
+        if room not in self._seqs or seq <= self._seqs[room]:
+            # Not for a room with local end-users, or already seen
+            return
+        self._seqs[room] = seq
+        self._tails[room].append(msg)
+
+
+    def seq(self, room):
+        """
+        The last sequence number of a room with local end-users
+        """
+        return self._seqs.get(room, 0)
+
+
+    def recent(self, room):
+        """
+        The recent messages of a room with local end-users
+        """
+        return list(self._tails.get(room, ()))
+
+
+    @tornado.gen.coroutine
+    def join(self, room):
+        """
+        An end-user joined the room, returns its recent messages
+        """
+        self._local[room] = self._local.get(room, 0) + 1
+        if room not in self._seqs:
+            fetching = self._fetching.get(room)
+            if fetching is None:
+                fetching = self._fetching[room] = self._fetch(room)
+                self._early[room] = []
+            try:
+                yield fetching
+            except:
+                self.leave(room)
+                raise
+        raise tornado.gen.Return(self.recent(room))
+
+
+    @tornado.gen.coroutine
+    def _fetch(self, room):
+        """
+        Read the room's tail once its channel is subscribed to, the messages
+        which arrive before it are added after, so none are missed.
+        """
+        keys = self._keys(room)
+        commands = [('get', keys[0])]
+        if self.size:
+            commands.append(('lrange', keys[1], -self.size, -1))
+        try:
+            yield self._app.sub.subscribed(room)
+            results = yield self._app.pipeline.execute(*commands)
+        finally:
+            self._fetching.pop(room, None)
+            early = self._early.pop(room, [])
+        if room not in self._local:
+            return
+        seq = int(results[0] or 0)
+        tail = collections.deque((json.loads(msg) for msg in results[1]) if self.size else (), self.size)
+        if tail:
+            seq = max(seq, tail[-1]['seq'])
+        for msg in early:
+            if msg['seq'] > seq:
+                seq = msg['seq']
+                tail.append(msg)
+        self._seqs[room] = seq
+        self._tails[room] = tail
+
+
+    def refresh(self):
+        """
+        Fetch messages which may have been missed while the pubsub connection
+        was down, they're handed to the local end-users as if just received.
+        """
+        if not self.size:
+            return
+        for room in self._seqs.keys():
+            tornado.ioloop.IOLoop.instance().add_future(self._catch_up(room), lambda future: future.result())
+
+
+    @tornado.gen.coroutine
+    def _catch_up(self, room):
+        yield self._app.sub.subscribed(room)
+        results = yield self._app.pipeline.execute(('lrange', self._keys(room)[1], -self.size, -1))
+        for msg in (json.loads(msg) for msg in results[0]):
+            if room in self._seqs and msg['seq'] > self._seqs[room]:
+                self._app.sub.dispatch(room, msg)
+
+
+    def missed(self, room, seq):
+        """
+        The messages an end-user missed if the last they got was `seq`,
+        and whether they're all still there
+        """
+        last = self.seq(room)
+        if seq == last:
+            return [], True
+        missed = [msg for msg in self._tails.get(room, ()) if msg['seq'] > seq]
+        complete = seq < last and [msg['seq'] for msg in missed] == range(seq + 1, last + 1)
+        return missed, complete
+
+
+    def leave(self, room):
+        """
+        An end-user left the room, or went away
+        """
+        count = self._local.get(room, 0) - 1
+        if count > 0:
+            self._local[room] = count
+        else:
+            self._local.pop(room, None)
+            self._tails.pop(room, None)
+            self._seqs.pop(room, None)
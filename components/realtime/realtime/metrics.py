@@ -0,0 +1,146 @@
+__all__ = ('Metrics', 'StatsHandler')
+
+import json, time
+
+import tornado.ioloop
+import tornado.web
+
+
+class Metrics(object):
+    """
+    Counters and timings for the hot paths of the `RealtimeServer`.
+
+    Updating a counter is a single attribute increment. When stats are
+    disabled the server has no `Metrics` at all and the hot paths skip
+    them with an `is not None` check, so there's no cost.
+
+    Once a second the IOLoop lag (how late a timer fires) is sampled and
+    the per-second rates of the counters are worked out.
+    """
+    COUNTERS = ('rpc_in', 'rpc_rejected', 'frames_out', 'frames_dropped', 'pubsub_in', 'published', 'sessions_opened', 'sessions_closed')
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.rpc_in = 0
+        self.rpc_rejected = 0
+        self.frames_out = 0
+        self.frames_dropped = 0
+        self.pubsub_in = 0
+        self.published = 0
+        self.sessions_opened = 0
+        self.sessions_closed = 0
+        # Command name -> [count, total seconds, max seconds]
+        self.commands = {}
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+        self.rates = dict((name, 0.0) for name in self.COUNTERS)
+        self._last = None
+        self._expected = None
+
+
+    def command(self, name, elapsed):
+        """
+        Record how long a handler for the RPC command took
+        """
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+
+    def start(self):
+        """
+        Start sampling, the IOLoop must not be started before forking so
+        this is called by each worker.
+        """
+        ioloop = tornado.ioloop.IOLoop.instance()
+        self._last = (ioloop.time(), self._counters())
+        self._expected = ioloop.time() + self.interval
+        ioloop.add_timeout(self._expected, self._sample)
+
+
+    def _counters(self):
+        return [getattr(self, name) for name in self.COUNTERS]
+
+
+    def _sample(self):
+        ioloop = tornado.ioloop.IOLoop.instance()
+        now = ioloop.time()
+        self.loop_lag = max(0.0, now - self._expected)
+        self.loop_lag_max = max(self.loop_lag_max, self.loop_lag)
+
+        then, last = self._last
+        counters = self._counters()
+        elapsed = (now - then) or self.interval
+        for name, value, previous in zip(self.COUNTERS, counters, last):
+            self.rates[name] = (value - previous) / elapsed
+        self._last = (now, counters)
+
+        self._expected = now + self.interval
+        ioloop.add_timeout(self._expected, self._sample)
+
+
+    def snapshot(self, server):
+        """
+        All the stats, including gauges read from the server, as a dict
+        """
+        sub = server.sub
+        return {
+            'time': time.time(),
+            'worker': server.worker_id,
+            'sessions': self.sessions_opened - self.sessions_closed,
+            'draining': int(server.draining),
+            'channels': len(sub.subs),
+            'redis_subscriptions': len(sub._shard_subs) if sub.shards else len(sub.subs),
+            'publish_queue': len(sub._publish_queue),
+            'loop_lag': self.loop_lag,
+            'loop_lag_max': self.loop_lag_max,
+            'counters': dict(zip(self.COUNTERS, self._counters())),
+            'rates': dict(self.rates),
+            'commands': dict((name, {'count': count, 'total': total, 'max': slowest})
+                             for name, (count, total, slowest) in self.commands.items()),
+        }
+
+
+    def prometheus(self, server):
+        """
+        The stats in the Prometheus text exposition format
+        """
+        snap = self.snapshot(server)
+        lines = []
+        def metric(name, kind, value, labels=''):
+            if kind is not None:
+                lines.append('# TYPE camaste_realtime_%s %s' % (name, kind))
+            lines.append('camaste_realtime_%s%s %s' % (name, labels, repr(float(value))))
+        for name in ('sessions', 'draining', 'channels', 'redis_subscriptions', 'publish_queue', 'loop_lag', 'loop_lag_max'):
+            metric(name, 'gauge', snap[name])
+        for name, value in sorted(snap['counters'].items()):
+            metric(name + '_total', 'counter', value)
+        if snap['commands']:
+            lines.append('# TYPE camaste_realtime_command_seconds summary')
+        for name, stats in sorted(snap['commands'].items()):
+            labels = '{command="%s"}' % (name.replace('\\', '\\\\').replace('"', '\\"'),)
+            metric('command_seconds_count', None, stats['count'], labels)
+            metric('command_seconds_sum', None, stats['total'], labels)
+        return '\n'.join(lines) + '\n'
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    """
+    Serves the `Metrics` as JSON, or as Prometheus text with ?format=prometheus
+    """
+    def initialize(self, server):
+        self.server = server
+
+    def get(self):
+        metrics = self.server.metrics
+        self.set_header('Cache-Control', 'no-cache')
+        if self.get_argument('format', None) == 'prometheus':
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.write(metrics.prometheus(self.server))
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(metrics.snapshot(self.server)))
@@ -0,0 +1,132 @@
+__all__ = ('CommandPipeline',)
+
+import functools, logging, zlib
+
+from tornado import stack_context
+import tornado.concurrent
+import tornado.ioloop
+
+LOGGER = logging.getLogger()
+
+
+
+class _Lane(object):
+    """
+    One connection of a `CommandPipeline`
+    """
+    def __init__(self, client):
+        self.client = client
+        self.queue = []
+        self.scheduled = False
+        self.running = None
+
+
+    def add(self, commands, future):
+        self.queue.append((commands, future))
+        if not self.scheduled:
+            self.scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.flush)
+
+
+    def flush(self):
+        self.scheduled = False
+        if self.running is not None or not self.queue:
+            return
+        batch = self.queue
+        self.queue = []
+        pipe = self.client.pipeline()
+        for commands, future in batch:
+            for command in commands:
+                getattr(pipe, command[0])(*command[1:])
+        self.running = batch
+        with stack_context.ExceptionStackContext(functools.partial(self._on_error, batch)):
+            pipe.execute(callback=functools.partial(self._on_results, batch))
+
+
+    def _on_results(self, batch, results):
+        if self.running is not batch:
+            return
+        self.running = None
+        offset = 0
+        for commands, future in batch:
+            mine = results[offset:offset + len(commands)]
+            offset += len(commands)
+            errors = [result for result in mine if isinstance(result, Exception)]
+            if errors:
+                future.set_exception(errors[0])
+            else:
+                future.set_result(mine)
+        # Commands queued while the pipeline was in flight
+        if self.queue:
+            self.flush()
+
+
+    def _on_error(self, batch, typ, value, tb):
+        LOGGER.error("_on_error: Redis command pipeline failed", exc_info=(typ, value, tb))
+        if self.running is batch:
+            self.running = None
+        for commands, future in batch:
+            if not future.done():
+                future.set_exc_info((typ, value, tb))
+        # The client reconnects when it's next used
+        if self.queue and not self.scheduled:
+            self.scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.flush)
+        return True
+
+
+
+class CommandPipeline(object):
+    """
+    Runs ordinary Redis commands (GET, HGET...) for many callers over a
+    small pool of tornadoredis clients, separate from the pubsub connection.
+
+    tornadoredis can't have two commands in flight on one connection, so
+    callers queue their commands and get a Future back. Everything queued
+    for a connection during an IOLoop iteration is sent as one pipeline,
+    with at most one pipeline in flight on each, just like `RedisSubscriber`
+    does for PUBLISH.
+
+    Commands go to a connection picked by the first key they use, so those
+    for the same key are always run in the order they were queued.
+    """
+    def __init__(self, clients):
+        self._lanes = [_Lane(client) for client in clients]
+
+
+    @property
+    def pending(self):
+        """
+        Number of callers whose commands haven't finished
+        """
+        return sum(len(lane.queue) + len(lane.running or ()) for lane in self._lanes)
+
+
+    @staticmethod
+    def _key(command):
+        if command[0] == 'eval':
+            # ('eval', script, keys, args)
+            return command[2][0] if len(command) > 2 and command[2] else ''
+        return command[1] if len(command) > 1 else ''
+
+
+    def execute(self, *commands):
+        """
+        Queue commands, each a tuple of the tornadoredis method name and its
+        arguments, e.g. ('hget', 'key', 'field'). Returns a Future for the
+        list of their results.
+        """
+        future = tornado.concurrent.Future()
+        if not commands:
+            future.set_result([])
+            return future
+        lanes = self._lanes
+        if len(lanes) == 1:
+            lane = lanes[0]
+        else:
+            key = self._key(commands[0])
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            lane = lanes[(zlib.crc32(str(key)) & 0xffffffff) % len(lanes)]
+        lane.add(commands, future)
+        return future
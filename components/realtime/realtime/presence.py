@@ -0,0 +1,294 @@
+__all__ = ('RoomPresence',)
+
+import json, logging, time
+
+import tornado.gen
+import tornado.ioloop
+
+LOGGER = logging.getLogger()
+
+
+# Count a connection for the member, and announce them if it's their first.
+# The node's own count for them is kept too, for `reap` if the node dies.
+# KEYS: counts hash, info hash, node hash, nodes sorted set
+# ARGV: member id, info JSON, channel, diff JSON, node field, unix time, node id
+JOIN_SCRIPT = """
+redis.call('zadd', KEYS[4], ARGV[6], ARGV[7])
+redis.call('hincrby', KEYS[3], ARGV[5], 1)
+local count = redis.call('hincrby', KEYS[1], ARGV[1], 1)
+if count == 1 then
+    redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('publish', ARGV[3], ARGV[4])
+end
+return count
+"""
+
+# Forget a connection for the member, and announce they left if it was their last
+# KEYS: counts hash, info hash, node hash  ARGV: member id, channel, diff JSON, node field
+LEAVE_SCRIPT = """
+local mine = redis.call('hincrby', KEYS[3], ARGV[4], -1)
+if mine <= 0 then
+    redis.call('hdel', KEYS[3], ARGV[4])
+    if mine < 0 then
+        -- Already forgotten by `reap`, the node was taken for dead
+        return -1
+    end
+end
+local count = redis.call('hincrby', KEYS[1], ARGV[1], -1)
+if count <= 0 then
+    redis.call('hdel', KEYS[1], ARGV[1])
+    redis.call('hdel', KEYS[2], ARGV[1])
+    redis.call('publish', ARGV[2], ARGV[3])
+end
+return count
+"""
+
+# Forget all of a dead node's connections for the member, as LEAVE_SCRIPT
+# would have. Running it twice is harmless.
+# KEYS: counts hash, info hash, the dead node's hash
+# ARGV: member id, channel, diff JSON, node field
+REAP_SCRIPT = """
+local gone = tonumber(redis.call('hget', KEYS[3], ARGV[4]) or 0)
+redis.call('hdel', KEYS[3], ARGV[4])
+if gone <= 0 then
+    return 0
+end
+local count = redis.call('hincrby', KEYS[1], ARGV[1], -gone)
+if count <= 0 then
+    redis.call('hdel', KEYS[1], ARGV[1])
+    redis.call('hdel', KEYS[2], ARGV[1])
+    redis.call('publish', ARGV[2], ARGV[3])
+end
+return gone
+"""
+
+
+class RoomPresence(object):
+    """
+    Who is in each room, shared by all the realtime servers through Redis.
+
+    'Room_<token>_Online' counts each member's connections across every
+    server and 'Room_<token>_Online_Info' holds what is shown for them. A
+    member is added on their first connection and removed after their last,
+    and only then is a diff, `{"presence": {"add": [...]}}` or
+    `{"presence": {"remove": [...]}}`, published on the room's channel.
+
+    Servers keep a mirror of the list for each room they have end-users in,
+    built from Redis by the first join and kept up to date by the diffs. An
+    end-user gets the whole list once, when they join.
+
+    Each server process (node) also counts its own connections to each room
+    and member in 'Presence_Node_<id>', and sends a heartbeat to the
+    'Presence_Nodes' sorted set. Nodes which stop, without draining, are
+    reaped by the others after NODE_TIMEOUT, and their members leave.
+    """
+    NODES = 'Presence_Nodes'
+    # Seconds between heartbeats, and without them before a node is reaped
+    HEARTBEAT = 10
+    NODE_TIMEOUT = 60
+    # Dead nodes reaped by each heartbeat
+    REAP_NODES = 10
+
+    def __init__(self, app):
+        self._app = app
+        # Room token -> {member id: info}, for rooms with local members
+        self._mirror = {}
+        # Room token -> Future of the fetch of its list from Redis
+        self._fetching = {}
+        # Room token -> diffs which arrived during the fetch
+        self._early = {}
+        # Room token -> number of local end-users joined
+        self._local = {}
+        self._heartbeat = None
+
+
+    def _keys(self, room):
+        return ['Room_%s_Online' % (room,), 'Room_%s_Online_Info' % (room,)]
+
+
+    def _node_key(self, node=None):
+        return 'Presence_Node_%s' % (node or self._app.sub.node_id,)
+
+
+    def _node_field(self, room, id):
+        return u'%s %d' % (room, id)
+
+
+    def _diff(self, room, diff):
+        """
+        The Redis channel and encoded message for a presence diff
+        """
+        sub = self._app.sub
+        body = {'presence': diff}
+        if sub.shards:
+            body['_c'] = room
+        return sub.shard(room), json.dumps(body)
+
+
+    def _start(self):
+        """
+        Start the heartbeats, done on first use as the server isn't set up
+        until after the apps are configured
+        """
+        if self._heartbeat is None:
+            self._heartbeat = tornado.ioloop.PeriodicCallback(self._beat, self.HEARTBEAT * 1000)
+            self._heartbeat.start()
+
+
+    @tornado.gen.coroutine
+    def join(self, room, member):
+        """
+        Count an end-user as being in the room, returns the member list.
+        `member` is a dict with an 'id', or None to not list the end-user.
+        """
+        self._start()
+        futures = []
+        if member is not None:
+            channel, diff = self._diff(room, {'add': [member]})
+            keys = self._keys(room) + [self._node_key(), self.NODES]
+            args = [member['id'], json.dumps(member), channel, diff, self._node_field(room, member['id']),
+                    int(time.time()), self._app.sub.node_id]
+            futures.append(self._app.pipeline.execute(('eval', JOIN_SCRIPT, keys, args)))
+        self._local[room] = self._local.get(room, 0) + 1
+        if room not in self._mirror:
+            fetching = self._fetching.get(room)
+            if fetching is None:
+                fetching = self._fetching[room] = self._fetch(room)
+                self._early[room] = []
+            futures.append(fetching)
+        try:
+            yield futures
+        except:
+            self._leave_local(room)
+            raise
+        mirror = self._mirror.get(room, {})
+        if member is not None:
+            mirror.setdefault(member['id'], member)
+        raise tornado.gen.Return(mirror.values())
+
+
+    @tornado.gen.coroutine
+    def _fetch(self, room):
+        """
+        Build the mirror of a room's list. It's read once the room's channel
+        is subscribed to, and the diffs which arrive before it are applied
+        over it, so none are missed.
+        """
+        try:
+            yield self._app.sub.subscribed(room)
+            results = yield self._app.pipeline.execute(('hgetall', self._keys(room)[1]))
+        finally:
+            self._fetching.pop(room, None)
+            early = self._early.pop(room, [])
+        if room not in self._local:
+            return
+        mirror = self._mirror[room] = dict((int(id), json.loads(info)) for id, info in results[0].iteritems())
+        for diff in early:
+            self._apply(mirror, diff)
+
+
+    def leave(self, room, member):
+        """
+        An end-user has left the room, or gone away
+        """
+        self._leave_local(room)
+        if member is None:
+            return
+        channel, diff = self._diff(room, {'remove': [member['id']]})
+        future = self._app.pipeline.execute(('eval', LEAVE_SCRIPT, self._keys(room) + [self._node_key()],
+                                             [member['id'], channel, diff, self._node_field(room, member['id'])]))
+        # Nobody is waiting on it, have any errors logged
+        tornado.ioloop.IOLoop.instance().add_future(future, lambda future: future.result())
+
+
+    def _leave_local(self, room):
+        count = self._local.get(room, 0) - 1
+        if count > 0:
+            self._local[room] = count
+        else:
+            self._local.pop(room, None)
+            self._mirror.pop(room, None)
+
+
+    def members(self, room):
+        """
+        The member list of a room with local end-users
+        """
+        return self._mirror.get(room, {}).values()
+
+
+    def refresh(self):
+        """
+        Fetch the member lists again, after diffs may have been missed. The
+        new lists are sent to the local end-users as a 'reset' diff.
+        """
+        for room in set(self._mirror) | set(self._fetching):
+            tornado.ioloop.IOLoop.instance().add_future(self._refresh(room), lambda future: future.result())
+
+
+    @tornado.gen.coroutine
+    def _refresh(self, room):
+        yield self._app.sub.subscribed(room)
+        results = yield self._app.pipeline.execute(('hgetall', self._keys(room)[1]))
+        if room in self._local:
+            members = [json.loads(info) for info in results[0].itervalues()]
+            self._app.sub.dispatch(room, {'presence': {'reset': members}})
+
+
+    def apply(self, room, diff):
+        """
+        Update the mirror with a diff received from the room's channel
+        """
+        if room in self._fetching:
+            self._early[room].append(diff)
+            return
+        mirror = self._mirror.get(room)
+        if mirror is not None:
+            self._apply(mirror, diff)
+
+
+    def _apply(self, mirror, diff):
+        if 'reset' in diff:
+            mirror.clear()
+            for member in diff['reset']:
+                mirror[member['id']] = member
+        for member in diff.get('add', ()):
+            mirror[member['id']] = member
+        for id in diff.get('remove', ()):
+            mirror.pop(id, None)
+
+
+    def _beat(self):
+        tornado.ioloop.IOLoop.instance().add_future(self._beat_and_reap(), lambda future: future.result())
+
+
+    @tornado.gen.coroutine
+    def _beat_and_reap(self):
+        now = time.time()
+        results = yield self._app.pipeline.execute(
+            ('zadd', self.NODES, int(now), self._app.sub.node_id),
+            ('zrangebyscore', self.NODES, '-inf', '(%d' % (now - self.NODE_TIMEOUT,), 0, self.REAP_NODES))
+        for node in results[1]:
+            yield self.reap(node)
+
+
+    @tornado.gen.coroutine
+    def reap(self, node):
+        """
+        Take a dead node's end-users out of their rooms, announcing the
+        members who have no connections left
+        """
+        results = yield self._app.pipeline.execute(('hgetall', self._node_key(node)))
+        commands = []
+        for field in results[0]:
+            room, id = field.rsplit(' ', 1)
+            id = int(id)
+            channel, diff = self._diff(room, {'remove': [id]})
+            commands.append(('eval', REAP_SCRIPT, self._keys(room) + [self._node_key(node)],
+                             [id, channel, diff, field]))
+        if commands:
+            yield self._app.pipeline.execute(*commands)
+        # The node's hash went when its last field did
+        yield self._app.pipeline.execute(('zrem', self.NODES, node))
+        LOGGER.warning("reap: Node %s stopped sending heartbeats, took its %d members out of their rooms",
+                       node, len(commands))
@@ -0,0 +1,46 @@
+__all__ = ('TokenBucket',)
+
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average, with bursts of up to `burst`.
+    Tokens are refilled lazily when consumed, so there's nothing to schedule
+    and each check is O(1).
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+
+    def _refill(self, now):
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.tokens = tokens
+        self.stamp = now
+
+
+    def consume(self, amount=1, now=None):
+        """
+        Take `amount` tokens from the bucket, returns False if there
+        aren't enough.
+        """
+        self._refill(time.time() if now is None else now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+    def is_idle(self, now=None):
+        """
+        Has the bucket refilled completely? If so it's the same as a new one.
+        """
+        self._refill(time.time() if now is None else now)
+        return self.tokens >= self.burst
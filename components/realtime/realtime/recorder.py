@@ -0,0 +1,131 @@
+__all__ = ('Recorder', 'read_recording')
+
+import json, logging, os, time
+
+import tornado.ioloop
+
+LOGGER = logging.getLogger()
+
+
+class Recorder(object):
+    """
+    Appends the traffic arriving at the server to a file, so it can be fed
+    back into another one with `bench.replay`.
+
+    The file is one compact JSON array per line, the first item is the
+    number of milliseconds since the recording started:
+
+        [ms, "o", conn]               an end-user connected
+        [ms, "c", conn]               an end-user disconnected
+        [ms, "r", conn, call, args]   an end-user called `call`
+        [ms, "p", channel, body]      a pubsub message arrived from Redis
+
+    `conn` numbers the end-users' connections. Each time the server starts
+    it adds a header line, {"version": 1, "started": unix time, "pid": pid},
+    and the numbers and milliseconds after it are relative to that.
+
+    Lines are buffered and written once a second, or sooner when there
+    are lots of them, so it costs one write for many messages.
+    """
+    VERSION = 1
+    FLUSH_INTERVAL = 1.0
+    FLUSH_LINES = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._started = time.time()
+        self._lines = []
+        # EndUserConnection -> its number in the recording
+        self._conns = {}
+        self._next_conn = 0
+        self._timer = None
+        self._lines.append(json.dumps({'version': self.VERSION, 'started': self._started, 'pid': os.getpid()}))
+
+
+    def start(self):
+        self._timer = tornado.ioloop.PeriodicCallback(self.flush, self.FLUSH_INTERVAL * 1000)
+        self._timer.start()
+
+
+    def _append(self, record):
+        self._lines.append(json.dumps(record, separators=(',', ':')))
+        if len(self._lines) >= self.FLUSH_LINES:
+            self.flush()
+
+
+    def _ms(self):
+        return int((time.time() - self._started) * 1000)
+
+
+    def opened(self, conn):
+        self._next_conn += 1
+        self._conns[conn] = self._next_conn
+        self._append([self._ms(), 'o', self._next_conn])
+
+
+    def closed(self, conn):
+        number = self._conns.pop(conn, None)
+        if number is not None:
+            self._append([self._ms(), 'c', number])
+
+
+    def rpc(self, conn, call, args):
+        number = self._conns.get(conn)
+        if number is not None:
+            self._append([self._ms(), 'r', number, call, args])
+
+
+    def pubsub(self, channel, body):
+        self._append([self._ms(), 'p', channel, body])
+
+
+    def flush(self):
+        if not self._lines:
+            return
+        data = '\n'.join(self._lines) + '\n'
+        self._lines = []
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except (IOError, OSError):
+            LOGGER.exception("flush: can't write to recording %s", self.path)
+
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        self.flush()
+        self._file.close()
+
+
+
+def read_recording(path):
+    """
+    Yield the records of a file written by `Recorder` in order, with the
+    time as unix seconds and the connection numbers as (start, number)
+    so they're unique when the server was restarted.
+    """
+    started = None
+    with open(path, 'rb') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line of a recording which was still being written
+                LOGGER.warning("read_recording: skipping a bad line in %s", path)
+                continue
+            if isinstance(record, dict):
+                if record.get('version') != Recorder.VERSION:
+                    raise ValueError('%s: unsupported recording version %r' % (path, record.get('version')))
+                started = record['started']
+                continue
+            if started is None:
+                raise ValueError('%s: not a recording, no header' % (path,))
+            record[0] = started + record[0] / 1000.0
+            if record[1] != 'p':
+                record[2] = (started, record[2])
+            yield record
@@ -0,0 +1,100 @@
+__all__ = ('Arg', 'compile_schema')
+
+MISSING = object()
+
+# JSON gives unicode strings and ints or longs, so the types in a
+# schema are widened to match
+_WIDEN = {
+    str: (basestring,),
+    unicode: (basestring,),
+    int: (int, long),
+    long: (int, long),
+    float: (int, long, float),
+}
+
+
+class Arg(object):
+    """
+    One argument of an RPC command, for `compile_schema`.
+
+    `types` is a type or tuple of them. `max_len` limits the length of
+    strings, lists and dicts. `keys` and `values` are `Arg`s for the keys
+    and values of a dict, `values` also for the items of a list. Optional
+    arguments may be left out or null.
+    """
+    __slots__ = ('types', 'optional', 'max_len', 'keys', 'values')
+
+    def __init__(self, types, optional=False, max_len=None, keys=None, values=None):
+        self.types = types
+        self.optional = optional
+        self.max_len = max_len
+        self.keys = keys
+        self.values = values
+
+
+
+def _compile(arg):
+    """
+    A function returning None if a value matches the `Arg`, otherwise
+    what's wrong with it. Checks which the `Arg` doesn't need are left out.
+    """
+    types = ()
+    for typ in (arg.types if isinstance(arg.types, tuple) else (arg.types,)):
+        types += _WIDEN.get(typ, (typ,))
+    # bool is an int as far as isinstance is concerned
+    no_bool = bool not in types and any(issubclass(bool, typ) for typ in types)
+    max_len = arg.max_len
+    keys = _compile(arg.keys) if arg.keys is not None else None
+    values = _compile(arg.values) if arg.values is not None else None
+
+    if max_len is None and keys is None and values is None:
+        if no_bool:
+            return lambda value: None if isinstance(value, types) and value.__class__ is not bool else 'Invalid'
+        return lambda value: None if isinstance(value, types) else 'Invalid'
+
+    def check(value):
+        if not isinstance(value, types) or (no_bool and value.__class__ is bool):
+            return 'Invalid'
+        if max_len is not None and len(value) > max_len:
+            return 'Too Long'
+        if keys is not None:
+            for key in value:
+                if keys(key) is not None:
+                    return 'Invalid'
+        if values is not None:
+            for item in (value.itervalues() if isinstance(value, dict) else value):
+                if values(item) is not None:
+                    return 'Invalid'
+        return None
+    return check
+
+
+def compile_schema(schema):
+    """
+    Turn a schema, a dict of argument name -> `Arg`, into a function which
+    checks the arguments of a call. It returns None if they're fine,
+    otherwise a dict of argument name -> 'Required', 'Unknown', 'Invalid'
+    or 'Too Long'.
+    """
+    checks = [(name, arg.optional, _compile(arg)) for name, arg in schema.items()]
+    known = frozenset(schema)
+
+    def validate(args):
+        errors = None
+        if not known.issuperset(args):
+            errors = dict((name, 'Unknown') for name in args if name not in known)
+        for name, optional, check in checks:
+            value = args.get(name, MISSING)
+            if value is MISSING or value is None:
+                if optional:
+                    continue
+                reason = 'Required'
+            else:
+                reason = check(value)
+                if reason is None:
+                    continue
+            if errors is None:
+                errors = {}
+            errors[name] = reason
+        return errors
+    return validate